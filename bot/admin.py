@@ -1,7 +1,12 @@
 # admin.py - добавление функционала "Мои записи"
 import os
 import logging
-import requests
+from api_client import api_get, api_post
+from media import get_photo, remember_photo
+from cache import get_cached, get_master_by_tg, invalidate as invalidate_cache, warm_up
+from availability import add_free_slot
+import broadcast
+from state_store import StateStore
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import ContextTypes
 from datetime import datetime, timedelta
@@ -19,7 +24,7 @@ API_BASE_URL = os.getenv('API_BASE_URL')
 if not API_BASE_URL:
     logger.error("❌ API_BASE_URL не установлен в .env файле")
 # Состояния пользователей для админ-панели
-admin_states = {}
+admin_states = StateStore('admin_states')
 
 async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать админ-панель для мастеров"""
@@ -28,12 +33,7 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Проверяем, является ли пользователь мастером
-        response = requests.get(f"{API_BASE_URL}/api/specialists-all")
-        if response.json()['message'] != 'success':
-            raise Exception("Error fetching specialists")
-            
-        masters = response.json()['data']
-        user_master = next((m for m in masters if m.get('tg_id') == str(user_id)), None)
+        user_master = await get_master_by_tg(user_id, refresh_if_missing=True)
         
         if not user_master:
             # Пользователь не является мастером
@@ -51,26 +51,28 @@ async def show_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Пользователь является мастером, показываем админ-панель
-        photo_url = f"{API_BASE_URL}/photo/images/admin.jpg"
+        photo_url = "/photo/images/admin.jpg"
         message_text = f"♔ Админ-панель мастера\n\nМастер: {user_master['имя']}"
 
         keyboard = [
             [InlineKeyboardButton("⊹ Добавить свободное время", callback_data='admin_add_freetime')],
             [InlineKeyboardButton("≣ Мои записи", callback_data='admin_my_records')],
             [InlineKeyboardButton("⎋ Рассылка", callback_data='admin_broadcast')],  # Новая кнопка
+            [InlineKeyboardButton("⟳ Обновить данные сайта", callback_data='admin_refresh_cache')],
             [InlineKeyboardButton("☰ Главное меню", callback_data='back_to_main')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         try:
-            photo_response = requests.get(photo_url)
-            if photo_response.status_code == 200:
-                photo_data = photo_response.content
+            photo_data = await get_photo(photo_url)
+            if photo_data:
                 if query:
                     media = InputMediaPhoto(media=photo_data, caption=message_text)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
                 else:
-                    await update.message.reply_photo(photo=photo_data, caption=message_text, reply_markup=reply_markup)
+                    sent_message = await update.message.reply_photo(photo=photo_data, caption=message_text, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
             else:
                 if query:
                     await query.edit_message_text(text=message_text, reply_markup=reply_markup)
@@ -122,6 +124,10 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await show_clients_list(update, context, user_id)
     elif data == 'admin_confirm_broadcast':
         await confirm_and_send_broadcast(update, context, user_id)
+    elif data in ('admin_broadcast_pause', 'admin_broadcast_resume', 'admin_broadcast_cancel'):
+        await control_broadcast(update, context, data)
+    elif data == 'admin_refresh_cache':
+        await refresh_site_data(update, context, user_id)
     # ДОБАВЬТЕ ЭТИ ОБРАБОТЧИКИ:
     elif data.startswith('admin_select_service_'):
         service_id = data.split('_')[3]
@@ -172,12 +178,7 @@ async def show_master_freetime(update: Update, context: ContextTypes.DEFAULT_TYP
 
     try:
         # Получаем мастера по tg_id
-        response = requests.get(f"{API_BASE_URL}/api/specialists-all")
-        if response.json()['message'] != 'success':
-            raise Exception("Error fetching specialists")
-            
-        masters = response.json()['data']
-        user_master = next((m for m in masters if m.get('tg_id') == str(user_id)), None)
+        user_master = await get_master_by_tg(user_id)
         
         if not user_master:
             await query.edit_message_caption(caption="❌ Мастер не найден")
@@ -185,18 +186,19 @@ async def show_master_freetime(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # Получаем свободное время мастера (только будущее)
         today = datetime.now().strftime('%Y-%m-%d')
-        freetime_response = requests.get(
-            f"{API_BASE_URL}/api/freetime-available",
+        freetime_response = await api_get(
+            "/api/freetime-available",
             params={
                 'masterId': user_master['id'],
-                'fromDate': today
+                'fromDate': today,
+                'format': 'compact'
             }
         )
 
-        if freetime_response.json()['message'] != 'success':
+        if freetime_response['message'] != 'success':
             raise Exception("Error fetching free time")
 
-        freetime_data = freetime_response.json()['data']
+        freetime_data = freetime_response['data']
         
         if not freetime_data:
             message_text = "⏰ У вас нет свободного времени на будущие даты"
@@ -263,12 +265,7 @@ async def start_add_freetime(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # Получаем мастера по tg_id
     try:
-        response = requests.get(f"{API_BASE_URL}/api/specialists-all")
-        if response.json()['message'] != 'success':
-            raise Exception("Error fetching specialists")
-            
-        masters = response.json()['data']
-        user_master = next((m for m in masters if m.get('tg_id') == str(user_id)), None)
+        user_master = await get_master_by_tg(user_id)
         
         if not user_master:
             await query.edit_message_text(text="❌ Мастер не найден")
@@ -298,11 +295,11 @@ async def select_service_for_freetime(update: Update, context: ContextTypes.DEFA
 
     try:
         # Получаем ВСЕ услуги (а не только для конкретного мастера)
-        response = requests.get(f"{API_BASE_URL}/api/services-all")
-        if response.json()['message'] != 'success':
+        response = await get_cached("/api/services-all")
+        if response['message'] != 'success':
             raise Exception("Error fetching services")
             
-        services = response.json()['data']
+        services = response['data']
         
         if not services:
             await query.edit_message_caption(
@@ -459,10 +456,10 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     'доступно': 1
                 }
 
-                response = requests.post(f"{API_BASE_URL}/api/schedule", 
-                                       json=schedule_data)
+                response = await api_post("/api/schedule", json=schedule_data)
 
-                if response.status_code == 200 and response.json().get('message') == 'success':
+                if response.get('message') == 'success':
+                    add_free_slot(response['data'])
                     await update.message.reply_text("✅ Свободное время успешно добавлено!")
                     
                     # Очищаем состояние
@@ -472,7 +469,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     # Возвращаем в админ-панель
                     await show_admin_panel(update, context)
                 else:
-                    error_msg = response.json().get('error', 'Неизвестная ошибка')
+                    error_msg = response.get('error', 'Неизвестная ошибка')
                     await update.message.reply_text(f"❌ Ошибка при добавлении свободного времени: {error_msg}")
 
             except Exception as e:
@@ -501,12 +498,7 @@ async def show_master_appointments(update: Update, context: ContextTypes.DEFAULT
 
     try:
         # Получаем мастера по tg_id
-        response = requests.get(f"{API_BASE_URL}/api/specialists-all")
-        if response.json()['message'] != 'success':
-            raise Exception("Error fetching specialists")
-            
-        masters = response.json()['data']
-        user_master = next((m for m in masters if m.get('tg_id') == str(user_id)), None)
+        user_master = await get_master_by_tg(user_id)
         
         if not user_master:
             await query.edit_message_text(text="❌ Мастер не найден")
@@ -514,18 +506,18 @@ async def show_master_appointments(update: Update, context: ContextTypes.DEFAULT
 
         # Получаем записи мастера (текущие и будущие)
         today = datetime.now().strftime('%Y-%m-%d')
-        appointments_response = requests.get(
-            f"{API_BASE_URL}/api/appointments",
+        appointments_response = await api_get(
+            "/api/appointments",
             params={
                 'specialistId': user_master['id'],
                 'startDate': today
             }
         )
 
-        if appointments_response.json()['message'] != 'success':
+        if appointments_response['message'] != 'success':
             raise Exception("Error fetching appointments")
 
-        appointments = appointments_response.json()['data']
+        appointments = appointments_response['data']
         
         if not appointments:
             message_text = "📋 У вас нет записей на сегодня и будущие даты"
@@ -595,12 +587,7 @@ async def show_master_appointments(update: Update, context: ContextTypes.DEFAULT
 
     try:
         # Получаем мастера по tg_id
-        response = requests.get(f"{API_BASE_URL}/api/specialists-all")
-        if response.json()['message'] != 'success':
-            raise Exception("Error fetching specialists")
-            
-        masters = response.json()['data']
-        user_master = next((m for m in masters if m.get('tg_id') == str(user_id)), None)
+        user_master = await get_master_by_tg(user_id)
         
         if not user_master:
             await query.edit_message_text(text="❌ Мастер не найден")
@@ -608,18 +595,18 @@ async def show_master_appointments(update: Update, context: ContextTypes.DEFAULT
 
         # Получаем записи мастера (текущие и будущие)
         today = datetime.now().strftime('%Y-%m-%d')
-        appointments_response = requests.get(
-            f"{API_BASE_URL}/api/appointments",
+        appointments_response = await api_get(
+            "/api/appointments",
             params={
                 'specialistId': user_master['id'],
                 'startDate': today
             }
         )
 
-        if appointments_response.json()['message'] != 'success':
+        if appointments_response['message'] != 'success':
             raise Exception("Error fetching appointments")
 
-        appointments = appointments_response.json()['data']
+        appointments = appointments_response['data']
         
         if not appointments:
             message_text = "📋 У вас нет записей на сегодня и будущие даты"
@@ -671,12 +658,7 @@ async def show_master_appointments(update: Update, context: ContextTypes.DEFAULT
 
     try:
         # Получаем мастера по tg_id
-        response = requests.get(f"{API_BASE_URL}/api/specialists-all")
-        if response.json()['message'] != 'success':
-            raise Exception("Error fetching specialists")
-            
-        masters = response.json()['data']
-        user_master = next((m for m in masters if m.get('tg_id') == str(user_id)), None)
+        user_master = await get_master_by_tg(user_id)
         
         if not user_master:
             await query.edit_message_text(text="❌ Мастер не найден")
@@ -684,18 +666,18 @@ async def show_master_appointments(update: Update, context: ContextTypes.DEFAULT
 
         # Получаем записи мастера
         today = datetime.now().strftime('%Y-%m-%d')
-        appointments_response = requests.get(
-            f"{API_BASE_URL}/api/appointments",
+        appointments_response = await api_get(
+            "/api/appointments",
             params={
                 'specialistId': user_master['id'],
                 'startDate': today
             }
         )
 
-        if appointments_response.json()['message'] != 'success':
+        if appointments_response['message'] != 'success':
             raise Exception("Error fetching appointments")
 
-        appointments = appointments_response.json()['data']
+        appointments = appointments_response['data']
         
         if not appointments:
             message_text = "📋 У вас нет записей на сегодня и будущие даты"
@@ -729,21 +711,30 @@ async def show_broadcast_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         # Получаем статистику по клиентам
-        response = requests.get(f"{API_BASE_URL}/api/broadcast-stats")
-        if response.status_code != 200 or response.json().get('message') != 'success':
+        response = await api_get("/api/broadcast-stats")
+        if response.get('message') != 'success':
             raise Exception("Error fetching broadcast stats")
             
-        stats = response.json().get('data', {})
+        stats = response.get('data', {})
         total_clients = stats.get('total_clients', 0)
+        dead_clients = stats.get('dead_clients', 0)
         
         message_text = (
             "📢 Рассылка сообщений\n\n"
-            f"👥 Всего клиентов с Telegram: {total_clients}\n\n"
+            f"👥 Всего клиентов с Telegram: {total_clients}\n"
+            f"🚫 Заблокировали бота: {dead_clients}\n\n"
             "Выберите действие:"
         )
         
+        if broadcast.is_active():
+            # Идущей рассылкой можно управлять из меню
+            message_text = f"{broadcast.progress_text()}\n\n{message_text}"
+            keyboard = broadcast.progress_keyboard().inline_keyboard[:-1]
+        else:
+            keyboard = [[InlineKeyboardButton("⊹ Создать рассылку", callback_data='admin_create_broadcast')]]
+        
         keyboard = [
-            [InlineKeyboardButton("⊹ Создать рассылку", callback_data='admin_create_broadcast')],
+            *keyboard,
             [InlineKeyboardButton("≣ Статистика клиентов", callback_data='admin_clients_list')],
             [InlineKeyboardButton("↲ Назад в админ-панель", callback_data='admin_panel')],
             [InlineKeyboardButton("☰ Главное меню", callback_data='back_to_main')]
@@ -784,23 +775,26 @@ async def show_clients_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
     query = update.callback_query
     
     try:
-        response = requests.get(f"{API_BASE_URL}/api/clients-with-tg")
-        if response.json()['message'] != 'success':
-            raise Exception("Error fetching clients")
-            
-        clients = response.json()['data']
+        total_clients = await broadcast.count_recipients()
         
-        if not clients:
+        if not total_clients:
             message_text = "❌ Нет клиентов с подключенным Telegram"
         else:
-            message_text = f"👥 Список клиентов ({len(clients)}):\n\n"
+            message_text = f"👥 Список клиентов ({total_clients}):\n\n"
             
-            for i, client in enumerate(clients, 1):
-                message_text += f"{i}. {client['имя']} ({client['телефон']})\n"
-                
-                # Обрезаем длинные сообщения
-                if len(message_text) > 3500:  # Лимит Telegram
-                    message_text += f"\n... и еще {len(clients) - i} клиентов"
+            # Клиенты загружаются страницами, пока сообщение не заполнится
+            i = 0
+            async for page in broadcast.stream_recipients(details=True):
+                for client in page:
+                    i += 1
+                    message_text += f"{i}. {client['имя']} ({client['телефон']})\n"
+                    
+                    # Обрезаем длинные сообщения
+                    if len(message_text) > 3500:  # Лимит Telegram
+                        break
+                if len(message_text) > 3500:
+                    if total_clients > i:
+                        message_text += f"\n... и еще {total_clients - i} клиентов"
                     break
         
         keyboard = [
@@ -890,11 +884,11 @@ async def process_broadcast_message(update: Update, context: ContextTypes.DEFAUL
     
     # Получаем статистику клиентов
     try:
-        stats_response = requests.get(f"{API_BASE_URL}/api/broadcast-stats")
-        if stats_response.status_code != 200 or stats_response.json().get('message') != 'success':
+        stats_response = await api_get("/api/broadcast-stats")
+        if stats_response.get('message') != 'success':
             raise Exception("Error fetching stats")
         
-        stats = stats_response.json().get('data', {})
+        stats = stats_response.get('data', {})
         total_clients = stats.get('total_clients', 0)
         
         preview_text = (
@@ -926,7 +920,7 @@ async def process_broadcast_message(update: Update, context: ContextTypes.DEFAUL
 
 
 async def confirm_and_send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    """Подтвердить и начать рассылку"""
+    """Подтвердить и запустить рассылку в фоне"""
     query = update.callback_query
     user_data = admin_states.get(user_id, {})
     
@@ -941,81 +935,87 @@ async def confirm_and_send_broadcast(update: Update, context: ContextTypes.DEFAU
         await query.edit_message_text(text="❌ Сообщение для рассылки не найдено")
         return
     
-    # Начинаем рассылку
-    await query.edit_message_text(text="🔄 Начинаем рассылку...")
-    
     try:
-        # Получаем список клиентов
-        clients_response = requests.get(f"{API_BASE_URL}/api/clients-with-tg")
-        if clients_response.json()['message'] != 'success':
-            raise Exception("Error fetching clients")
-        
-        clients = clients_response.json()['data']
-        total_clients = len(clients)
-        
-        if total_clients == 0:
-            await query.edit_message_text(text="❌ Нет клиентов для рассылки")
-            return
-        
-        # Обновляем данные рассылки
-        broadcast_data['total_count'] = total_clients
-        broadcast_data['start_time'] = datetime.now().strftime('%H:%M:%S')
-        user_data['broadcast_data'] = broadcast_data
-        admin_states[user_id] = user_data
-        
-        # Отправляем рассылку
-        success_count = 0
-        failed_count = 0
-        
-        for i, client in enumerate(clients, 1):
-            try:
-                # Импортируем бота из main
-                from main import bot
-                
-                await bot.send_message(
-                    chat_id=client['tg_id'],
-                    text=message_text,
-                    parse_mode='HTML'
-                )
-                success_count += 1
-                
-                # Обновляем прогресс каждые 10 сообщений или для последнего сообщения
-                if i % 10 == 0 or i == total_clients:
-                    progress = f"📤 Отправлено {i}/{total_clients} сообщений"
-                    await query.edit_message_text(text=progress)
-                
-                # Задержка чтобы не превысить лимиты Telegram
-                import asyncio
-                await asyncio.sleep(0.1)
-                
-            except Exception as e:
-                logger.error(f"Error sending to client {client['id']}: {e}")
-                failed_count += 1
-        
-        # Финальный отчет
-        report_text = (
-            "✓ Рассылка завершена!\n\n"
-            f"≣ Статистика:\n"
-            f"• Всего клиентов: {total_clients}\n"
-            f"• Успешно отправлено: {success_count}\n"
-            f"• Не удалось отправить: {failed_count}\n"
-            f"• Время начала: {broadcast_data['start_time']}\n"
-            f"• Время окончания: {datetime.now().strftime('%H:%M:%S')}"
+        # Рассылка идет в фоне, прогресс обновляется в этом сообщении
+        started = await broadcast.start_broadcast(
+            context.bot,
+            user_id,
+            query.message.chat_id,
+            query.message.message_id,
+            message_text
         )
         
-        keyboard = [
-            [InlineKeyboardButton("⊹ Новая рассылка", callback_data='admin_create_broadcast')],
-            [InlineKeyboardButton("♔ Админ-панель", callback_data='admin_panel')],
-            [InlineKeyboardButton("☰ Главное меню", callback_data='back_to_main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if not started:
+            await query.edit_message_text(
+                text=f"❌ Уже идет другая рассылка\n\n{broadcast.progress_text()}",
+                reply_markup=broadcast.progress_keyboard()
+            )
+            return
         
-        await query.edit_message_text(text=report_text, reply_markup=reply_markup)
+        await query.edit_message_text(text="🔄 Начинаем рассылку...", reply_markup=broadcast.progress_keyboard())
         
         # Очищаем состояние
         if user_id in admin_states:
             del admin_states[user_id]
             
     except Exception as e:
-        logger.error(f"Error during broadcast: {e}")
-        await query.edit_message_text(text="❌ Ошибка во время рассылки")
\ No newline at end of file
+        logger.error(f"Error starting broadcast: {e}")
+        await query.edit_message_text(text="❌ Ошибка во время рассылки")
+
+
+async def control_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
+    """Пауза, продолжение или отмена идущей рассылки"""
+    query = update.callback_query
+    
+    if not broadcast.is_active():
+        keyboard = [
+            [InlineKeyboardButton("↲ Назад к рассылке", callback_data='admin_broadcast_menu')],
+            [InlineKeyboardButton("♔ Админ-панель", callback_data='admin_panel')]
+        ]
+        await query.edit_message_text(text="ℹ️ Нет активной рассылки", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    
+    if action == 'admin_broadcast_pause':
+        await broadcast.pause_broadcast()
+    elif action == 'admin_broadcast_resume':
+        await broadcast.resume_broadcast()
+    else:
+        # Итоговый отчет задача рассылки допишет в сообщение с прогрессом
+        await broadcast.cancel_broadcast()
+        keyboard = [
+            [InlineKeyboardButton("↲ Назад к рассылке", callback_data='admin_broadcast_menu')],
+            [InlineKeyboardButton("♔ Админ-панель", callback_data='admin_panel')]
+        ]
+        await query.edit_message_text(text="✕ Рассылка отменена", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    
+    # Управлять можно и из другого сообщения (меню рассылки) - обновляем его тоже
+    if query.message.message_id != broadcast.get_broadcast()['message_id']:
+        try:
+            await query.edit_message_text(text=broadcast.progress_text(), reply_markup=broadcast.progress_keyboard())
+        except Exception as e:
+            logger.debug(f"Progress message not modified: {e}")
+
+
+async def refresh_site_data(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id):
+    """Сбросить кэш справочных данных после правок в веб-админке (мастера, услуги, ссылки, страницы)"""
+    query = update.callback_query
+    keyboard = [[InlineKeyboardButton("♔ Админ-панель", callback_data='admin_panel')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    try:
+        if not await get_master_by_tg(user_id):
+            message_text = "❌ У вас нет прав доступа к админ-панели"
+        else:
+            invalidate_cache()
+            await warm_up()
+            logger.info(f"Мастер {user_id} обновил справочные данные")
+            message_text = "✓ Данные сайта обновлены"
+    except Exception as e:
+        logger.error(f"Error refreshing site data: {e}")
+        message_text = "❌ Ошибка подключения к серверу"
+
+    if query.message.photo:
+        await query.edit_message_caption(caption=message_text, reply_markup=reply_markup)
+    else:
+        await query.edit_message_text(text=message_text, reply_markup=reply_markup)
@@ -0,0 +1,223 @@
+# api_client.py - общий асинхронный клиент API сервера
+import os
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+import httpx
+from dotenv import load_dotenv
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Конфигурация
+API_BASE_URL = os.getenv('API_BASE_URL')
+
+# Проверка наличия переменной
+if not API_BASE_URL:
+    logger.error("❌ API_BASE_URL не установлен в .env файле")
+
+# Таймауты по умолчанию (в секундах)
+DEFAULT_TIMEOUT = float(os.getenv('API_TIMEOUT', '10'))
+PHOTO_TIMEOUT = float(os.getenv('API_PHOTO_TIMEOUT', '15'))
+
+# Пул keep-alive соединений, общий для всех обработчиков и задач планировщика
+POOL_LIMITS = httpx.Limits(
+    max_connections=50,
+    max_keepalive_connections=20,
+    keepalive_expiry=30
+)
+
+_client = None
+_client_loop = None
+
+# Выполняющиеся GET запросы: одинаковые параллельные запросы ждут один общий ответ
+_inflight = {}
+
+# Кэш GET ответов в рамках обработки одного обновления Telegram
+_update_memo = contextvars.ContextVar('update_memo', default=None)
+
+# Последние ответы с ETag для условных GET запросов: ключ запроса -> (etag, данные)
+ETAG_STORE_SIZE = int(os.getenv('API_ETAG_STORE_SIZE', '256'))
+_etag_store = OrderedDict()
+# ETag храним только для справочных данных (как в cache.RESOURCE_TTL) и поиска мастера/услуги по id:
+# разовые ответы (страницы получателей рассылки, диапазоны свободного времени) не вытесняют их и не держат память
+CONDITIONAL_PATHS = {
+    '/api/specialists',
+    '/api/specialists-all',
+    '/api/services',
+    '/api/services-all',
+    '/api/links',
+    '/api/pages/главная',
+}
+CONDITIONAL_PREFIXES = ('/api/specialist/', '/api/service/')
+
+# Счетчики запросов к API
+api_stats = {
+    'requests': 0,
+    'coalesced': 0,
+    'memo_hits': 0,
+    'not_modified': 0,
+}
+
+
+class ApiError(Exception):
+    """Ошибка обращения к API: сеть, таймаут или ответ не в формате JSON"""
+
+
+def get_client():
+    """Вернуть общий httpx.AsyncClient, создав его при первом обращении"""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    # Клиент привязан к event loop, поэтому пересоздаем его при смене цикла
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            base_url=API_BASE_URL or '',
+            timeout=DEFAULT_TIMEOUT,
+            limits=POOL_LIMITS
+        )
+        _client_loop = loop
+    return _client
+
+
+async def request(method, path, *, params=None, json=None, timeout=None):
+    """Выполнить запрос к API и вернуть декодированный JSON"""
+    if method != 'GET':
+        # После изменения данных ранее прочитанные в этом обновлении ответы неактуальны
+        memo = _update_memo.get()
+        if memo:
+            memo.clear()
+
+    headers = {}
+    key = _request_key(path, params) if method == 'GET' and _is_conditional(path) else None
+    stored = _etag_store.get(key) if key else None
+    if stored:
+        # Условный запрос: если данные не менялись, сервер ответит 304 без тела
+        headers['If-None-Match'] = stored[0]
+
+    api_stats['requests'] += 1
+    client = get_client()
+    try:
+        response = await client.request(
+            method,
+            path,
+            params=params,
+            json=json,
+            headers=headers,
+            timeout=timeout or DEFAULT_TIMEOUT
+        )
+    except httpx.HTTPError as e:
+        raise ApiError(f"{method} {path}: {e}") from e
+
+    if response.status_code == 304 and stored:
+        api_stats['not_modified'] += 1
+        _etag_store.move_to_end(key)
+        return stored[1]
+
+    try:
+        data = response.json()
+    except ValueError as e:
+        raise ApiError(f"{method} {path}: некорректный ответ (HTTP {response.status_code})") from e
+
+    if isinstance(data, dict) and data.get('format') == 'compact':
+        data = {'message': data.get('message'), 'data': expand_compact(data)}
+
+    etag = response.headers.get('etag')
+    if key and etag and response.status_code == 200:
+        _etag_store[key] = (etag, data)
+        _etag_store.move_to_end(key)
+        while len(_etag_store) > ETAG_STORE_SIZE:
+            _etag_store.popitem(last=False)
+    return data
+
+
+def expand_compact(data):
+    """Развернуть колоночный ответ (?format=compact) в список строк, как в обычном формате"""
+    columns = data.get('columns', {})
+    dictionaries = data.get('dictionaries', {})
+    values = []
+    for name, column in columns.items():
+        dictionary = dictionaries.get(name)
+        values.append([dictionary[i] for i in column] if dictionary is not None else column)
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+
+def _is_conditional(path):
+    return path in CONDITIONAL_PATHS or path.startswith(CONDITIONAL_PREFIXES)
+
+
+def _request_key(path, params):
+    return (path, tuple(sorted((params or {}).items())))
+
+
+async def _shared_get(key, path, params, timeout):
+    """Один запрос на все одинаковые параллельные GET"""
+    task = _inflight.get(key)
+    if task is None:
+        task = create_background_task(request('GET', path, params=params, timeout=timeout))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        api_stats['coalesced'] += 1
+    # shield: отмена одного ожидающего не должна отменять общий запрос
+    return await asyncio.shield(task)
+
+
+async def api_get(path, params=None, timeout=None):
+    """GET запрос к API (с объединением одинаковых запросов и кэшем в рамках обновления)"""
+    key = _request_key(path, params)
+    memo = _update_memo.get()
+    if memo is not None and key in memo:
+        api_stats['memo_hits'] += 1
+        return memo[key]
+
+    data = await _shared_get(key, path, params, timeout)
+    if memo is not None:
+        memo[key] = data
+    return data
+
+
+def create_background_task(coro):
+    """Запустить фоновую задачу без кэша GET ответов текущего обновления: задача переживает
+    обработку обновления и не должна читать или дописывать его кэш"""
+    context = contextvars.copy_context()
+    context.run(_update_memo.set, None)
+    return asyncio.create_task(coro, context=context)
+
+
+@contextmanager
+def update_memo():
+    """Включить кэш GET ответов на время обработки одного обновления"""
+    token = _update_memo.set({})
+    try:
+        yield
+    finally:
+        _update_memo.reset(token)
+
+
+async def api_post(path, json=None, timeout=None):
+    """POST запрос к API"""
+    return await request('POST', path, json=json, timeout=timeout)
+
+
+async def api_patch(path, json=None, timeout=None):
+    """PATCH запрос к API"""
+    return await request('PATCH', path, json=json, timeout=timeout)
+
+
+async def api_delete(path, timeout=None):
+    """DELETE запрос к API"""
+    return await request('DELETE', path, timeout=timeout)
+
+
+async def close_client():
+    """Закрыть пул соединений"""
+    global _client, _client_loop
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
@@ -0,0 +1,322 @@
+# availability.py - индекс свободного времени в памяти бота
+# дата -> мастер -> услуга -> компактные массивы (минуты от начала дня, id слота)
+import os
+import time
+import logging
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from api_client import api_get, create_background_task
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# На сколько дней вперед держим расписание в памяти
+AVAILABILITY_DAYS = int(os.getenv('AVAILABILITY_DAYS', '120'))
+# Как часто (в секундах) перечитывать расписание с сервера
+AVAILABILITY_REFRESH_SECONDS = int(os.getenv('AVAILABILITY_REFRESH_SECONDS', '60'))
+# Сколько дней дальнего горизонта перечитывается за одно обновление (обход по кругу)
+REFRESH_CHUNK_DAYS = 14
+
+# дата -> мастер_id -> услуга_id -> (array('H') минут, array('I') id), отсортировано по времени
+_index = {}
+# id слота -> (дата, мастер_id, услуга_id)
+_slot_keys = {}
+# Справочники имен из ответов freetime-available
+_masters = {}   # мастер_id -> имя
+_services = {}  # услуга_id -> (название, цена)
+
+_range = None          # (from_date, to_date) загруженного диапазона, строки YYYY-MM-DD
+_refreshed_at = 0
+_refresh_cursor = None
+_load_task = None
+_refresh_task = None
+# Слоты, забронированные, пока шла загрузка с сервера: в снимке загрузки они могут быть еще свободны
+_booked_since_fetch = set()
+_fetches_in_flight = 0
+
+
+def _to_minutes(time_str):
+    hours, minutes = time_str.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def _to_time(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def _date_str(date):
+    return date.strftime('%Y-%m-%d')
+
+
+def _add_row(row):
+    """Добавить слот из строки freetime-available в индекс"""
+    slot_id = row['id']
+    if slot_id in _slot_keys:
+        _remove_slot(slot_id)
+
+    date = row['дата']
+    master_id = int(row['мастер_id'])
+    service_id = int(row['услуга_id'])
+    if row.get('мастер_имя'):
+        _masters[master_id] = row['мастер_имя']
+    if row.get('услуга_название'):
+        _services[service_id] = (row['услуга_название'], row.get('услуга_цена'))
+
+    masters = _index.setdefault(date, {})
+    services = masters.setdefault(master_id, {})
+    if service_id not in services:
+        services[service_id] = (array('H'), array('I'))
+    times, ids = services[service_id]
+
+    minutes = _to_minutes(row['время'])
+    position = bisect_left(times, minutes)
+    times.insert(position, minutes)
+    ids.insert(position, slot_id)
+    _slot_keys[slot_id] = (date, master_id, service_id)
+
+
+def _remove_slot(slot_id):
+    """Удалить слот из индекса. Возвращает True, если слот был в индексе"""
+    key = _slot_keys.pop(slot_id, None)
+    if key is None:
+        return False
+    date, master_id, service_id = key
+    services = _index[date][master_id]
+    times, ids = services[service_id]
+    position = ids.index(slot_id)
+    del times[position]
+    del ids[position]
+
+    # Убираем пустые ветки, чтобы не держать лишние даты
+    if not ids:
+        del services[service_id]
+        if not services:
+            del _index[date][master_id]
+            if not _index[date]:
+                del _index[date]
+    return True
+
+
+def _clear_dates(from_date, to_date):
+    """Удалить из индекса все слоты в диапазоне дат"""
+    for date in [d for d in _index if from_date <= d <= to_date]:
+        for services in _index[date].values():
+            for times, ids in services.values():
+                for slot_id in ids:
+                    _slot_keys.pop(slot_id, None)
+        del _index[date]
+
+
+async def _fetch(from_date, to_date):
+    """Загрузить свободные слоты за диапазон дат одним запросом"""
+    data = await api_get(
+        "/api/freetime-available",
+        params={'fromDate': from_date, 'toDate': to_date, 'format': 'compact'}
+    )
+    if data.get('message') != 'success':
+        raise Exception(f"Error fetching free time: {data.get('error')}")
+    return data['data']
+
+
+async def _fetch_fresh(from_date, to_date):
+    """Загрузить слоты и отбросить те, что забронированы через бота во время загрузки"""
+    global _fetches_in_flight
+    _fetches_in_flight += 1
+    try:
+        rows = await _fetch(from_date, to_date)
+    finally:
+        _fetches_in_flight -= 1
+    booked = set(_booked_since_fetch)
+    if not _fetches_in_flight:
+        _booked_since_fetch.clear()
+    return [row for row in rows if row['id'] not in booked]
+
+
+def _horizon():
+    """Диапазон дат, который держим в памяти: с начала текущей недели на AVAILABILITY_DAYS вперед"""
+    today = datetime.now().date()
+    start_of_week = today - timedelta(days=today.weekday())
+    return _date_str(start_of_week), _date_str(today + timedelta(days=AVAILABILITY_DAYS))
+
+
+async def load():
+    """Полная загрузка индекса одним запросом freetime-available"""
+    global _range, _refreshed_at, _refresh_cursor
+    from_date, to_date = _horizon()
+    rows = await _fetch_fresh(from_date, to_date)
+
+    _index.clear()
+    _slot_keys.clear()
+    for row in rows:
+        _add_row(row)
+
+    _range = (from_date, to_date)
+    _refreshed_at = time.monotonic()
+    _refresh_cursor = None
+    logger.info(f"✅ Индекс свободного времени загружен: {len(_slot_keys)} слотов, {from_date} - {to_date}")
+
+
+async def _replace_dates(from_date, to_date):
+    """Перечитать диапазон дат с сервера и заменить его в индексе"""
+    rows = await _fetch_fresh(from_date, to_date)
+    _clear_dates(from_date, to_date)
+    for row in rows:
+        _add_row(row)
+
+
+async def refresh():
+    """Инкрементальное обновление: ближайшая неделя и очередной кусок дальнего горизонта"""
+    global _range, _refreshed_at, _refresh_cursor
+    from_date, to_date = _horizon()
+    today = datetime.now().date()
+    hot_end = _date_str(today + timedelta(days=6))
+
+    # Сдвигаем горизонт: отбрасываем прошедшие недели
+    if _range and _range[0] < from_date:
+        _clear_dates(_range[0], _date_str(datetime.strptime(from_date, '%Y-%m-%d').date() - timedelta(days=1)))
+
+    # Ближайшая неделя меняется чаще всего - обновляем ее каждый раз
+    await _replace_dates(from_date, hot_end)
+
+    # Дальний горизонт обходим по кругу кусками по REFRESH_CHUNK_DAYS дней
+    chunk_start = _refresh_cursor if _refresh_cursor and _refresh_cursor > hot_end else \
+        _date_str(today + timedelta(days=7))
+    chunk_end = min(
+        _date_str(datetime.strptime(chunk_start, '%Y-%m-%d').date() + timedelta(days=REFRESH_CHUNK_DAYS - 1)),
+        to_date
+    )
+    await _replace_dates(chunk_start, chunk_end)
+    _refresh_cursor = None if chunk_end >= to_date else \
+        _date_str(datetime.strptime(chunk_end, '%Y-%m-%d').date() + timedelta(days=1))
+
+    _range = (from_date, to_date)
+    _refreshed_at = time.monotonic()
+
+
+async def _run_refresh():
+    global _refresh_task
+    try:
+        await refresh()
+    except Exception as e:
+        logger.error(f"Ошибка обновления индекса свободного времени: {e}")
+    finally:
+        _refresh_task = None
+
+
+async def _ensure_loaded():
+    """Загрузить индекс при первом обращении и запускать фоновое обновление по таймеру"""
+    global _load_task, _refresh_task
+    if _range is None:
+        if _load_task is None:
+            _load_task = create_background_task(load())
+        try:
+            await _load_task
+        finally:
+            _load_task = None
+        return
+
+    if time.monotonic() - _refreshed_at >= AVAILABILITY_REFRESH_SECONDS and _refresh_task is None:
+        _refresh_task = create_background_task(_run_refresh())
+
+
+def _covers(from_date, to_date):
+    return _range is not None and _range[0] <= from_date and to_date <= _range[1]
+
+
+def _iter_slots(from_date, to_date, master_id=None, service_id=None):
+    """Слоты из индекса в виде строк как у freetime-available, по дате и времени"""
+    for date in sorted(d for d in _index if from_date <= d <= to_date):
+        rows = []
+        for m_id, services in _index[date].items():
+            if master_id is not None and m_id != int(master_id):
+                continue
+            for s_id, (times, ids) in services.items():
+                if service_id is not None and s_id != int(service_id):
+                    continue
+                service_name, service_price = _services.get(s_id, (None, None))
+                for minutes, slot_id in zip(times, ids):
+                    rows.append({
+                        'id': slot_id,
+                        'дата': date,
+                        'время': _to_time(minutes),
+                        'мастер_id': m_id,
+                        'услуга_id': s_id,
+                        'доступно': 1,
+                        'мастер_имя': _masters.get(m_id),
+                        'услуга_название': service_name,
+                        'услуга_цена': service_price,
+                    })
+        rows.sort(key=lambda row: row['время'])
+        yield from rows
+
+
+async def get_free_slots(from_date, to_date, master_id=None, service_id=None):
+    """Свободные слоты за диапазон дат (из памяти, вне горизонта - с сервера)"""
+    await _ensure_loaded()
+    if _covers(from_date, to_date):
+        return list(_iter_slots(from_date, to_date, master_id, service_id))
+
+    rows = await _fetch(from_date, to_date)
+    return [
+        row for row in rows
+        if (master_id is None or str(row['мастер_id']) == str(master_id))
+        and (service_id is None or str(row['услуга_id']) == str(service_id))
+    ]
+
+
+async def get_available_week(master_id, service_id, start_date, until_date):
+    """Первая неделя (пн-вс) со свободным временем для мастера и услуги, не раньше start_date.
+    Формат ответа совпадает с /available-week на сервере."""
+    await _ensure_loaded()
+    if not _covers(start_date, until_date):
+        return await api_get(
+            f"/api/specialist/{master_id}/service/{service_id}/available-week",
+            params={'start': start_date, 'until': until_date}
+        )
+
+    master_id = int(master_id)
+    service_id = int(service_id)
+    first_date = next(
+        (date for date in sorted(_index)
+         if start_date <= date <= until_date and service_id in _index[date].get(master_id, {})),
+        None
+    )
+    if first_date is None:
+        return {'message': 'success', 'firstAvailableDate': None, 'weekStart': None, 'weekEnd': None, 'availableDates': []}
+
+    first = datetime.strptime(first_date, '%Y-%m-%d').date()
+    week_start = _date_str(first - timedelta(days=first.weekday()))
+    week_end = _date_str(first - timedelta(days=first.weekday()) + timedelta(days=6))
+    available_dates = [
+        date for date in sorted(_index)
+        if week_start <= date <= week_end and service_id in _index[date].get(master_id, {})
+    ]
+    return {
+        'message': 'success',
+        'firstAvailableDate': first_date,
+        'weekStart': week_start,
+        'weekEnd': week_end,
+        'availableDates': available_dates
+    }
+
+
+def mark_booked(slot_id):
+    """Слот забронирован через бота - сразу убираем его из индекса"""
+    slot_id = int(slot_id)
+    if _fetches_in_flight:
+        # Идущая загрузка могла получить слот еще свободным - не даем ей вернуть его в индекс
+        _booked_since_fetch.add(slot_id)
+    if _remove_slot(slot_id):
+        logger.info(f"Слот {slot_id} удален из индекса свободного времени")
+
+
+def add_free_slot(slot):
+    """Новый или освободившийся слот - сразу добавляем в индекс"""
+    _booked_since_fetch.discard(slot['id'])
+    if _range is None or not (_range[0] <= slot['дата'] <= _range[1]):
+        return
+    _add_row(slot)
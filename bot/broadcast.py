@@ -0,0 +1,308 @@
+# broadcast.py - фоновая рассылка: пул отправки с лимитами, контрольные точки, пауза и отмена
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from api_client import api_get, create_background_task
+from delivery import send_limited, deliver
+from dead_chats import ChatUnavailable
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from dotenv import load_dotenv
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Файл с состоянием рассылки: после перезапуска она продолжается с контрольной точки
+BROADCAST_STATE_FILE = os.getenv('BROADCAST_STATE_FILE', 'broadcast_state.json')
+# Сколько получателей отправляется между контрольными точками (после сбоя повторно может уйти не больше этого)
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '50'))
+# Не чаще какого интервала (в секундах) обновлять сообщение с прогрессом
+PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '3'))
+
+# Статусы: running - идет, paused - на паузе, cancelled - отменена, done - завершена
+ACTIVE_STATUSES = ('running', 'paused')
+
+_state = None
+_task = None
+_bot = None
+# Установлен, когда рассылка не на паузе
+_resumed = asyncio.Event()
+# Очередность записи контрольных точек
+_save_lock = asyncio.Lock()
+_progress_at = 0
+
+
+def _load_state():
+    try:
+        with open(BROADCAST_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка чтения состояния рассылки: {e}")
+        return None
+
+
+def _write_state(content):
+    """Записать контрольную точку в файл (атомарно через временный файл)"""
+    tmp_file = f"{BROADCAST_STATE_FILE}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_file, BROADCAST_STATE_FILE)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения состояния рассылки: {e}")
+
+
+async def _save_state():
+    """Сохранить контрольную точку: снимок состояния делается в event loop, файл пишется в отдельном потоке.
+    Записи идут по очереди, чтобы более старый снимок не перезаписал новый"""
+    async with _save_lock:
+        content = json.dumps(_state, ensure_ascii=False, indent=2)
+        await asyncio.to_thread(_write_state, content)
+
+
+def get_broadcast():
+    """Текущая рассылка (копия состояния) или None"""
+    return dict(_state) if _state else None
+
+
+def is_active():
+    return bool(_state) and _state['status'] in ACTIVE_STATUSES
+
+
+async def stream_recipients(after_id=0, page_size=BROADCAST_CHUNK_SIZE, details=False):
+    """Получатели рассылки страницами по возрастанию id (keyset): в памяти только одна страница"""
+    while after_id is not None:
+        params = {'afterId': after_id, 'limit': page_size}
+        if details:
+            params['details'] = 1
+        response = await api_get("/api/broadcast-recipients", params=params)
+        if response.get('message') != 'success':
+            raise Exception("Error fetching recipients")
+        if response['data']:
+            yield response['data']
+        after_id = response.get('next_after')
+
+
+async def count_recipients():
+    response = await api_get("/api/broadcast-stats")
+    if response.get('message') != 'success':
+        raise Exception("Error fetching broadcast stats")
+    return response.get('data', {}).get('total_clients', 0)
+
+
+def progress_keyboard():
+    """Кнопки управления рассылкой"""
+    if _state and _state['status'] == 'paused':
+        toggle = InlineKeyboardButton("▶ Продолжить", callback_data='admin_broadcast_resume')
+    else:
+        toggle = InlineKeyboardButton("⏸ Пауза", callback_data='admin_broadcast_pause')
+    return InlineKeyboardMarkup([
+        [toggle],
+        [InlineKeyboardButton("✕ Отменить рассылку", callback_data='admin_broadcast_cancel')],
+        [InlineKeyboardButton("♔ Админ-панель", callback_data='admin_panel')]
+    ])
+
+
+def progress_text():
+    status = "⏸ Рассылка на паузе" if _state['status'] == 'paused' else "📤 Идет рассылка"
+    total = _state['total'] if _state['total'] is not None else '...'
+    return (
+        f"{status}\n\n"
+        f"• Обработано: {_state['sent'] + _state['failed']}/{total}\n"
+        f"• Успешно отправлено: {_state['sent']}\n"
+        f"• Не удалось отправить: {_state['failed']}\n"
+        f"• Время начала: {_state['start_time']}"
+    )
+
+
+def _report_text():
+    title = "✕ Рассылка отменена" if _state['status'] == 'cancelled' else "✓ Рассылка завершена!"
+    return (
+        f"{title}\n\n"
+        f"≣ Статистика:\n"
+        f"• Всего клиентов: {_state['total'] or 0}\n"
+        f"• Успешно отправлено: {_state['sent']}\n"
+        f"• Не удалось отправить: {_state['failed']}\n"
+        f"• Время начала: {_state['start_time']}\n"
+        f"• Время окончания: {_state['end_time']}"
+    )
+
+
+async def _edit_progress(text, reply_markup):
+    """Обновить сообщение администратора с прогрессом"""
+    try:
+        await send_limited(_state['chat_id'], lambda: _bot.edit_message_text(
+            chat_id=_state['chat_id'],
+            message_id=_state['message_id'],
+            text=text,
+            reply_markup=reply_markup
+        ), idempotent=True)
+    except Exception as e:
+        # "message is not modified" и удаленное сообщение не мешают рассылке
+        logger.debug(f"Не удалось обновить прогресс рассылки: {e}")
+
+
+async def _update_progress(force=False):
+    """Обновить прогресс не чаще PROGRESS_INTERVAL"""
+    global _progress_at
+    now = time.monotonic()
+    if not force and now - _progress_at < PROGRESS_INTERVAL:
+        return
+    _progress_at = now
+    await _edit_progress(progress_text(), progress_keyboard())
+
+
+async def _send_to_client(client):
+    try:
+        await send_limited(client['tg_id'], lambda: _bot.send_message(
+            chat_id=client['tg_id'],
+            text=_state['text'],
+            parse_mode='HTML'
+        ))
+        return True
+    except ChatUnavailable:
+        # Недоступные чаты пропускаются без запроса к Telegram
+        return False
+    except Exception as e:
+        logger.error(f"Error sending to client {client['id']}: {e}")
+        return False
+
+
+async def _run():
+    """Рассылка по страницам получателей: после каждой сохраняется контрольная точка и проверяются пауза и отмена"""
+    try:
+        if _state['total'] is None:
+            _state['total'] = await count_recipients()
+            await _save_state()
+        await _update_progress(force=True)
+
+        # Отправка начинается с первой страницы, не дожидаясь загрузки всех получателей
+        async for chunk in stream_recipients(_state['last_client_id']):
+            await _resumed.wait()
+            if _state['status'] == 'cancelled':
+                break
+
+            report = await deliver(f"рассылка {_state['id']}", chunk, _send_to_client)
+            _state['sent'] += report['sent']
+            _state['failed'] += report['failed']
+            _state['last_client_id'] = chunk[-1]['id']
+            await _save_state()
+            await _update_progress()
+
+        if _state['status'] != 'cancelled':
+            _state['status'] = 'done'
+        _state['end_time'] = datetime.now().strftime('%H:%M:%S')
+        await _save_state()
+        logger.info(f"Рассылка {_state['id']} завершена: {_state['status']}, отправлено {_state['sent']}, ошибок {_state['failed']}")
+
+        keyboard = [
+            [InlineKeyboardButton("⊹ Новая рассылка", callback_data='admin_create_broadcast')],
+            [InlineKeyboardButton("♔ Админ-панель", callback_data='admin_panel')],
+            [InlineKeyboardButton("☰ Главное меню", callback_data='back_to_main')]
+        ]
+        await _edit_progress(_report_text(), InlineKeyboardMarkup(keyboard))
+
+    except asyncio.CancelledError:
+        # Остановка бота: состояние остается активным и рассылка продолжится после запуска
+        await _save_state()
+        raise
+    except Exception as e:
+        logger.error(f"Error during broadcast: {e}")
+        _state['status'] = 'paused'
+        _resumed.clear()
+        await _save_state()
+        await _edit_progress(f"❌ Ошибка во время рассылки, она поставлена на паузу\n\n{progress_text()}", progress_keyboard())
+
+
+def _start_task():
+    global _task
+    if _state['status'] == 'paused':
+        _resumed.clear()
+    else:
+        _resumed.set()
+    _task = create_background_task(_run())
+
+
+async def start_broadcast(bot, admin_id, chat_id, message_id, text):
+    """Запустить рассылку в фоне. Возвращает False, если уже идет другая рассылка"""
+    global _state, _bot
+    if is_active():
+        return False
+    _bot = bot
+    _state = {
+        'id': datetime.now().strftime('%Y%m%d%H%M%S'),
+        'admin_id': admin_id,
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'text': text,
+        'status': 'running',
+        'total': None,
+        'sent': 0,
+        'failed': 0,
+        'last_client_id': 0,
+        'start_time': datetime.now().strftime('%H:%M:%S'),
+        'end_time': None
+    }
+    await _save_state()
+    _start_task()
+    return True
+
+
+async def pause_broadcast():
+    if _state and _state['status'] == 'running':
+        _state['status'] = 'paused'
+        _resumed.clear()
+        await _save_state()
+        await _update_progress(force=True)
+
+
+async def resume_broadcast():
+    if _state and _state['status'] == 'paused':
+        _state['status'] = 'running'
+        await _save_state()
+        if _task is None or _task.done():
+            # Рассылка была остановлена ошибкой - запускаем заново с контрольной точки
+            _start_task()
+        else:
+            _resumed.set()
+        await _update_progress(force=True)
+
+
+async def cancel_broadcast():
+    if is_active():
+        _state['status'] = 'cancelled'
+        await _save_state()
+        # Снимаем паузу, чтобы задача дошла до проверки отмены
+        _resumed.set()
+        if _task is None or _task.done():
+            _state['end_time'] = datetime.now().strftime('%H:%M:%S')
+            await _save_state()
+
+
+async def resume_saved_broadcast(bot):
+    """Продолжить рассылку, прерванную остановкой бота (вызывается из post_init)"""
+    global _state, _bot
+    saved = _load_state()
+    if not saved or saved.get('status') not in ACTIVE_STATUSES:
+        return
+    _state, _bot = saved, bot
+    logger.info(f"Продолжаем рассылку {_state['id']} после клиента {_state['last_client_id']}")
+    _start_task()
+
+
+async def stop_broadcast():
+    """Остановить задачу рассылки при остановке бота (контрольная точка сохраняется)"""
+    global _task
+    if _task is not None and not _task.done():
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+    _task = None
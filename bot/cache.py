@@ -0,0 +1,141 @@
+# cache.py - кэш справочных данных (мастера, услуги, ссылки, страницы) с TTL
+import os
+import time
+import logging
+from dotenv import load_dotenv
+from api_client import api_get, create_background_task
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Время жизни данных по ресурсам (в секундах)
+DEFAULT_TTL = int(os.getenv('CACHE_DEFAULT_TTL', '300'))
+RESOURCE_TTL = {
+    '/api/specialists-all': 300,
+    '/api/services': 600,
+    '/api/services-all': 600,
+    '/api/links': 3600,
+    '/api/pages/главная': 3600,
+}
+
+# Доля TTL, после которой данные обновляются в фоне (пока старое значение еще отдается)
+REFRESH_AHEAD = 0.8
+
+# path -> {'data', 'expires_at', 'refresh_at'}
+_entries = {}
+_refresh_tasks = {}
+
+# Индекс мастеров по tg_id, перестраивается при каждой загрузке /api/specialists-all
+_masters_by_tg = {}
+
+# Счетчики кэша
+cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'errors': 0,
+}
+
+
+async def _load(path):
+    """Загрузить ресурс с сервера и положить в кэш (кэшируются только успешные ответы)"""
+    data = await api_get(path)
+    if data.get('message') == 'success':
+        ttl = RESOURCE_TTL.get(path, DEFAULT_TTL)
+        now = time.monotonic()
+        _entries[path] = {
+            'data': data,
+            'expires_at': now + ttl,
+            'refresh_at': now + ttl * REFRESH_AHEAD,
+        }
+        if path == '/api/specialists-all':
+            _rebuild_master_index(data['data'])
+    return data
+
+
+def _rebuild_master_index(masters):
+    """Перестроить индекс tg_id -> мастер"""
+    global _masters_by_tg
+    _masters_by_tg = {
+        str(master['tg_id']): master
+        for master in masters
+        if master.get('tg_id')
+    }
+
+
+async def _refresh(path):
+    """Фоновое обновление ресурса до истечения TTL"""
+    try:
+        await _load(path)
+        cache_stats['refreshes'] += 1
+    except Exception as e:
+        cache_stats['errors'] += 1
+        logger.error(f"Ошибка фонового обновления кэша {path}: {e}")
+    finally:
+        _refresh_tasks.pop(path, None)
+
+
+async def get_cached(path):
+    """Получить справочные данные из кэша или загрузить с сервера"""
+    entry = _entries.get(path)
+    now = time.monotonic()
+
+    if entry and now < entry['expires_at']:
+        cache_stats['hits'] += 1
+        if now >= entry['refresh_at'] and path not in _refresh_tasks:
+            _refresh_tasks[path] = create_background_task(_refresh(path))
+        return entry['data']
+
+    cache_stats['misses'] += 1
+    return await _load(path)
+
+
+def invalidate(path=None):
+    """Сбросить кэш ресурса (None - весь кэш). Справочные данные правят в веб-админке, поэтому мастер
+    может обновить их в боте сразу, не дожидаясь TTL; повторная загрузка идет условным GET по ETag"""
+    global _masters_by_tg
+    if path is None:
+        _entries.clear()
+        _masters_by_tg = {}
+        return
+    _entries.pop(path, None)
+
+
+async def get_master_by_tg(tg_id, refresh_if_missing=False):
+    """Найти мастера по tg_id (None, если пользователь не мастер)"""
+    data = await get_cached('/api/specialists-all')
+    if data.get('message') != 'success':
+        raise Exception("Error fetching specialists")
+
+    master = _masters_by_tg.get(str(tg_id))
+    if master is None and refresh_if_missing:
+        # tg_id мог быть назначен мастеру после последней загрузки
+        invalidate('/api/specialists-all')
+        await get_cached('/api/specialists-all')
+        master = _masters_by_tg.get(str(tg_id))
+    return master
+
+
+async def is_master(tg_id, refresh_if_missing=False):
+    """Проверить, является ли пользователь мастером"""
+    return await get_master_by_tg(tg_id, refresh_if_missing) is not None
+
+
+async def warm_up():
+    """Загрузить все справочные ресурсы заранее (при запуске бота)"""
+    for path in RESOURCE_TTL:
+        try:
+            await _load(path)
+        except Exception as e:
+            cache_stats['errors'] += 1
+            logger.error(f"Ошибка предзагрузки кэша {path}: {e}")
+    logger.info(f"✅ Кэш справочных данных загружен: {len(_entries)} ресурсов")
+
+
+def get_cache_stats():
+    """Статистика кэша: попадания, промахи, фоновые обновления"""
+    total = cache_stats['hits'] + cache_stats['misses']
+    hit_rate = cache_stats['hits'] / total * 100 if total else 0
+    return {**cache_stats, 'entries': len(_entries), 'hit_rate': round(hit_rate, 1)}
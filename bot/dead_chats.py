@@ -0,0 +1,97 @@
+# dead_chats.py - реестр чатов, в которые бот не может писать (хранится на сервере)
+import os
+import time
+import logging
+from datetime import datetime
+import pytz
+from api_client import api_get, api_post, api_delete
+from telegram.error import Forbidden, BadRequest
+from dotenv import load_dotenv
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Через сколько дней снова пробовать писать в недоступный чат
+RECHECK_DAYS = float(os.getenv('DEAD_CHAT_RECHECK_DAYS', '30'))
+
+# Время в реестре сервера - московское
+TIMEZONE = pytz.timezone('Europe/Moscow')
+
+# tg_id -> время отметки (unix timestamp)
+_registry = {}
+
+# Счетчики реестра
+dead_chat_stats = {
+    'skipped': 0,
+    'marked': 0,
+    'revived': 0,
+}
+
+
+class ChatUnavailable(Exception):
+    """Чат недоступен: бот заблокирован пользователем или чат не найден"""
+
+
+def is_dead_chat_error(error):
+    """Ошибка Telegram означает, что писать в этот чат бессмысленно"""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in str(error).lower()
+
+
+def _parse_marked_at(value):
+    try:
+        return TIMEZONE.localize(datetime.strptime(value, '%Y-%m-%d %H:%M:%S')).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+
+async def load_dead_chats():
+    """Загрузить реестр с сервера (вызывается при запуске бота)"""
+    try:
+        response = await api_get("/api/dead-chats")
+        if response.get('message') != 'success':
+            logger.error(f"Ошибка загрузки реестра недоступных чатов: {response}")
+            return
+        _registry.clear()
+        for row in response['data']:
+            _registry[str(row['tg_id'])] = _parse_marked_at(row['отмечено'])
+        logger.info(f"Загружено недоступных чатов: {len(_registry)}")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки реестра недоступных чатов: {e}")
+
+
+def is_dead(chat_id):
+    """Чат недоступен и время повторной проверки еще не пришло"""
+    marked_at = _registry.get(str(chat_id))
+    return marked_at is not None and time.time() - marked_at < RECHECK_DAYS * 86400
+
+
+async def mark_dead(chat_id, reason):
+    """Отметить чат недоступным (локально сразу, на сервере - для статистики и после перезапуска)"""
+    _registry[str(chat_id)] = time.time()
+    dead_chat_stats['marked'] += 1
+    logger.info(f"Чат {chat_id} недоступен ({reason}), следующая попытка через {RECHECK_DAYS:g} дн.")
+    try:
+        await api_post("/api/dead-chats", json={'tg_id': str(chat_id), 'причина': reason})
+    except Exception as e:
+        logger.error(f"Ошибка сохранения недоступного чата {chat_id}: {e}")
+
+
+def is_marked(chat_id):
+    """Чат есть в реестре (проверка в памяти, без запроса к серверу)"""
+    return str(chat_id) in _registry
+
+
+async def mark_alive(chat_id):
+    """Сообщение в чат из реестра дошло или пользователь снова пишет боту - убираем чат из реестра"""
+    if _registry.pop(str(chat_id), None) is None:
+        return
+    dead_chat_stats['revived'] += 1
+    logger.info(f"Чат {chat_id} снова доступен")
+    try:
+        await api_delete(f"/api/dead-chats/{chat_id}")
+    except Exception as e:
+        logger.error(f"Ошибка снятия отметки недоступного чата {chat_id}: {e}")
@@ -0,0 +1,166 @@
+# delivery.py - конвейер отправки уведомлений с лимитами Telegram
+import os
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from telegram.error import RetryAfter, TimedOut, Forbidden, BadRequest
+import dead_chats
+from dead_chats import ChatUnavailable
+from dotenv import load_dotenv
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 сообщение в секунду в один чат
+GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '25'))
+CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+# Сколько отправок выполняется параллельно
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', '8'))
+# Сколько раз повторять отправку после RetryAfter / таймаута (таймаут - только для idempotent вызовов)
+MAX_RETRIES = 3
+
+# Счетчики отправки
+delivery_stats = {
+    'sent': 0,
+    'retry_after': 0,
+    'timeouts': 0,
+}
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """Дождаться свободного токена и забрать его"""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+_global_bucket = TokenBucket(GLOBAL_RATE, capacity=GLOBAL_RATE)
+# chat_id -> TokenBucket
+_chat_buckets = {}
+# До какого момента (time.monotonic) Telegram просил не отправлять сообщения
+_paused_until = 0
+
+
+def _chat_bucket(chat_id):
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(_chat_buckets) > 1000:
+            # Полные ведра ничего не ограничивают - их можно забыть
+            for key in [key for key, value in _chat_buckets.items() if value.is_full()]:
+                del _chat_buckets[key]
+        bucket = _chat_buckets[chat_id] = TokenBucket(CHAT_RATE)
+    return bucket
+
+
+def _retry_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+async def send_limited(chat_id, send, idempotent=False):
+    """Выполнить отправку в чат (send - функция без аргументов, возвращающая корутину) с учетом лимитов.
+    При RetryAfter все отправки ставятся на паузу на указанное Telegram время.
+    TimedOut не значит, что сообщение не дошло, поэтому повторяются только idempotent вызовы
+    (например, edit_message_*); для остальных решение о повторе принимает вызывающий код.
+    В недоступные чаты (реестр dead_chats) отправка не выполняется - сразу ChatUnavailable."""
+    global _paused_until
+    if dead_chats.is_dead(chat_id):
+        dead_chats.dead_chat_stats['skipped'] += 1
+        raise ChatUnavailable(chat_id)
+    attempt = 0
+    while True:
+        pause = _paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        await _chat_bucket(chat_id).acquire()
+        await _global_bucket.acquire()
+        try:
+            result = await send()
+            delivery_stats['sent'] += 1
+            # Чат из реестра снова доступен (прошел срок повторной проверки)
+            await dead_chats.mark_alive(chat_id)
+            return result
+        except (Forbidden, BadRequest) as e:
+            if not dead_chats.is_dead_chat_error(e):
+                raise
+            await dead_chats.mark_dead(chat_id, str(e))
+            raise ChatUnavailable(chat_id) from e
+        except RetryAfter as e:
+            delivery_stats['retry_after'] += 1
+            delay = _retry_seconds(e)
+            _paused_until = max(_paused_until, time.monotonic() + delay)
+            logger.warning(f"Telegram просит подождать {delay} с (чат {chat_id})")
+            if attempt >= MAX_RETRIES:
+                raise
+        except TimedOut:
+            delivery_stats['timeouts'] += 1
+            if not idempotent or attempt >= MAX_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+        attempt += 1
+
+
+async def deliver(name, items, send_item, workers=DELIVERY_WORKERS):
+    """Разослать items через пул воркеров. send_item(item) возвращает True при успешной отправке.
+    Возвращает отчет: сколько отправлено, ошибок, время и скорость."""
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    report = {'total': queue.qsize(), 'sent': 0, 'failed': 0}
+    if not report['total']:
+        return {**report, 'elapsed': 0, 'rate': 0}
+
+    retries_before = delivery_stats['retry_after'] + delivery_stats['timeouts']
+    started_at = time.monotonic()
+
+    async def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                success = await send_item(item)
+            except Exception as e:
+                logger.error(f"Ошибка отправки ({name}): {e}")
+                success = False
+            report['sent' if success else 'failed'] += 1
+
+    await asyncio.gather(*(worker() for _ in range(min(workers, report['total']))))
+
+    elapsed = time.monotonic() - started_at
+    report['elapsed'] = round(elapsed, 2)
+    report['rate'] = round(report['sent'] / elapsed, 1) if elapsed else report['sent']
+    report['retries'] = delivery_stats['retry_after'] + delivery_stats['timeouts'] - retries_before
+    logger.info(
+        f"📨 {name}: отправлено {report['sent']} из {report['total']} за {report['elapsed']} с "
+        f"({report['rate']} сообщ/с), ошибок {report['failed']}, повторов {report['retries']}"
+    )
+    return report
@@ -1,13 +1,21 @@
 # main.py
 import os
 import logging
-import requests
+from api_client import api_get, api_post, api_patch, close_client, update_memo, api_stats, ApiError
+from media import get_photo, remember_photo, flush_registry
+from cache import warm_up, get_cache_stats
+from availability import get_free_slots, get_available_week, mark_booked, load as load_availability
+from notification import initialize_notifications, shutdown_notifications
+from broadcast import resume_saved_broadcast, stop_broadcast
+from dead_chats import load_dead_chats, dead_chat_stats, is_marked, mark_alive
+from state_store import StateStore, get_state_stats, init_state_backend, close_state_backend, load_user_states, save_user_states
 from admin import show_admin_panel, handle_admin_callback, handle_admin_message
 from datetime import datetime, timedelta
 from personal_cabinet import handle_personal_callback, handle_personal_message
 from menu_handlers import show_main_menu, handle_menu_callback
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.constants import ChatType
 from admin import handle_admin_message, admin_states
 from admin import show_admin_panel, handle_admin_callback, handle_admin_message, admin_states
 from personal_cabinet import handle_personal_message, personal_states
@@ -35,8 +43,8 @@ if not API_BASE_URL:
 
 
 
-# Состояния пользователей
-user_states = {}
+# Состояния пользователей (брошенные диалоги забываются по времени и при переполнении)
+user_states = StateStore('user_states')
 
 # Словарь для перевода английских дней недели в русские сокращения
 WEEKDAY_MAP = {
@@ -68,7 +76,9 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         'admin_panel', 'admin_add_freetime', 'admin_my_records', 
         'admin_my_appointments', 'admin_my_freetime', 'admin_back_to_records',
         'admin_back_to_services', 'admin_broadcast', 'admin_broadcast_menu',
-        'admin_create_broadcast', 'admin_clients_list', 'admin_confirm_broadcast'
+        'admin_create_broadcast', 'admin_clients_list', 'admin_confirm_broadcast',
+        'admin_broadcast_pause', 'admin_broadcast_resume', 'admin_broadcast_cancel',
+        'admin_refresh_cache'
     ]
     
     admin_starts_with = [
@@ -212,14 +222,14 @@ async def show_booking_options(query):
     reply_markup = InlineKeyboardMarkup(keyboard)
     message_text = "Как вы хотите записаться?"
     
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     
     try:
-        photo_response = requests.get(photo_url)
-        if photo_response.status_code == 200:
-            photo_data = photo_response.content
+        photo_data = await get_photo(photo_url)
+        if photo_data:
             media = InputMediaPhoto(media=photo_data, caption=message_text)
-            await query.edit_message_media(media=media, reply_markup=reply_markup)
+            sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+            remember_photo(photo_url, sent_message)
         else:
             await query.edit_message_text(text=message_text, reply_markup=reply_markup)
     except Exception as e:
@@ -229,41 +239,29 @@ async def show_booking_options(query):
 
 async def show_services(query):
     """Показать список услуг с доступным временем (в будущем)"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     try:
-        response = requests.get(f"{API_BASE_URL}/api/services")
-        data = response.json()
+        # Все пары (мастер, услуга) со свободным временем в будущем одним запросом
+        data = await api_get(
+            "/api/available-pairs",
+            params={'start': datetime.now().strftime('%Y-%m-%d')}
+        )
         
         if data['message'] == 'success':
-            services = data['data']
             keyboard = []
+            shown_services = set()
             
-            for service in services:
-                specialists_response = requests.get(f"{API_BASE_URL}/api/service/{service['id']}/specialists")
-                
-                if specialists_response.json()['message'] == 'success':
-                    specialists = specialists_response.json()['data']
-                    
-                    has_available_time = False
-                    for specialist in specialists:
-                        # Проверяем доступное время в будущем (без ограничения по дате)
-                        dates_response = requests.get(
-                            f"{API_BASE_URL}/api/specialist/{specialist['id']}/service/{service['id']}/available-dates",
-                            params={'start': datetime.now().strftime('%Y-%m-%d'), 'end': '2099-12-31'}
-                        )
-                        
-                        if (dates_response.json()['message'] == 'success' and 
-                            dates_response.json()['availableDates']):
-                            has_available_time = True
-                            break
-                    
-                    if has_available_time:
-                        keyboard.append([
-                            InlineKeyboardButton(
-                                f"{service['название']} - {service['цена']}₽",
-                                callback_data=f'service_{service["id"]}'
-                            )
-                        ])
+            # Пары отсортированы по категории и названию услуги
+            for pair in data['data']:
+                if pair['услуга_id'] in shown_services:
+                    continue
+                shown_services.add(pair['услуга_id'])
+                keyboard.append([
+                    InlineKeyboardButton(
+                        f"{pair['услуга_название']} - {pair['цена']}₽",
+                        callback_data=f'service_{pair["услуга_id"]}'
+                    )
+                ])
             
             if not keyboard:
                 message_text = (
@@ -278,11 +276,11 @@ async def show_services(query):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 try:
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(photo_url)
+                    if photo_data:
                         media = InputMediaPhoto(media=photo_data, caption=message_text)
-                        await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        remember_photo(photo_url, sent_message)
                     else:
                         await query.edit_message_text(text=message_text, reply_markup=reply_markup)
                 except Exception as e:
@@ -296,11 +294,11 @@ async def show_services(query):
             message_text = "Выберите услугу:"
             
             try:
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
+                photo_data = await get_photo(photo_url)
+                if photo_data:
                     media = InputMediaPhoto(media=photo_data, caption=message_text)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
                 else:
                     await query.edit_message_text(text=message_text, reply_markup=reply_markup)
             except Exception as e:
@@ -325,41 +323,28 @@ async def show_services(query):
 
 async def show_specialists(query):
     """Показать список мастеров с доступным временем (в будущем)"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     try:
-        response = requests.get(f"{API_BASE_URL}/api/specialists")
-        data = response.json()
+        # Все пары (мастер, услуга) со свободным временем в будущем одним запросом
+        data = await api_get(
+            "/api/available-pairs",
+            params={'start': datetime.now().strftime('%Y-%m-%d')}
+        )
         
         if data['message'] == 'success':
-            specialists = data['data']
             keyboard = []
+            shown_specialists = set()
             
-            for specialist in specialists:
-                services_response = requests.get(f"{API_BASE_URL}/api/specialist/{specialist['id']}/services")
-                
-                if services_response.json()['message'] == 'success':
-                    services = services_response.json()['data']
-                    
-                    has_available_time = False
-                    for service in services:
-                        # Проверяем доступное время в будущем (без ограничения по дате)
-                        dates_response = requests.get(
-                            f"{API_BASE_URL}/api/specialist/{specialist['id']}/service/{service['id']}/available-dates",
-                            params={'start': datetime.now().strftime('%Y-%m-%d'), 'end': '2099-12-31'}
-                        )
-                        
-                        if (dates_response.json()['message'] == 'success' and 
-                            dates_response.json()['availableDates']):
-                            has_available_time = True
-                            break
-                    
-                    if has_available_time:
-                        keyboard.append([
-                            InlineKeyboardButton(
-                                f"{specialist['имя']}",
-                                callback_data=f'specialist_{specialist["id"]}'
-                            )
-                        ])
+            for pair in sorted(data['data'], key=lambda p: p['мастер_имя']):
+                if pair['мастер_id'] in shown_specialists:
+                    continue
+                shown_specialists.add(pair['мастер_id'])
+                keyboard.append([
+                    InlineKeyboardButton(
+                        f"{pair['мастер_имя']}",
+                        callback_data=f'specialist_{pair["мастер_id"]}'
+                    )
+                ])
             
             if not keyboard:
                 message_text = (
@@ -374,11 +359,11 @@ async def show_specialists(query):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 try:
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(photo_url)
+                    if photo_data:
                         media = InputMediaPhoto(media=photo_data, caption=message_text)
-                        await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        remember_photo(photo_url, sent_message)
                     else:
                         await query.edit_message_text(text=message_text, reply_markup=reply_markup)
                 except Exception as e:
@@ -392,11 +377,11 @@ async def show_specialists(query):
             message_text = "Выберите мастера:"
             
             try:
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
+                photo_data = await get_photo(photo_url)
+                if photo_data:
                     media = InputMediaPhoto(media=photo_data, caption=message_text)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
                 else:
                     await query.edit_message_text(text=message_text, reply_markup=reply_markup)
             except Exception as e:
@@ -427,50 +412,28 @@ async def handle_cancel_to_main(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def show_specialists_for_service(query, service_id):
     """Показать мастеров для выбранной услуги (проверяя доступное время в будущем)"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     try:
-        response = requests.get(f"{API_BASE_URL}/api/service/{service_id}/specialists")
-        data = response.json()
+        data = await api_get(
+            "/api/available-pairs",
+            params={'start': datetime.now().strftime('%Y-%m-%d')}
+        )
         
         if data['message'] == 'success':
-            specialists = data['data']
+            # Мастера, у которых есть свободное время на эту услугу
+            specialists = [
+                pair for pair in data['data']
+                if str(pair['услуга_id']) == str(service_id)
+            ]
             
-            # ИНИЦИАЛИЗИРУЕМ keyboard ПЕРЕД ИСПОЛЬЗОВАНИЕМ
             keyboard = []
-            
-            if not specialists:
-                message_text = "❌ Нет доступных мастеров для этой услуги"
-                keyboard = [
-                    [InlineKeyboardButton("↲ Назад", callback_data='choose_service')],
-                    [InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                try:
-                    if query.message.photo:
-                        await query.edit_message_caption(caption=message_text, reply_markup=reply_markup)
-                    else:
-                        await query.edit_message_text(text=message_text, reply_markup=reply_markup)
-                except Exception as e:
-                    logger.error(f"Error editing message (no specialists): {e}")
-                    await query.message.reply_text(text=message_text, reply_markup=reply_markup)
-                return
-            
-            # Теперь keyboard уже инициализирована, можно добавлять кнопки
-            for specialist in specialists:
-                # Проверяем доступное время в будущем
-                dates_response = requests.get(
-                    f"{API_BASE_URL}/api/specialist/{specialist['id']}/service/{service_id}/available-dates",
-                    params={'start': datetime.now().strftime('%Y-%m-%d'), 'end': '2099-12-31'}
-                )
-                
-                if (dates_response.json()['message'] == 'success' and 
-                    dates_response.json()['availableDates']):
-                    keyboard.append([
-                        InlineKeyboardButton(
-                            f"{specialist['имя']}",
-                            callback_data=f'select_specialist_{specialist["id"]}_{service_id}'
-                        )
-                    ])
+            for specialist in sorted(specialists, key=lambda p: p['мастер_имя']):
+                keyboard.append([
+                    InlineKeyboardButton(
+                        f"{specialist['мастер_имя']}",
+                        callback_data=f'select_specialist_{specialist["мастер_id"]}_{service_id}'
+                    )
+                ])
             
             if not keyboard:
                 message_text = (
@@ -483,12 +446,12 @@ async def show_specialists_for_service(query, service_id):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 try:
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(photo_url)
+                    if photo_data:
                         try:
                             media = InputMediaPhoto(media=photo_data, caption=message_text)
-                            await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            remember_photo(photo_url, sent_message)
                         except Exception as media_error:
                             logger.error(f"Error editing media (no specialists): {media_error}")
                             if query.message.photo:
@@ -511,11 +474,11 @@ async def show_specialists_for_service(query, service_id):
             message_text = "Выберите мастера:"
             
             try:
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
+                photo_data = await get_photo(photo_url)
+                if photo_data:
                     media = InputMediaPhoto(media=photo_data, caption=message_text)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
                 else:
                     await query.edit_message_text(text=message_text, reply_markup=reply_markup)
             except Exception as e:
@@ -550,50 +513,28 @@ async def show_specialists_for_service(query, service_id):
 
 async def show_services_for_specialist(query, specialist_id):
     """Показать услуги для выбранного мастера (проверяя доступное время в будущем)"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     try:
-        response = requests.get(f"{API_BASE_URL}/api/specialist/{specialist_id}/services")
-        data = response.json()
+        data = await api_get(
+            "/api/available-pairs",
+            params={'start': datetime.now().strftime('%Y-%m-%d')}
+        )
         
         if data['message'] == 'success':
-            services = data['data']
-            
-            if not services:
-                message_text = "❌ Нет доступных услуг для этого мастера"
-                keyboard = [
-                    [InlineKeyboardButton("↲ Назад", callback_data='choose_specialist')],
-                    [InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                try:
-                    # Пытаемся отредактировать сообщение в зависимости от его типа
-                    if query.message.photo:
-                        await query.edit_message_caption(caption=message_text, reply_markup=reply_markup)
-                    else:
-                        await query.edit_message_text(text=message_text, reply_markup=reply_markup)
-                except Exception as e:
-                    logger.error(f"Error editing message (no services): {e}")
-                    # Если не удалось отредактировать, отправляем новое сообщение
-                    await query.message.reply_text(text=message_text, reply_markup=reply_markup)
-                return
+            # Услуги мастера со свободным временем (уже отсортированы по категории и названию)
+            services = [
+                pair for pair in data['data']
+                if str(pair['мастер_id']) == str(specialist_id)
+            ]
             
             keyboard = []
             for service in services:
-                # Проверяем доступное время в будущем
-                dates_response = requests.get(
-                    f"{API_BASE_URL}/api/specialist/{specialist_id}/service/{service['id']}/available-dates",
-                    params={'start': datetime.now().strftime('%Y-%m-%d'), 'end': '2099-12-31'}
-                )
-                
-                if (dates_response.json()['message'] == 'success' and 
-                    dates_response.json()['availableDates']):
-                    keyboard.append([
-                        InlineKeyboardButton(
-                            f"{service['название']} - {service['цена']}₽",
-                            callback_data=f'select_service_{service["id"]}_{specialist_id}'
-                        )
-                    ])
+                keyboard.append([
+                    InlineKeyboardButton(
+                        f"{service['услуга_название']} - {service['цена']}₽",
+                        callback_data=f'select_service_{service["услуга_id"]}_{specialist_id}'
+                    )
+                ])
             
             if not keyboard:
                 message_text = (
@@ -606,13 +547,13 @@ async def show_services_for_specialist(query, specialist_id):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 try:
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(photo_url)
+                    if photo_data:
                         # Пытаемся отредактировать с фото
                         try:
                             media = InputMediaPhoto(media=photo_data, caption=message_text)
-                            await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            remember_photo(photo_url, sent_message)
                         except Exception as media_error:
                             logger.error(f"Error editing media (no services): {media_error}")
                             # Если не удалось отредактировать медиа, пробуем изменить текст/подпись
@@ -638,11 +579,11 @@ async def show_services_for_specialist(query, specialist_id):
             message_text = "Выберите услугу:"
             
             try:
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
+                photo_data = await get_photo(photo_url)
+                if photo_data:
                     media = InputMediaPhoto(media=photo_data, caption=message_text)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
                 else:
                     if query.message.photo:
                         await query.edit_message_caption(caption=message_text, reply_markup=reply_markup)
@@ -685,7 +626,7 @@ async def show_services_for_specialist(query, specialist_id):
 
 async def show_date_selection(query, specialist_id, service_id, target_date_str=None):
     """Показать выбор даты для бронирования с учетом свободного времени"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     user_id = query.from_user.id
     try:
         today = datetime.now().date()
@@ -708,71 +649,44 @@ async def show_date_selection(query, specialist_id, service_id, target_date_str=
             'service_id': service_id
         })
 
-        # Проверяем доступное время на текущую неделю
-        from_date_str = start_of_week.strftime('%Y-%m-%d')
-        to_date_str = end_of_week.strftime('%Y-%m-%d')
-        response = requests.get(
-            f"{API_BASE_URL}/api/specialist/{specialist_id}/service/{service_id}/available-dates",
-            params={'start': from_date_str, 'end': to_date_str}
+        # Первая неделя со свободным временем, начиная с текущей (максимум 3 месяца вперед)
+        max_search_date = today + timedelta(days=90)
+        data = await get_available_week(
+            specialist_id,
+            service_id,
+            start_of_week.strftime('%Y-%m-%d'),
+            (max_search_date + timedelta(days=6)).strftime('%Y-%m-%d')
         )
-        data = response.json()
-
-        # Если на текущей неделе нет свободного времени, ищем следующую доступную неделю
-        if data['message'] != 'success' or not data['availableDates']:
-            # Ищем первую неделю с доступным временем (максимум 3 месяца вперед)
-            max_search_date = today + timedelta(days=90)
-            current_start = start_of_week
-            found_week = None
-
-            while current_start <= max_search_date and not found_week:
-                current_end = current_start + timedelta(days=6)
-                response = requests.get(
-                    f"{API_BASE_URL}/api/specialist/{specialist_id}/service/{service_id}/available-dates",
-                    params={
-                        'start': current_start.strftime('%Y-%m-%d'),
-                        'end': current_end.strftime('%Y-%m-%d')
-                    }
-                )
-                data = response.json()
-                if data['message'] == 'success' and data['availableDates']:
-                    found_week = current_start
-                current_start += timedelta(days=7)
-
-            if found_week:
-                # Если найдена неделя с доступным временем, обновляем даты
-                start_of_week = found_week
-                end_of_week = start_of_week + timedelta(days=6)
-                from_date_str = start_of_week.strftime('%Y-%m-%d')
-                to_date_str = end_of_week.strftime('%Y-%m-%d')
-                response = requests.get(
-                    f"{API_BASE_URL}/api/specialist/{specialist_id}/service/{service_id}/available-dates",
-                    params={'start': from_date_str, 'end': to_date_str}
-                )
-                data = response.json()
-            else:
-                # Если ничего не найдено в течение 3 месяцев
-                message_text = (
-                    "❌ На ближайшие 3 месяца нет доступного времени для этой услуги и мастера.\n"
-                    "Попробуйте выбрать другую услугу или мастера."
-                )
-                keyboard = [
-                    [InlineKeyboardButton("🎯 Выбрать услугу", callback_data='choose_service')],
-                    [InlineKeyboardButton("♢ Выбрать мастера", callback_data='choose_specialist')],
-                    [InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                try:
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
-                        media = InputMediaPhoto(media=photo_data, caption=message_text)
-                        await query.edit_message_media(media=media, reply_markup=reply_markup)
-                    else:
-                        await query.edit_message_text(text=message_text, reply_markup=reply_markup)
-                except Exception as e:
-                    logger.error(f"Error in show_date_selection (no dates): {e}")
+
+        if data['message'] == 'success' and not data['availableDates']:
+            # Если ничего не найдено в течение 3 месяцев
+            message_text = (
+                "❌ На ближайшие 3 месяца нет доступного времени для этой услуги и мастера.\n"
+                "Попробуйте выбрать другую услугу или мастера."
+            )
+            keyboard = [
+                [InlineKeyboardButton("🎯 Выбрать услугу", callback_data='choose_service')],
+                [InlineKeyboardButton("♢ Выбрать мастера", callback_data='choose_specialist')],
+                [InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            try:
+                photo_data = await get_photo(photo_url)
+                if photo_data:
+                    media = InputMediaPhoto(media=photo_data, caption=message_text)
+                    sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
+                else:
                     await query.edit_message_text(text=message_text, reply_markup=reply_markup)
-                return
+            except Exception as e:
+                logger.error(f"Error in show_date_selection (no dates): {e}")
+                await query.edit_message_text(text=message_text, reply_markup=reply_markup)
+            return
+
+        if data['message'] == 'success':
+            # Показываем неделю, на которой найдено свободное время
+            start_of_week = datetime.strptime(data['weekStart'], '%Y-%m-%d').date()
+            end_of_week = start_of_week + timedelta(days=6)
 
         # Формируем сообщение с календарем
         message = f"🗓️ Выберите дату ({start_of_week.strftime('%d.%m')} - {end_of_week.strftime('%d.%m')}):\n\n"
@@ -835,11 +749,11 @@ async def show_date_selection(query, specialist_id, service_id, target_date_str=
         reply_markup = InlineKeyboardMarkup(keyboard)
 
         try:
-            photo_response = requests.get(photo_url)
-            if photo_response.status_code == 200:
-                photo_data = photo_response.content
+            photo_data = await get_photo(photo_url)
+            if photo_data:
                 media = InputMediaPhoto(media=photo_data, caption=message)
-                await query.edit_message_media(media=media, reply_markup=reply_markup)
+                sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                remember_photo(photo_url, sent_message)
             else:
                 await query.edit_message_text(text=message, reply_markup=reply_markup)
         except Exception as e:
@@ -858,7 +772,7 @@ async def show_date_selection(query, specialist_id, service_id, target_date_str=
 
 async def show_time_slots(query, date_str):
     """Показать доступное время на выбранную дату (только будущее время +2 часа)"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     user_id = query.from_user.id
     user_data = user_states.get(user_id, {})
     specialist_id = user_data.get('specialist_id')
@@ -874,80 +788,68 @@ async def show_time_slots(query, date_str):
         return
     
     try:
-        response = requests.get(
-            f"{API_BASE_URL}/api/specialist/{specialist_id}/service/{service_id}/schedule/{date_str}"
-        )
-        data = response.json()
+        # Свободные слоты мастера на услугу за дату из индекса в памяти
+        time_slots = await get_free_slots(date_str, date_str, specialist_id, service_id)
         
-        if data['message'] == 'success':
-            time_slots = data['data']
-            
-            # Фильтруем слоты: показываем только те, которые не прошли более чем на 2 часа
-            current_datetime = datetime.now()
-            filtered_slots = []
-            
-            for slot in time_slots:
-                slot_datetime_str = f"{date_str} {slot['время']}"
-                slot_datetime = datetime.strptime(slot_datetime_str, '%Y-%m-%d %H:%M')
-                
-                # Проверяем, что время не прошло более чем на 2 часа
-                time_difference = slot_datetime - current_datetime
-                if time_difference.total_seconds() > -7200:  # 7200 секунд = 2 часа
-                    filtered_slots.append(slot)
-            
-            if not filtered_slots:
-                message_text = "❌ Нет свободного времени на эту дату"
-                keyboard = [
-                    [InlineKeyboardButton("↲ Назад", callback_data=f'back_to_date_{date_str}')],
-                    [InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                try:
-                    # Пытаемся отправить как новое сообщение если редактирование не работает
-                    await query.message.reply_photo(
-                        photo=photo_url,
-                        caption=message_text,
-                        reply_markup=reply_markup
-                    )
-                    await query.delete_message()
-                except Exception as e:
-                    logger.error(f"Error in show_time_slots (no slots): {e}")
-                    await query.edit_message_text(text=message_text, reply_markup=reply_markup)
-                return
-            
-            keyboard = []
-            for slot in filtered_slots:
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f" {slot['время']}",
-                        callback_data=f'time_slot_{slot["id"]}'
-                    )
-                ])
-            
-            # Используем специальный callback для возврата к выбору даты
-            keyboard.append([InlineKeyboardButton("↲ Назад", callback_data=f'back_to_date_{date_str}')])
-            keyboard.append([InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            message_text = f"Доступное время на {datetime.strptime(date_str, '%Y-%m-%d').strftime('%d.%m.%Y')}:"
+        # Фильтруем слоты: показываем только те, которые не прошли более чем на 2 часа
+        current_datetime = datetime.now()
+        filtered_slots = []
+        
+        for slot in time_slots:
+            slot_datetime_str = f"{date_str} {slot['время']}"
+            slot_datetime = datetime.strptime(slot_datetime_str, '%Y-%m-%d %H:%M')
             
-            try:
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
-                    media = InputMediaPhoto(media=photo_data, caption=message_text)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
-                else:
-                    await query.edit_message_text(text=message_text, reply_markup=reply_markup)
-            except Exception as e:
-                logger.error(f"Error in show_time_slots: {e}")
-                await query.edit_message_text(text=message_text, reply_markup=reply_markup)
-        else:
-            message_text = "❌ Ошибка загрузки времени"
+            # Проверяем, что время не прошло более чем на 2 часа
+            time_difference = slot_datetime - current_datetime
+            if time_difference.total_seconds() > -7200:  # 7200 секунд = 2 часа
+                filtered_slots.append(slot)
+        
+        if not filtered_slots:
+            message_text = "❌ Нет свободного времени на эту дату"
             keyboard = [
                 [InlineKeyboardButton("↲ Назад", callback_data=f'back_to_date_{date_str}')],
                 [InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
+            try:
+                # Пытаемся отправить как новое сообщение если редактирование не работает
+                sent_message = await query.message.reply_photo(
+                    photo=await get_photo(photo_url),
+                    caption=message_text,
+                    reply_markup=reply_markup
+                )
+                remember_photo(photo_url, sent_message)
+                await query.delete_message()
+            except Exception as e:
+                logger.error(f"Error in show_time_slots (no slots): {e}")
+                await query.edit_message_text(text=message_text, reply_markup=reply_markup)
+            return
+        
+        keyboard = []
+        for slot in filtered_slots:
+            keyboard.append([
+                InlineKeyboardButton(
+                    f" {slot['время']}",
+                    callback_data=f'time_slot_{slot["id"]}'
+                )
+            ])
+        
+        # Используем специальный callback для возврата к выбору даты
+        keyboard.append([InlineKeyboardButton("↲ Назад", callback_data=f'back_to_date_{date_str}')])
+        keyboard.append([InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        message_text = f"Доступное время на {datetime.strptime(date_str, '%Y-%m-%d').strftime('%d.%m.%Y')}:"
+        
+        try:
+            photo_data = await get_photo(photo_url)
+            if photo_data:
+                media = InputMediaPhoto(media=photo_data, caption=message_text)
+                sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                remember_photo(photo_url, sent_message)
+            else:
+                await query.edit_message_text(text=message_text, reply_markup=reply_markup)
+        except Exception as e:
+            logger.error(f"Error in show_time_slots: {e}")
             await query.edit_message_text(text=message_text, reply_markup=reply_markup)
             
     except Exception as e:
@@ -969,8 +871,7 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # Получаем детали расписания
-        response = requests.get(f"{API_BASE_URL}/api/schedule/{schedule_id}")
-        data = response.json()
+        data = await api_get(f"/api/schedule/{schedule_id}")
         
         if data['message'] == 'success':
             schedule = data['data']
@@ -984,8 +885,7 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
             formatted_date = datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y')
             
             # Проверяем, зарегистрирован ли пользователь
-            client_response = requests.get(f"{API_BASE_URL}/api/client/by-tg/{user_id}")
-            client_data = client_response.json()
+            client_data = await api_get(f"/api/client/by-tg/{user_id}")
             
             if client_data['message'] == 'success' and client_data['data']:
                 # Пользователь авторизован
@@ -1009,13 +909,13 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 
-                photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+                photo_url = "/photo/images/zapis.jpg"
                 try:
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(photo_url)
+                    if photo_data:
                         media = InputMediaPhoto(media=photo_data, caption=message_text)
-                        await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        remember_photo(photo_url, sent_message)
                     else:
                         await query.edit_message_text(text=message_text, reply_markup=reply_markup)
                 except Exception as e:
@@ -1047,13 +947,13 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 
-                photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+                photo_url = "/photo/images/zapis.jpg"
                 try:
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(photo_url)
+                    if photo_data:
                         media = InputMediaPhoto(media=photo_data, caption=message_text)
-                        await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        remember_photo(photo_url, sent_message)
                     else:
                         await query.edit_message_text(text=message_text, reply_markup=reply_markup)
                 except Exception as e:
@@ -1089,7 +989,7 @@ async def show_week_schedule(query, target_date_str=None):
 
 async def show_all_specialists_schedule(query, service_id, target_date_str=None):
     """Показать расписание всех мастеров для услуги (только будущее время +2 часа)"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     
     try:
         today = datetime.now().date()
@@ -1120,13 +1020,8 @@ async def show_all_specialists_schedule(query, service_id, target_date_str=None)
         to_date_str = to_date.strftime('%Y-%m-%d')
         
         try:
-            response = requests.get(
-                f"{API_BASE_URL}/api/freetime-available?fromDate={from_date_str}&toDate={to_date_str}",
-                timeout=5
-            )
-            response.raise_for_status()
-            data = response.json()
-        except requests.exceptions.RequestException as e:
+            slots = await get_free_slots(from_date_str, to_date_str, service_id=service_id)
+        except Exception as e:
             logger.error(f"Error fetching schedule: {e}")
             message_text = "❌ Ошибка подключения к серверу"
             keyboard = [
@@ -1138,87 +1033,81 @@ async def show_all_specialists_schedule(query, service_id, target_date_str=None)
             return
         
         try:
-            service_response = requests.get(f"{API_BASE_URL}/api/service/{service_id}", timeout=5)
-            service_response.raise_for_status()
-            service_data = service_response.json()
+            service_data = await api_get(f"/api/service/{service_id}", timeout=5)
             service_name = service_data.get('data', {}).get('название', 'Услуга') if service_data.get('message') == 'success' else "Услуга"
-        except requests.exceptions.RequestException as e:
+        except ApiError as e:
             logger.error(f"Error fetching service name for service {service_id}: {e}")
             service_name = "Услуга"
         
         message = f"≣ Расписание для услуги '{service_name}' на неделю ({start_of_week.strftime('%d.%m')} - {end_of_week.strftime('%d.%m')}):\n\n"
         keyboard = []
         
-        if data.get('message') == 'success' and isinstance(data.get('data'), list):
-            # Фильтрация по service_id и времени
-            current_datetime = datetime.now()
-            schedule = []
-            
-            for item in data['data']:
-                if str(item.get('услуга_id')) == str(service_id):
-                    slot_datetime_str = f"{item['дата']} {item['время']}"
-                    try:
-                        slot_datetime = datetime.strptime(slot_datetime_str, '%Y-%m-%d %H:%M')
-                        # Проверяем, что время не прошло более чем на 2 часа
-                        time_difference = slot_datetime - current_datetime
-                        if time_difference.total_seconds() > -7200:  # 7200 секунд = 2 часа
-                            schedule.append(item)
-                    except ValueError:
-                        continue
-            
-            # Группировка расписания по датам
-            schedule_by_date = {}
-            for item in schedule:
-                date = item.get('дата')
-                if date and isinstance(date, str):
-                    if date not in schedule_by_date:
-                        schedule_by_date[date] = []
-                    schedule_by_date[date].append(item)
-            
-            # Формирование текста сообщения и кнопок
-            for date, items in sorted(schedule_by_date.items()):
+        # Фильтрация по service_id и времени
+        current_datetime = datetime.now()
+        schedule = []
+        
+        for item in slots:
+            if str(item.get('услуга_id')) == str(service_id):
+                slot_datetime_str = f"{item['дата']} {item['время']}"
                 try:
-                    formatted_date = datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m')
+                    slot_datetime = datetime.strptime(slot_datetime_str, '%Y-%m-%d %H:%M')
+                    # Проверяем, что время не прошло более чем на 2 часа
+                    time_difference = slot_datetime - current_datetime
+                    if time_difference.total_seconds() > -7200:  # 7200 секунд = 2 часа
+                        schedule.append(item)
                 except ValueError:
-                    logger.error(f"Invalid date format in schedule: {date}")
                     continue
-                message += f"📆 {formatted_date}:\n"
+        
+        # Группировка расписания по датам
+        schedule_by_date = {}
+        for item in schedule:
+            date = item.get('дата')
+            if date and isinstance(date, str):
+                if date not in schedule_by_date:
+                    schedule_by_date[date] = []
+                schedule_by_date[date].append(item)
+        
+        # Формирование текста сообщения и кнопок
+        for date, items in sorted(schedule_by_date.items()):
+            try:
+                formatted_date = datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m')
+            except ValueError:
+                logger.error(f"Invalid date format in schedule: {date}")
+                continue
+            message += f"📆 {formatted_date}:\n"
+            
+            for item in items:
+                time = item.get('время')
+                master_name = item.get('мастер_имя', 'Неизвестный мастер')
+                item_id = item.get('id')
+                service_name_item = item.get('услуга_название', 'Услуга')
                 
-                for item in items:
-                    time = item.get('время')
-                    master_name = item.get('мастер_имя', 'Неизвестный мастер')
-                    item_id = item.get('id')
-                    service_name_item = item.get('услуга_название', 'Услуга')
+                if time and item_id:
+                    message += f"    {time} - {master_name}\n"
                     
-                    if time and item_id:
-                        message += f"    {time} - {master_name}\n"
-                        
-                        # Создаем текст для кнопки с услугой
-                        button_text = f"{formatted_date} {time} - {master_name} - {service_name_item}"
-                        
-                        # Обрезаем длинные названия
+                    # Создаем текст для кнопки с услугой
+                    button_text = f"{formatted_date} {time} - {master_name} - {service_name_item}"
+                    
+                    # Обрезаем длинные названия
+                    if len(button_text) > 40:
+                        if len(master_name) > 12:
+                            master_short = master_name[:10] + "..."
+                            button_text = f"{formatted_date} {time} - {master_short} - {service_name_item}"
                         if len(button_text) > 40:
-                            if len(master_name) > 12:
-                                master_short = master_name[:10] + "..."
-                                button_text = f"{formatted_date} {time} - {master_short} - {service_name_item}"
-                            if len(button_text) > 40:
-                                service_short = service_name_item[:15] + "..." if len(service_name_item) > 15 else service_name_item
-                                button_text = f"{formatted_date} {time} - {master_name[:10]}... - {service_short}"
-                        
-                        keyboard.append([
-                            InlineKeyboardButton(
-                                button_text,
-                                callback_data=f'time_slot_{item_id}'
-                            )
-                        ])
-                
-                message += "\n"
+                            service_short = service_name_item[:15] + "..." if len(service_name_item) > 15 else service_name_item
+                            button_text = f"{formatted_date} {time} - {master_name[:10]}... - {service_short}"
+                    
+                    keyboard.append([
+                        InlineKeyboardButton(
+                            button_text,
+                            callback_data=f'time_slot_{item_id}'
+                        )
+                    ])
             
-            if not schedule:
-                message += "❌ Нет свободного времени на этой неделе для данной услуги\n"
-        else:
-            message += "❌ Ошибка загрузки расписания\n"
-            logger.error(f"Invalid API response for service {service_id}: {data}")
+            message += "\n"
+        
+        if not schedule:
+            message += "❌ Нет свободного времени на этой неделе для данной услуги\n"
         
         # Добавление кнопок навигации
         prev_week_start = start_of_week - timedelta(days=7)
@@ -1241,13 +1130,13 @@ async def show_all_specialists_schedule(query, service_id, target_date_str=None)
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         try:
-            photo_response = requests.get(photo_url, timeout=5)
-            if photo_response.status_code == 200:
-                photo_data = photo_response.content
+            photo_data = await get_photo(photo_url)
+            if photo_data:
                 media = InputMediaPhoto(media=photo_data, caption=message)
-                await query.edit_message_media(media=media, reply_markup=reply_markup)
+                sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                remember_photo(photo_url, sent_message)
             else:
-                logger.warning(f"Failed to download photo: {photo_response.status_code}")
+                logger.warning(f"Failed to download photo: {photo_url}")
                 await query.edit_message_text(text=message, reply_markup=reply_markup)
         except Exception as e:
             logger.error(f"Error sending message: {e}")
@@ -1273,15 +1162,13 @@ async def process_confirmed_appointment(update: Update, context: ContextTypes.DE
 
     try:
         # Получаем детали расписания
-        response = requests.get(f"{API_BASE_URL}/api/schedule/{schedule_id}")
-        data = response.json()
+        data = await api_get(f"/api/schedule/{schedule_id}")
         
         if data['message'] == 'success':
             schedule = data['data']
             
             # Получаем данные клиента
-            client_response = requests.get(f"{API_BASE_URL}/api/client/by-tg/{user_id}")
-            client_data = client_response.json()
+            client_data = await api_get(f"/api/client/by-tg/{user_id}")
             
             if client_data['message'] == 'success' and client_data['data']:
                 client = client_data['data']
@@ -1289,7 +1176,7 @@ async def process_confirmed_appointment(update: Update, context: ContextTypes.DE
                 phone = client['телефон']
                 
                 # Создаем запись
-                appointment_response = requests.post(f"{API_BASE_URL}/api/appointment", json={
+                appointment_response = await api_post("/api/appointment", json={
                     'specialistId': schedule['мастер_id'],
                     'serviceId': schedule['услуга_id'],
                     'date': schedule['дата'],
@@ -1298,13 +1185,14 @@ async def process_confirmed_appointment(update: Update, context: ContextTypes.DE
                     'clientPhone': phone
                 })
                 
-                if appointment_response.json().get('message') == 'success':
+                if appointment_response.get('message') == 'success':
                     # Обновляем расписание как недоступное
-                    requests.patch(f"{API_BASE_URL}/api/schedule/{schedule_id}", json={'доступно': 0})
+                    await api_patch(f"/api/schedule/{schedule_id}", json={'доступно': 0})
+                    mark_booked(schedule_id)
                     
                     # Обновляем tg_id клиента если его нет
                     if not client.get('tg_id'):
-                        requests.patch(f"{API_BASE_URL}/api/client/{client['id']}", json={
+                        await api_patch(f"/api/client/{client['id']}", json={
                             'tg_id': str(user_id)
                         })
                     
@@ -1327,13 +1215,13 @@ async def process_confirmed_appointment(update: Update, context: ContextTypes.DE
                     ]
                     reply_markup = InlineKeyboardMarkup(keyboard)
                     
-                    photo_url = f"{API_BASE_URL}/photo/images/pusto.jpg"
+                    photo_url = "/photo/images/pusto.jpg"
                     try:
-                        photo_response = requests.get(photo_url)
-                        if photo_response.status_code == 200:
-                            photo_data = photo_response.content
+                        photo_data = await get_photo(photo_url)
+                        if photo_data:
                             media = InputMediaPhoto(media=photo_data, caption=message_text)
-                            await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            remember_photo(photo_url, sent_message)
                         else:
                             await query.edit_message_text(text=message_text, reply_markup=reply_markup)
                     except Exception as e:
@@ -1366,7 +1254,7 @@ def validate_phone(phone):
 
 async def show_week_calendar(query, target_date_str=None):
     """Показать календарь на неделю для просмотра свободного времени"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     try:
         today = datetime.now().date()
         
@@ -1382,20 +1270,19 @@ async def show_week_calendar(query, target_date_str=None):
         from_date_str = start_of_week.strftime('%Y-%m-%d')
         to_date_str = end_of_week.strftime('%Y-%m-%d')
         
-        response = requests.get(f"{API_BASE_URL}/api/freetime-available?fromDate={from_date_str}&toDate={to_date_str}")
-        data = response.json()
+        slots = await get_free_slots(from_date_str, to_date_str)
         
         # Формируем сообщение с календарем
         message = f"🗓️ Календарь свободного времени\n({start_of_week.strftime('%d.%m')} - {end_of_week.strftime('%d.%m')})\n\n"
         
         keyboard = []
         
-        if data['message'] == 'success' and data['data']:
+        if slots:
             # Группируем слоты по датам
             schedule_by_date = {}
             current_datetime = datetime.now()
             
-            for item in data['data']:
+            for item in slots:
                 # Фильтруем прошедшее время (+2 часа)
                 slot_datetime_str = f"{item['дата']} {item['время']}"
                 try:
@@ -1456,11 +1343,11 @@ async def show_week_calendar(query, target_date_str=None):
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         try:
-            photo_response = requests.get(photo_url)
-            if photo_response.status_code == 200:
-                photo_data = photo_response.content
+            photo_data = await get_photo(photo_url)
+            if photo_data:
                 media = InputMediaPhoto(media=photo_data, caption=message)
-                await query.edit_message_media(media=media, reply_markup=reply_markup)
+                sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                remember_photo(photo_url, sent_message)
             else:
                 await query.edit_message_text(text=message, reply_markup=reply_markup)
         except Exception as e:
@@ -1479,11 +1366,10 @@ async def show_week_calendar(query, target_date_str=None):
 
 async def show_day_schedule(query, date_str):
     """Показать все свободное время на конкретный день"""
-    photo_url = f"{API_BASE_URL}/photo/images/zapis.jpg"
+    photo_url = "/photo/images/zapis.jpg"
     try:
         # Получаем все свободные слоты на выбранную дату
-        response = requests.get(f"{API_BASE_URL}/api/freetime-available?fromDate={date_str}&toDate={date_str}")
-        data = response.json()
+        slots = await get_free_slots(date_str, date_str)
         
         date_obj = datetime.strptime(date_str, '%Y-%m-%d')
         formatted_date = date_obj.strftime('%d.%m.%Y')
@@ -1493,12 +1379,12 @@ async def show_day_schedule(query, date_str):
         
         keyboard = []
         
-        if data['message'] == 'success' and data['data']:
+        if slots:
             # Фильтруем прошедшее время (+2 часа)
             current_datetime = datetime.now()
             available_slots = []
             
-            for item in data['data']:
+            for item in slots:
                 slot_datetime_str = f"{item['дата']} {item['время']}"
                 try:
                     slot_datetime = datetime.strptime(slot_datetime_str, '%Y-%m-%d %H:%M')
@@ -1566,11 +1452,11 @@ async def show_day_schedule(query, date_str):
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         try:
-            photo_response = requests.get(photo_url)
-            if photo_response.status_code == 200:
-                photo_data = photo_response.content
+            photo_data = await get_photo(photo_url)
+            if photo_data:
                 media = InputMediaPhoto(media=photo_data, caption=message)
-                await query.edit_message_media(media=media, reply_markup=reply_markup)
+                sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                remember_photo(photo_url, sent_message)
             else:
                 await query.edit_message_text(text=message, reply_markup=reply_markup)
         except Exception as e:
@@ -1622,29 +1508,28 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             try:
                 # Сначала проверяем есть ли клиент с таким телефоном
-                client_check_response = requests.get(f"{API_BASE_URL}/api/client/by-phone/{user_data['client_phone']}")
-                client_data = client_check_response.json()
+                client_data = await api_get(f"/api/client/by-phone/{user_data['client_phone']}")
                 
                 client_id = None
                 if client_data['message'] == 'success' and client_data['data']:
                     # Клиент существует - обновляем tg_id
                     client_id = client_data['data']['id']
-                    update_response = requests.patch(f"{API_BASE_URL}/api/client/{client_id}", json={
+                    update_response = await api_patch(f"/api/client/{client_id}", json={
                         'tg_id': str(user_id)
                     })
                 else:
                     # Создаем нового клиента с tg_id
-                    create_response = requests.post(f"{API_BASE_URL}/api/client", json={
+                    create_response = await api_post("/api/client", json={
                         'имя': user_data['client_name'],
                         'телефон': user_data['client_phone'],
                         'tg_id': str(user_id)
                     })
-                    if create_response.json()['message'] == 'success':
-                        client_id = create_response.json()['data']['id']
+                    if create_response['message'] == 'success':
+                        client_id = create_response['data']['id']
                 
                 if client_id:
                     # Создаем запись
-                    response = requests.post(f"{API_BASE_URL}/api/appointment", json={
+                    response = await api_post("/api/appointment", json={
                         'specialistId': user_data['specialist_id'],
                         'serviceId': user_data['service_id'],
                         'date': user_data['date'],
@@ -1653,7 +1538,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         'clientPhone': user_data['client_phone']
                     })
                     
-                    if response.json().get('message') == 'success':
+                    if response.get('message') == 'success':
                         keyboard = [
                             [InlineKeyboardButton("📋 Личный кабинет", callback_data='personal_cabinet')],
                             [InlineKeyboardButton("☰ Главное меню", callback_data='cancel_to_main')]
@@ -1669,9 +1554,10 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             reply_markup=reply_markup
                         )
                         
-                        requests.patch(f"{API_BASE_URL}/api/schedule/{user_data['schedule_id']}", json={
+                        await api_patch(f"/api/schedule/{user_data['schedule_id']}", json={
                             'доступно': 0
                         })
+                        mark_booked(user_data['schedule_id'])
                         
                     else:
                         await update.message.reply_text("❌ Ошибка при создании записи")
@@ -1709,6 +1595,53 @@ async def start_callback(query):
     update = Update(0, callback_query=query)
     await show_main_menu(update, None)
 
+class SalonApplication(Application):
+    """Application, в котором каждое обновление обрабатывается со своим кэшем запросов к API,
+    а состояния диалога пользователя читаются из хранилища до обработки и сохраняются после"""
+
+    async def process_update(self, update):
+        user = getattr(update, 'effective_user', None)
+        chat = getattr(update, 'effective_chat', None)
+        if chat is not None and chat.type == ChatType.PRIVATE and is_marked(chat.id):
+            # Пользователь написал боту - значит, разблокировал его: снова отправляем ему сообщения
+            await mark_alive(chat.id)
+        with update_memo():
+            if user is None:
+                await super().process_update(update)
+                return
+            await load_user_states(user.id)
+            try:
+                await super().process_update(update)
+            finally:
+                await save_user_states(user.id)
+
+async def post_init(application: Application):
+    """Предзагрузка справочных данных и индекса свободного времени, запуск уведомлений"""
+    await init_state_backend()
+    await warm_up()
+    try:
+        await load_availability()
+    except Exception as e:
+        logger.error(f"Ошибка загрузки индекса свободного времени: {e}")
+    await load_dead_chats()
+    await initialize_notifications(application)
+    await resume_saved_broadcast(application.bot)
+
+async def post_stop(application: Application):
+    """Остановка уведомлений и рассылки до закрытия соединений бота"""
+    await stop_broadcast()
+    await shutdown_notifications(application)
+
+async def post_shutdown(application: Application):
+    """Закрытие пула соединений с API при остановке бота"""
+    logger.info(f"Статистика кэша справочных данных: {get_cache_stats()}")
+    logger.info(f"Статистика запросов к API: {api_stats}")
+    logger.info(f"Статистика недоступных чатов: {dead_chat_stats}")
+    logger.info(f"Статистика состояний диалогов: {get_state_stats()}")
+    await close_state_backend()
+    await flush_registry()
+    await close_client()
+
 def main():
     """Запуск бота"""
     global bot
@@ -1716,7 +1649,7 @@ def main():
     print(f"DEBUG: Initializing bot with BOT_TOKEN = {bot_token}")
     if not bot_token:
         raise ValueError("BOT_TOKEN is not set or empty in main.py")
-    application = Application.builder().token(bot_token.strip()).build()  # Strip to remove any whitespace
+    application = Application.builder().token(bot_token.strip()).application_class(SalonApplication).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()  # Strip to remove any whitespace
     bot = application.bot  # Сохраняем экземпляр бота
     
     application.add_handler(CommandHandler("start", start))
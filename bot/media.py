@@ -0,0 +1,168 @@
+# media.py - реестр Telegram file_id для статичных фото (баннеры, фото мастеров и услуг)
+import os
+import json
+import time
+import asyncio
+import logging
+import httpx
+from telegram import Message
+from dotenv import load_dotenv
+from api_client import get_client, create_background_task, PHOTO_TIMEOUT
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Файл, в котором file_id переживают перезапуск бота
+MEDIA_CACHE_FILE = os.getenv('MEDIA_CACHE_FILE', 'media_cache.json')
+# Как часто (в секундах) сверять фото с сервером через ETag / Last-Modified
+MEDIA_REVALIDATE_SECONDS = int(os.getenv('MEDIA_REVALIDATE_SECONDS', '300'))
+# Через сколько секунд после изменения реестр записывается в файл (изменения за это время пишутся разом)
+MEDIA_SAVE_DELAY = float(os.getenv('MEDIA_SAVE_DELAY', '5'))
+
+# file_id действителен только для того бота, который загрузил фото
+BOT_ID = (os.getenv('BOT_TOKEN') or '').strip().split(':')[0]
+
+# path -> {'file_id', 'etag', 'last_modified', 'checked_at'}
+_registry = None
+# Отложенная запись реестра в файл
+_save_task = None
+
+
+def _load_registry():
+    """Загрузить реестр из файла"""
+    global _registry
+    _registry = {}
+    try:
+        with open(MEDIA_CACHE_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('bot_id') == BOT_ID:
+            _registry = data.get('photos', {})
+        else:
+            logger.info("Кэш file_id создан другим ботом, начинаем заново")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка чтения кэша file_id: {e}")
+    return _registry
+
+
+def _get_registry():
+    if _registry is None:
+        _load_registry()
+    return _registry
+
+
+def _write_registry(content):
+    """Записать реестр в файл (атомарно через временный файл)"""
+    tmp_file = f"{MEDIA_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_file, MEDIA_CACHE_FILE)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения кэша file_id: {e}")
+
+
+def _dump_registry():
+    # Снимок делается в event loop, чтобы реестр не менялся во время сериализации
+    return json.dumps({'bot_id': BOT_ID, 'photos': _get_registry()}, ensure_ascii=False, indent=2)
+
+
+async def _delayed_save():
+    global _save_task
+    try:
+        await asyncio.sleep(MEDIA_SAVE_DELAY)
+    finally:
+        _save_task = None
+    await asyncio.to_thread(_write_registry, _dump_registry())
+
+
+def _save_registry():
+    """Запланировать запись реестра: файл пишется в отдельном потоке не чаще раза в MEDIA_SAVE_DELAY"""
+    global _save_task
+    if _save_task is None:
+        _save_task = create_background_task(_delayed_save())
+
+
+async def flush_registry():
+    """Записать отложенные изменения реестра сразу (вызывается при остановке бота)"""
+    global _save_task
+    if _save_task is None:
+        return
+    _save_task.cancel()
+    try:
+        await _save_task
+    except asyncio.CancelledError:
+        pass
+    _save_task = None
+    await asyncio.to_thread(_write_registry, _dump_registry())
+
+
+def _validators(response):
+    return {
+        'etag': response.headers.get('etag'),
+        'last_modified': response.headers.get('last-modified')
+    }
+
+
+async def get_photo(path):
+    """Вернуть file_id фото, если оно уже загружено в Telegram, иначе байты с сервера.
+    Возвращает None, если фото недоступно."""
+    registry = _get_registry()
+    entry = registry.get(path)
+    now = time.time()
+
+    if entry and entry.get('file_id') and now - entry.get('checked_at', 0) < MEDIA_REVALIDATE_SECONDS:
+        return entry['file_id']
+
+    headers = {}
+    if entry and entry.get('file_id'):
+        # Условный запрос: сервер ответит 304, если файл не менялся
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    try:
+        response = await get_client().get(path, headers=headers, timeout=PHOTO_TIMEOUT)
+    except httpx.HTTPError as e:
+        logger.error(f"Ошибка загрузки фото {path}: {e}")
+        # Сервер недоступен - используем то, что уже есть
+        return entry.get('file_id') if entry else None
+
+    if response.status_code == 304 and entry:
+        # Время проверки в файл не пишем: после перезапуска фото просто проверится раньше
+        entry['checked_at'] = now
+        return entry['file_id']
+
+    if response.status_code != 200:
+        logger.warning(f"Фото {path} недоступно: HTTP {response.status_code}")
+        if entry:
+            del registry[path]
+            _save_registry()
+        return None
+
+    validators = _validators(response)
+    if entry and entry.get('file_id') and validators['etag'] and validators['etag'] == entry.get('etag'):
+        entry['checked_at'] = now
+        return entry['file_id']
+
+    # Фото новое или изменилось на сервере - file_id появится после отправки
+    if entry and entry.get('file_id'):
+        logger.info(f"Фото {path} изменилось на сервере, обновляем file_id")
+    registry[path] = {'file_id': None, 'checked_at': now, **validators}
+    _save_registry()
+    return response.content
+
+
+def remember_photo(path, message):
+    """Запомнить file_id фото из отправленного/отредактированного сообщения"""
+    if not isinstance(message, Message) or not message.photo:
+        return
+    registry = _get_registry()
+    entry = registry.setdefault(path, {'etag': None, 'last_modified': None, 'checked_at': time.time()})
+    if not entry.get('file_id'):
+        entry['file_id'] = message.photo[-1].file_id
+        _save_registry()
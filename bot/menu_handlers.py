@@ -1,7 +1,9 @@
 # menu_handlers.py
 import os
 import logging
-import requests
+from api_client import api_get, api_patch
+from media import get_photo, remember_photo
+from cache import get_cached, is_master as is_master_user
 from personal_cabinet import show_personal_cabinet, handle_personal_callback
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
@@ -28,10 +30,8 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Проверяем, является ли пользователь мастером
     is_master = False
     try:
-        response = requests.get(f"{API_BASE_URL}/api/specialists-all")
-        if response.json()['message'] == 'success':
-            masters = response.json()['data']
-            is_master = any(m.get('tg_id') == str(user_id) for m in masters)
+        # По команде (не по кнопке) перепроверяем: tg_id мог быть только что назначен мастеру
+        is_master = await is_master_user(user_id, refresh_if_missing=update.callback_query is None)
     except:
         pass
     
@@ -40,15 +40,15 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     site_link = None
     try:
         # Получаем название салона из таблицы страниц
-        pages_response = requests.get(f"{API_BASE_URL}/api/pages/главная")
-        if pages_response.json()['message'] == 'success':
-            pages_data = pages_response.json()['data']
+        pages_response = await get_cached("/api/pages/главная")
+        if pages_response['message'] == 'success':
+            pages_data = pages_response['data']
             salon_name = pages_data.get('название_салона')
         
         # Получаем ссылку на сайт
-        links_response = requests.get(f"{API_BASE_URL}/api/links")
-        if links_response.json()['message'] == 'success':
-            links = links_response.json()['data']
+        links_response = await get_cached("/api/links")
+        if links_response['message'] == 'success':
+            links = links_response['data']
             site_link = links.get('site_link')
     except Exception as e:
         logger.error(f"Error fetching salon data: {e}")
@@ -80,16 +80,16 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if site_link:
         message_text += f"\n\n○ Наш сайт: {site_link}"
     
-    photo_url = f"{API_BASE_URL}/photo/images/main.jpg"
+    photo_url = "/photo/images/main.jpg"
     
     if hasattr(update, 'callback_query') and update.callback_query:
         query = update.callback_query
         try:
-            photo_response = requests.get(photo_url)
-            if photo_response.status_code == 200:
-                photo_data = photo_response.content
+            photo_data = await get_photo(photo_url)
+            if photo_data:
                 media = InputMediaPhoto(media=photo_data, caption=message_text)
-                await query.edit_message_media(media=media, reply_markup=reply_markup)
+                sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                remember_photo(photo_url, sent_message)
             else:
                 await query.edit_message_text(text=message_text, reply_markup=reply_markup)
         except Exception as e:
@@ -97,14 +97,14 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(text=message_text, reply_markup=reply_markup)
     else:
         try:
-            photo_response = requests.get(photo_url)
-            if photo_response.status_code == 200:
-                photo_data = photo_response.content
-                await update.message.reply_photo(
+            photo_data = await get_photo(photo_url)
+            if photo_data:
+                sent_message = await update.message.reply_photo(
                     photo=photo_data,
                     caption=message_text,
                     reply_markup=reply_markup
                 )
+                remember_photo(photo_url, sent_message)
             else:
                 await update.message.reply_text(
                     text=message_text,
@@ -124,8 +124,7 @@ async def show_contacts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     try:
         # Получаем ссылки из базы данных
-        response = requests.get(f"{API_BASE_URL}/api/links")
-        data = response.json()
+        data = await get_cached("/api/links")
         
         if data['message'] == 'success':
             links = data['data']
@@ -175,27 +174,28 @@ async def show_contacts_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             # Используем фото для контактов
-            photo_url = f"{API_BASE_URL}/photo/images/contakts.jpg"
+            photo_url = "/photo/images/contakts.jpg"
             
             try:
                 # Скачиваем фото
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
+                photo_data = await get_photo(photo_url)
+                if photo_data:
                     
                     # Проверяем, есть ли фото в текущем сообщении
                     if query.message.photo:
                         # Если сообщение с фото, редактируем его
                         media = InputMediaPhoto(media=photo_data, caption=message)
-                        await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        remember_photo(photo_url, sent_message)
                     else:
                         # Если текстовое сообщение, редактируем текст и добавляем фото
-                        await query.message.reply_photo(
+                        sent_message = await query.message.reply_photo(
                             photo=photo_data,
                             caption=message,
                             reply_markup=reply_markup,
                             parse_mode='Markdown'  # Изменено с HTML на Markdown
                         )
+                        remember_photo(photo_url, sent_message)
                         await query.delete_message()
                 else:
                     # Если фото недоступно, редактируем текстовое сообщение
@@ -278,8 +278,7 @@ async def show_master_detail(update: Update, context: ContextTypes.DEFAULT_TYPE,
     """Показать детальную информацию о мастере"""
     query = update.callback_query
     try:
-        response = requests.get(f"{API_BASE_URL}/api/specialist/{master_id}")
-        data = response.json()
+        data = await api_get(f"/api/specialist/{master_id}")
         
         if data['message'] == 'success':
             master = data['data']
@@ -312,27 +311,28 @@ async def show_master_detail(update: Update, context: ContextTypes.DEFAULT_TYPE,
             if has_valid_photo:
                 try:
                     # Формируем полный URL к фото через API сервера
-                    photo_url = f"{API_BASE_URL}/{master_photo}"
+                    photo_url = f"/{master_photo}"
                     logger.info(f"Trying to edit with photo from URL: {photo_url}")
                     
                     # Скачиваем фото
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(photo_url)
+                    if photo_data:
                         # Проверяем, есть ли уже фото в сообщении
                         if query.message.photo:
                             media = InputMediaPhoto(media=photo_data, caption=message)
-                            await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            remember_photo(photo_url, sent_message)
                         else:
                             # Если сообщение без фото, отправляем новое сообщение с фото
-                            await query.message.reply_photo(
+                            sent_message = await query.message.reply_photo(
                                 photo=photo_data,
                                 caption=message,
                                 reply_markup=reply_markup
                             )
+                            remember_photo(photo_url, sent_message)
                             await query.delete_message()
                     else:
-                        logger.error(f"Failed to download photo: {photo_response.status_code}")
+                        logger.error(f"Failed to download photo: {photo_url}")
                         # Если фото не загрузилось, используем текстовое сообщение
                         await query.edit_message_text(text=message, reply_markup=reply_markup)
                 except Exception as photo_error:
@@ -342,24 +342,25 @@ async def show_master_detail(update: Update, context: ContextTypes.DEFAULT_TYPE,
             else:
                 # Используем фото по умолчанию для мастеров
                 try:
-                    default_photo_url = f"{API_BASE_URL}/photo/работники/default.jpg"
+                    default_photo_url = "/photo/работники/default.jpg"
                     logger.info(f"Using default master photo: {default_photo_url}")
                     
-                    photo_response = requests.get(default_photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(default_photo_url)
+                    if photo_data:
                         if query.message.photo:
                             media = InputMediaPhoto(media=photo_data, caption=message)
-                            await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            remember_photo(default_photo_url, sent_message)
                         else:
-                            await query.message.reply_photo(
+                            sent_message = await query.message.reply_photo(
                                 photo=photo_data,
                                 caption=message,
                                 reply_markup=reply_markup
                             )
+                            remember_photo(default_photo_url, sent_message)
                             await query.delete_message()
                     else:
-                        logger.error(f"Failed to download default photo: {photo_response.status_code}")
+                        logger.error(f"Failed to download default photo: {default_photo_url}")
                         await query.edit_message_text(text=message, reply_markup=reply_markup)
                 except Exception as default_photo_error:
                     logger.error(f"Error with default photo: {default_photo_error}")
@@ -389,10 +390,9 @@ async def show_master_detail(update: Update, context: ContextTypes.DEFAULT_TYPE,
 async def show_masters_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню мастеров"""
     query = update.callback_query
-    photo_url = f"{API_BASE_URL}/photo/images/master.jpg"
+    photo_url = "/photo/images/master.jpg"
     try:
-        response = requests.get(f"{API_BASE_URL}/api/specialists")
-        data = response.json()
+        data = await api_get("/api/specialists")
         
         if data['message'] == 'success':
             masters = data['data']
@@ -415,11 +415,11 @@ async def show_masters_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             try:
                 # Скачиваем фото
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
+                photo_data = await get_photo(photo_url)
+                if photo_data:
                     media = InputMediaPhoto(media=photo_data, caption=message_text)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
                 else:
                     await query.edit_message_text(text=message_text, reply_markup=reply_markup)
             except Exception as e:
@@ -441,10 +441,9 @@ async def show_masters_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_services_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню услуг"""
     query = update.callback_query
-    photo_url = f"{API_BASE_URL}/photo/images/services.jpg"
+    photo_url = "/photo/images/services.jpg"
     try:
-        response = requests.get(f"{API_BASE_URL}/api/services")
-        data = response.json()
+        data = await get_cached("/api/services")
         
         if data['message'] == 'success':
             services = data['data']
@@ -467,11 +466,11 @@ async def show_services_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
             try:
                 # Скачиваем фото
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
+                photo_data = await get_photo(photo_url)
+                if photo_data:
                     media = InputMediaPhoto(media=photo_data, caption=message_text)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    remember_photo(photo_url, sent_message)
                 else:
                     await query.edit_message_text(text=message_text, reply_markup=reply_markup)
             except Exception as e:
@@ -494,8 +493,7 @@ async def show_service_detail(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Показать детальную информацию об услуге"""
     query = update.callback_query
     try:
-        response = requests.get(f"{API_BASE_URL}/api/service/{service_id}")
-        data = response.json()
+        data = await api_get(f"/api/service/{service_id}")
         
         if data['message'] == 'success':
             service = data['data']
@@ -525,25 +523,26 @@ async def show_service_detail(update: Update, context: ContextTypes.DEFAULT_TYPE
             if has_valid_photo:
                 try:
                     # Формируем полный URL к фото через API сервера
-                    photo_url = f"{API_BASE_URL}/{service_photo}"
+                    photo_url = f"/{service_photo}"
                     logger.info(f"Trying to edit with service photo from URL: {photo_url}")
                     
                     # Скачиваем фото
-                    photo_response = requests.get(photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(photo_url)
+                    if photo_data:
                         if query.message.photo:
                             media = InputMediaPhoto(media=photo_data, caption=message)
-                            await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            remember_photo(photo_url, sent_message)
                         else:
-                            await query.message.reply_photo(
+                            sent_message = await query.message.reply_photo(
                                 photo=photo_data,
                                 caption=message,
                                 reply_markup=reply_markup
                             )
+                            remember_photo(photo_url, sent_message)
                             await query.delete_message()
                     else:
-                        logger.error(f"Failed to download service photo: {photo_response.status_code}")
+                        logger.error(f"Failed to download service photo: {photo_url}")
                         await query.edit_message_text(text=message, reply_markup=reply_markup)
                 except Exception as photo_error:
                     logger.error(f"Error editing with service photo: {photo_error}")
@@ -551,24 +550,25 @@ async def show_service_detail(update: Update, context: ContextTypes.DEFAULT_TYPE
             else:
                 # Используем фото по умолчанию для услуг
                 try:
-                    default_photo_url = f"{API_BASE_URL}/photo/услуги/default.jpg"
+                    default_photo_url = "/photo/услуги/default.jpg"
                     logger.info(f"Using default service photo: {default_photo_url}")
                     
-                    photo_response = requests.get(default_photo_url)
-                    if photo_response.status_code == 200:
-                        photo_data = photo_response.content
+                    photo_data = await get_photo(default_photo_url)
+                    if photo_data:
                         if query.message.photo:
                             media = InputMediaPhoto(media=photo_data, caption=message)
-                            await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                            remember_photo(default_photo_url, sent_message)
                         else:
-                            await query.message.reply_photo(
+                            sent_message = await query.message.reply_photo(
                                 photo=photo_data,
                                 caption=message,
                                 reply_markup=reply_markup
                             )
+                            remember_photo(default_photo_url, sent_message)
                             await query.delete_message()
                     else:
-                        logger.error(f"Failed to download default service photo: {photo_response.status_code}")
+                        logger.error(f"Failed to download default service photo: {default_photo_url}")
                         await query.edit_message_text(text=message, reply_markup=reply_markup)
                 except Exception as default_photo_error:
                     logger.error(f"Error with default service photo: {default_photo_error}")
@@ -647,17 +647,16 @@ async def logout_from_cabinet(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         # Получаем данные клиента для поиска ID
-        response = requests.get(f"{API_BASE_URL}/api/client/by-tg/{user_id}")
-        data = response.json()
+        data = await api_get(f"/api/client/by-tg/{user_id}")
 
         if data['message'] == 'success' and data['data']:
             client_data = data['data']
             client_id = client_data['id']
             
             # Сбрасываем tg_id в NULL
-            update_response = requests.patch(f"{API_BASE_URL}/api/client/{client_id}", json={'tg_id': None})
+            update_response = await api_patch(f"/api/client/{client_id}", json={'tg_id': None})
             
-            if update_response.json()['message'] == 'success':
+            if update_response['message'] == 'success':
                 message_text = "✅ Вы вышли из личного кабинета. Для доступа потребуется повторная регистрация."
                 
                 # Показываем главное меню
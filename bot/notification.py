@@ -1,9 +1,17 @@
 import os
 import logging
+import time
 import asyncio
-import requests
+from api_client import api_get, api_post
+from media import get_photo, remember_photo
+from cache import get_cached
+from delivery import send_limited, deliver
+import dead_chats
+from dead_chats import ChatUnavailable
+from reminders import ReminderScheduler
+import outbox
 from datetime import datetime, timedelta
-from telegram import Bot, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 import pytz
@@ -41,28 +49,41 @@ def get_moscow_datetime():
     """Возвращает datetime в московском времени"""
     return get_moscow_time()
 
+# Сколько уведомлений из локальной очереди отправляется за один проход
+OUTBOX_BATCH_SIZE = 100
+
+# Отметки об отправке копятся и уходят на сервер пачками
+ACK_BATCH_SIZE = int(os.getenv('NOTIFICATION_ACK_BATCH_SIZE', '50'))
+ACK_FLUSH_SECONDS = int(os.getenv('NOTIFICATION_ACK_FLUSH_SECONDS', '5'))
+
+# Как часто (в минутах) запасной обход ищет новые записи, не пришедшие событием
+NOTIFICATION_SWEEP_MINUTES = int(os.getenv('NOTIFICATION_SWEEP_MINUTES', '5'))
+# Как часто (в минутах) сверять расписание напоминаний за час с сервером
+REMINDER_RESYNC_MINUTES = int(os.getenv('REMINDER_RESYNC_MINUTES', '30'))
+# За сколько до записи отправляется напоминание
+HOURLY_REMINDER_LEAD = timedelta(hours=1)
+
+# Сколько секунд сервер держит long-poll запрос событий по записям
+APPOINTMENT_EVENTS_WAIT = int(os.getenv('APPOINTMENT_EVENTS_WAIT', '25'))
+
 # Глобальные переменные
 bot = None
 scheduler = None
-notification_loop = None
-
-def initialize_notifications():
-    """Инициализация системы уведомлений"""
-    global bot, scheduler, notification_loop
+events_task = None
+hourly_reminders = None
+outbox_task = None
+outbox_wakeup = None
+
+async def initialize_notifications(application):
+    """Инициализация системы уведомлений (вызывается из post_init приложения)"""
+    global bot, scheduler, events_task, hourly_reminders, outbox_task, outbox_wakeup
     
     try:
-        bot_token = os.getenv('BOT_TOKEN')
-        print(f"DEBUG: Initializing notifications with BOT_TOKEN = {bot_token}")
-        if not bot_token:
-            raise ValueError("BOT_TOKEN is not set or empty")
-        bot = Bot(token=bot_token.strip())
-        
-        # Создаем отдельный event loop для уведомлений
-        notification_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(notification_loop)
+        # Уведомления отправляет тот же бот и в том же event loop, что и обработчики
+        bot = application.bot
         
         # ИСПРАВЛЕНО: Указываем московский часовой пояс для планировщика
-        scheduler = AsyncIOScheduler(event_loop=notification_loop, timezone=TIMEZONE)
+        scheduler = AsyncIOScheduler(timezone=TIMEZONE)
         
         # ИСПРАВЛЕНО: Уведомления будут срабатывать в 18:00 по МОСКОВСКОМУ времени
         scheduler.add_job(
@@ -77,31 +98,49 @@ def initialize_notifications():
             id='daily_user_notifications'
         )
         
-        # Проверка уведомлений за час каждую минуту
+        # Отправка накопленных отметок об уведомлениях
         scheduler.add_job(
-            send_hourly_notifications,
+            flush_notification_acks,
             'interval',
-            minutes=1,
-            id='hourly_notifications_check'
+            seconds=ACK_FLUSH_SECONDS,
+            id='notification_acks_flush'
         )
         
-        # Проверка новых записей для клиентов каждую минуту
+        # Очистка локальной очереди от старых завершенных уведомлений
         scheduler.add_job(
-            check_new_appointments,
+            prune_outbox,
+            CronTrigger(hour=4, minute=0, timezone=TIMEZONE),
+            id='outbox_prune'
+        )
+        
+        # Запасной обход: новые записи (клиентам и мастерам), если событие с сервера не дошло
+        scheduler.add_job(
+            run_notification_sweep,
             'interval',
-            minutes=1,
-            id='new_appointments_check'
+            minutes=NOTIFICATION_SWEEP_MINUTES,
+            id='notification_sweep'
         )
         
-        # Проверка новых записей для мастеров каждую минуту
+        # Напоминания за час ставятся в точное время; сверка с сервером - сразу и периодически
+        hourly_reminders = ReminderScheduler(_fire_hourly_reminders)
+        hourly_reminders.start()
         scheduler.add_job(
-            check_new_master_appointments,
+            sync_hourly_reminders,
             'interval',
-            minutes=1,
-            id='new_master_appointments_check'
+            minutes=REMINDER_RESYNC_MINUTES,
+            next_run_time=get_moscow_time(),
+            id='hourly_reminders_sync'
         )
         
         scheduler.start()
+        
+        # Уведомления из локальной очереди (в том числе оставшиеся с прошлого запуска)
+        outbox_wakeup = asyncio.Event()
+        outbox_task = asyncio.create_task(run_outbox_dispatcher())
+        
+        # События о новых записях приходят с сервера сразу, обход выше - запасной путь
+        events_task = asyncio.create_task(consume_appointment_events())
+        
         current_time = get_moscow_time()
         logger.info(f"✅ Система уведомлений инициализирована. Московское время: {current_time}")
         
@@ -125,29 +164,33 @@ async def send_notification_with_photo(chat_id: int, message: str, is_client: bo
             ])
         
         # URL для получения фотографии
-        photo_url = f"{API_BASE_URL}/photo/images/notif.jpg"
+        photo_url = "/photo/images/notif.jpg"
         
         # Загружаем фотографию
-        photo_response = requests.get(photo_url)
-        if photo_response.status_code == 200:
-            photo_data = photo_response.content
-            await bot.send_photo(
+        photo_data = await get_photo(photo_url)
+        if photo_data:
+            sent_message = await send_limited(chat_id, lambda: bot.send_photo(
                 chat_id=chat_id, 
                 photo=photo_data, 
                 caption=message,
                 reply_markup=keyboard
-            )
+            ))
+            remember_photo(photo_url, sent_message)
             return True
         else:
             # Если фото не найдено, отправляем только текст с кнопками
-            await bot.send_message(
+            await send_limited(chat_id, lambda: bot.send_message(
                 chat_id=chat_id, 
                 text=message,
                 reply_markup=keyboard
-            )
+            ))
             logger.warning(f"Фото notif.jpg не найдено, отправлено текстовое уведомление")
-            return False
+            # Уведомление доставлено - иначе очередь отправила бы его повторно
+            return True
             
+    except ChatUnavailable:
+        # Бот заблокирован или чат удален - текстом тоже не отправить
+        return False
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления с фото: {e}")
         # В случае ошибки отправляем только текст с кнопками
@@ -162,11 +205,11 @@ async def send_notification_with_photo(chat_id: int, message: str, is_client: bo
                     [InlineKeyboardButton("☰ Главное меню", callback_data="back_to_main")]
                 ])
                 
-            await bot.send_message(
+            await send_limited(chat_id, lambda: bot.send_message(
                 chat_id=chat_id, 
                 text=message,
                 reply_markup=keyboard
-            )
+            ))
             return True
         except Exception as text_error:
             logger.error(f"Ошибка отправки текстового уведомления: {text_error}")
@@ -187,80 +230,20 @@ async def send_notification_without_photo(chat_id: int, message: str, is_client:
                 [InlineKeyboardButton("☰ Главное меню", callback_data="back_to_main")]
             ])
         
-        await bot.send_message(
+        await send_limited(chat_id, lambda: bot.send_message(
             chat_id=chat_id, 
             text=message,
             reply_markup=keyboard
-        )
+        ))
         return True
             
+    except ChatUnavailable:
+        return False
     except Exception as e:
         logger.error(f"Ошибка отправки текстового уведомления: {e}")
         return False 
 
 
-async def check_new_master_appointments():
-    """Проверка новых записей для уведомления мастеров (только созданные сегодня)"""
-    try:
-        current_time = get_moscow_time()
-        logger.info(f"🔄 Проверка новых записей для уведомления мастеров. Московское время: {current_time}")
-        
-        # ИСПРАВЛЕНО: Получаем записи, созданные сегодня по московскому времени
-        today_date = get_moscow_date().strftime('%Y-%m-%d')
-        
-        response = requests.get(
-            f"{API_BASE_URL}/api/appointments",
-            params={'startDate': today_date, 'endDate': today_date}
-        )
-        
-        if response.status_code != 200 or response.json().get('message') != 'success':
-            logger.error(f"Ошибка API appointments: {response.status_code} - {response.text}")
-            return
-            
-        appointments = response.json().get('data', [])
-        
-        # Фильтруем только записи, созданные сегодня (по дате создания)
-        today_appointments = []
-        for appointment in appointments:
-            created_at = appointment.get('created_at', '')
-            if created_at.startswith(today_date):
-                today_appointments.append(appointment)
-        
-        new_master_notifications_sent = 0
-        
-        for appointment in today_appointments:
-            try:
-                # Проверяем, отправлено ли уже masternew уведомление
-                check_notification_response = requests.get(
-                    f"{API_BASE_URL}/api/check-notification",
-                    params={
-                        'запись_id': appointment['id'],
-                        'тип': 'masternew'
-                    }
-                )
-                
-                # Если уведомление еще не отправлено
-                should_send = True
-                if (check_notification_response.status_code == 200 and 
-                    check_notification_response.json().get('message') == 'success' and 
-                    check_notification_response.json().get('sent', False)):
-                    should_send = False
-                    logger.info(f"Уведомление masternew для записи {appointment['id']} уже отправлено")
-                
-                if should_send and appointment.get('мастер_tg_id'):
-                    await send_master_new_appointment_notification(appointment)
-                    new_master_notifications_sent += 1
-                    await asyncio.sleep(0.5)
-                    
-            except Exception as e:
-                logger.error(f"Ошибка обработки новой записи для мастера {appointment.get('id')}: {e}")
-                continue
-                
-        logger.info(f"✅ Отправлено {new_master_notifications_sent} уведомлений мастерам о новых записях (сегодня)")
-        
-    except Exception as e:
-        logger.error(f"Ошибка проверки новых записей для мастеров: {e}")
-
 async def send_master_new_appointment_notification(appointment):
     """Отправка уведомления о новой записи мастеру"""
     try:
@@ -287,19 +270,12 @@ async def send_master_new_appointment_notification(appointment):
         )
         
         if success:
-            # Отмечаем уведомление как отправленное
-            mark_response = requests.post(f"{API_BASE_URL}/api/notification-sent", json={
-                'запись_id': appointment['id'],
-                'тип': 'masternew'
-            })
-            
-            if mark_response.status_code == 200 and mark_response.json().get('message') == 'success':
-                logger.info(f"✅ Отправлено уведомление о новой записи мастеру {appointment['мастер_tg_id']}")
-            else:
-                logger.error(f"❌ Ошибка отметки уведомления как отправленного: {mark_response.text}")
+            logger.info(f"✅ Отправлено уведомление о новой записи мастеру {appointment['мастер_tg_id']}")
+        return success
         
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления о новой записи мастеру: {e}")
+        return False
 
 async def send_daily_user_notifications():
     """Упрощенная версия отправки ежедневных уведомлений пользователям"""
@@ -308,33 +284,21 @@ async def send_daily_user_notifications():
         logger.info(f"🔄 Проверка ежедневных уведомлений пользователям. Московское время: {current_time}")
         
         # Используем новый упрощенный endpoint
-        response = requests.get(f"{API_BASE_URL}/api/appointments-for-daily-simple")
+        result = await api_get("/api/appointments-for-daily-simple")
         
-        if response.status_code != 200:
-            logger.error(f"Ошибка API: {response.status_code} - {response.text}")
-            return
-            
-        result = response.json()
         if result.get('message') != 'success':
             logger.error(f"Ошибка в ответе API: {result}")
             return
             
         appointments = result.get('data', [])
         
-        daily_notifications_sent = 0
-        
-        for appointment in appointments:
-            try:
-                await send_user_daily_notification(appointment)
-                daily_notifications_sent += 1
-                await asyncio.sleep(0.5)
-                    
-            except Exception as e:
-                logger.error(f"Ошибка обработки записи {appointment.get('id')}: {e}")
-                continue
+        # Уведомления уходят через локальную очередь, повторно одно и то же не ставится
+        daily_notifications_queued = sum(
+            enqueue_notification(appointment, 'daily') for appointment in appointments
+        )
                 
-        if daily_notifications_sent > 0:
-            logger.info(f"✅ Отправлено {daily_notifications_sent} ежедневных уведомлений пользователям")
+        if daily_notifications_queued > 0:
+            logger.info(f"✅ В очередь поставлено {daily_notifications_queued} ежедневных уведомлений пользователям")
         else:
             logger.info("ℹ️ Не найдено записей для daily уведомлений")
         
@@ -342,17 +306,40 @@ async def send_daily_user_notifications():
         logger.error(f"Ошибка отправки ежедневных уведомлений: {e}")
 
 
-def get_salon_phone():
+_flush_lock = asyncio.Lock()
+
+
+async def flush_notification_acks():
+    """Отправить отметки об отправленных уведомлениях пачками (одна транзакция на сервере на пачку)"""
+    async with _flush_lock:
+        while True:
+            batch = outbox.unacked(ACK_BATCH_SIZE)
+            if not batch:
+                return
+            try:
+                response = await api_post("/api/notifications-sent", json={
+                    'items': [{'запись_id': appointment_id, 'тип': notification_type}
+                              for appointment_id, notification_type in batch]
+                })
+            except Exception as e:
+                logger.error(f"Ошибка отправки отметок уведомлений: {e}")
+                return
+            if response.get('message') != 'success':
+                # Отметки остаются в очереди - повторим при следующем сбросе
+                logger.error(f"❌ Ошибка пакетной отметки уведомлений: {response}")
+                return
+            outbox.mark_acked(batch)
+
+
+async def get_salon_phone():
     """Получить номер телефона салона из базы данных"""
     try:
-        response = requests.get(f"{API_BASE_URL}/api/links")
-        if response.status_code == 200:
-            data = response.json()
-            if data.get('message') == 'success':
-                phone = data.get('data', {}).get('phone_contact')
-                if phone:
-                    # Форматируем номер для красивого отображения
-                    return format_phone_number(phone)
+        data = await get_cached("/api/links")
+        if data.get('message') == 'success':
+            phone = data.get('data', {}).get('phone_contact')
+            if phone:
+                # Форматируем номер для красивого отображения
+                return format_phone_number(phone)
         return "+7 (XXX) XXX-XX-XX"  # Запасной вариант
     except Exception as e:
         logger.error(f"Ошибка получения телефона салона: {e}")
@@ -382,7 +369,7 @@ def format_phone_number(phone):
 async def send_user_daily_notification(appointment):
     """Отправка ежедневного уведомления пользователю"""
     try:
-        salon_phone = get_salon_phone()
+        salon_phone = await get_salon_phone()
         
         # Форматируем дату в понятный формат
         appointment_date = datetime.strptime(appointment['дата'], '%Y-%m-%d')
@@ -409,69 +396,22 @@ async def send_user_daily_notification(appointment):
         )
         
         if success:
-            # Отмечаем уведомление как отправленное
-            mark_response = requests.post(f"{API_BASE_URL}/api/notification-sent", json={
-                'запись_id': appointment['id'],
-                'тип': 'daily'
-            })
-            
-            if mark_response.status_code == 200 and mark_response.json().get('message') == 'success':
-                logger.info(f"✅ Отправлено daily уведомление клиенту {appointment['клиент_tg_id']} для записи {appointment['id']}")
-            else:
-                logger.error(f"❌ Ошибка отметки daily уведомления: {mark_response.text}")
+            logger.info(f"✅ Отправлено daily уведомление клиенту {appointment['клиент_tg_id']} для записи {appointment['id']}")
         else:
             logger.error(f"❌ Не удалось отправить daily уведомление клиенту {appointment['клиент_tg_id']}")
+        return success
         
     except Exception as e:
         logger.error(f"Ошибка отправки daily уведомления: {e}")
+        return False
 
 
 
 
-async def send_hourly_notifications():
-    """Упрощенная версия отправки уведомлений за час до записи"""
-    try:
-        current_time = get_moscow_time()
-        logger.info(f"🔄 Проверка уведомлений за час до записи. Московское время: {current_time}")
-        
-        # Используем новый упрощенный endpoint
-        response = requests.get(f"{API_BASE_URL}/api/appointments-for-hourly-simple")
-        
-        if response.status_code != 200:
-            logger.error(f"Ошибка API: {response.status_code} - {response.text}")
-            return
-            
-        result = response.json()
-        if result.get('message') != 'success':
-            logger.error(f"Ошибка в ответе API: {result}")
-            return
-            
-        appointments = result.get('data', [])
-        
-        hourly_notifications_sent = 0
-        
-        for appointment in appointments:
-            try:
-                await send_user_hourly_notification(appointment)
-                hourly_notifications_sent += 1
-                await asyncio.sleep(0.5)
-                    
-            except Exception as e:
-                logger.error(f"Ошибка обработки записи {appointment.get('id')}: {e}")
-                continue
-                
-        if hourly_notifications_sent > 0:
-            logger.info(f"✅ Отправлено {hourly_notifications_sent} уведомлений за час до записи")
-        else:
-            logger.info("ℹ️ Не найдено записей для hourly уведомлений")
-        
-    except Exception as e:
-        logger.error(f"Ошибка отправки уведомлений за час до записи: {e}")
-
 async def send_user_hourly_notification(appointment):
     """Отправка уведомления пользователю за час до записи"""
     try:
-        salon_phone = get_salon_phone()
+        salon_phone = await get_salon_phone()
         
         # Форматируем дату в понятный формат
         appointment_date = datetime.strptime(appointment['дата'], '%Y-%m-%d')
@@ -495,23 +435,46 @@ async def send_user_hourly_notification(appointment):
         )
         
         if success:
-            # Отмечаем уведомление как отправленное
-            mark_response = requests.post(f"{API_BASE_URL}/api/notification-sent", json={
-                'запись_id': appointment['id'],
-                'тип': 'hourly'
-            })
-            
-            if mark_response.status_code == 200 and mark_response.json().get('message') == 'success':
-                logger.info(f"✅ Отправлено hourly уведомление клиенту {appointment['клиент_tg_id']} для записи {appointment['id']}")
-            else:
-                logger.error(f"❌ Ошибка отметки hourly уведомления: {mark_response.text}")
+            logger.info(f"✅ Отправлено hourly уведомление клиенту {appointment['клиент_tg_id']} для записи {appointment['id']}")
         else:
             logger.error(f"❌ Не удалось отправить hourly уведомление клиенту {appointment['клиент_tg_id']}")
+        return success
         
     except Exception as e:
         logger.error(f"Ошибка отправки hourly уведомления: {e}")
+        return False
+
+
 
 
+def format_master_digest(date, appointments):
+    """Сообщение мастеру со списком его записей на дату"""
+    message = f"≣ Ваши записи на завтра ({date}):\n\n"
+    
+    # Сортируем записи по времени
+    for app in sorted(appointments, key=lambda x: x['время']):
+        message += (
+            f"⏰ {app['время']}\n"
+            f"👤 {app['клиент_имя']} ({app['клиент_телефон']})\n"
+            f"🎯 {app['услуга_название']}\n"
+            f"💵 {app['цена']}₽\n"
+            f"────────────────\n"
+        )
+    return message
+
+
+async def send_master_digest(digest):
+    """Отправить мастеру сообщение с записями на завтра"""
+    master, message = digest
+    # Используем функцию с фото для мастеров, is_client=False
+    success = await send_notification_with_photo(
+        chat_id=master['tg_id'], 
+        message=message,
+        is_client=False
+    )
+    if success:
+        logger.info(f"✅ Отправлено ежедневное уведомление мастеру {master['id']}")
+    return success
 
 
 async def send_daily_master_notifications():
@@ -523,71 +486,22 @@ async def send_daily_master_notifications():
         # ИСПРАВЛЕНО: Получаем завтрашнюю дату по московскому времени
         tomorrow = (get_moscow_date() + timedelta(days=1)).strftime('%Y-%m-%d')
         
-        # Получаем всех мастеров
-        response = requests.get(f"{API_BASE_URL}/api/specialists-all")
-        if response.json().get('message') != 'success':
-            logger.error(f"Ошибка API specialists-all: {response.json()}")
+        # Все записи на завтра одним запросом, уже сгруппированные по мастерам с tg_id
+        response = await api_get("/api/appointments-by-master", params={'date': tomorrow})
+        if response.get('message') != 'success':
+            logger.error(f"Ошибка API appointments-by-master: {response}")
             return
-            
-        masters = response.json().get('data', [])
         
-        master_notifications_sent = 0
+        # Собираем сообщения всем мастерам, затем отправляем их через общий конвейер
+        digests = [
+            ({'id': group['мастер_id'], 'tg_id': group['мастер_tg_id']},
+             format_master_digest(tomorrow, group['записи']))
+            for group in response.get('data', [])
+            if group['записи']
+        ]
         
-        for master in masters:
-            if master.get('tg_id'):
-                try:
-                    # Получаем записи мастера на завтра
-                    appointments_response = requests.get(
-                        f"{API_BASE_URL}/api/appointments",
-                        params={
-                            'specialistId': master['id'],
-                            'startDate': tomorrow,
-                            'endDate': tomorrow
-                        }
-                    )
-                    
-                    if appointments_response.json().get('message') != 'success':
-                        logger.error(f"Ошибка получения записей для мастера {master['id']}")
-                        continue
-                    
-                    appointments = appointments_response.json().get('data', [])
-                    
-                    # ЕСЛИ НЕТ ЗАПИСЕЙ - ПРОПУСТИТЬ ЭТОГО МАСТЕРА
-                    if not appointments:
-                        logger.info(f"ℹ️ У мастера {master['id']} нет записей на завтра, уведомление не отправляется")
-                        continue
-                    
-                    # Есть записи - формируем сообщение
-                    message = f"≣ Ваши записи на завтра ({tomorrow}):\n\n"
-                    
-                    # Сортируем записи по времени
-                    appointments.sort(key=lambda x: x['время'])
-                    
-                    for app in appointments:
-                        message += (
-                            f"⏰ {app['время']}\n"
-                            f"👤 {app['клиент_имя']} ({app['клиент_телефон']})\n"
-                            f"🎯 {app['услуга_название']}\n"
-                            f"💵 {app['цена']}₽\n"
-                            f"────────────────\n"
-                        )
-                    
-                    # Используем функцию с фото для мастеров, is_client=False
-                    success = await send_notification_with_photo(
-                        chat_id=master['tg_id'], 
-                        message=message,
-                        is_client=False
-                    )
-                    
-                    if success:
-                        master_notifications_sent += 1
-                        logger.info(f"✅ Отправлено ежедневное уведомление мастеру {master['id']}")
-                    
-                    await asyncio.sleep(0.5)
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка отправки уведомления мастеру {master.get('id')}: {e}")
-                    continue
+        report = await deliver("ежедневные уведомления мастерам", digests, send_master_digest)
+        master_notifications_sent = report['sent']
                 
         if master_notifications_sent > 0:
             logger.info(f"✅ Отправлено {master_notifications_sent} ежедневных уведомлений мастерам")
@@ -600,8 +514,8 @@ async def send_daily_master_notifications():
 async def send_master_daily_notification(master_id, tg_id, date):
     """Отправка уведомления конкретному мастеру о записях на указанную дату"""
     try:
-        response = requests.get(
-            f"{API_BASE_URL}/api/appointments",
+        response = await api_get(
+            "/api/appointments",
             params={
                 'specialistId': master_id,
                 'startDate': date,
@@ -609,11 +523,11 @@ async def send_master_daily_notification(master_id, tg_id, date):
             }
         )
         
-        if response.json()['message'] != 'success':
-            logger.error(f"Ошибка API appointments для мастера {master_id}: {response.json()}")
+        if response['message'] != 'success':
+            logger.error(f"Ошибка API appointments для мастера {master_id}: {response}")
             return
             
-        appointments = response.json()['data']
+        appointments = response['data']
         
         if not appointments:
             message = f"≣ На {datetime.strptime(date, '%Y-%m-%d').strftime('%d.%m.%Y')} у вас нет записей"
@@ -641,72 +555,10 @@ async def send_master_daily_notification(master_id, tg_id, date):
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления мастеру {master_id}: {e}")
 
-async def check_new_appointments():
-    """Проверка новых записей для уведомления клиентов (только созданные сегодня)"""
-    try:
-        current_time = get_moscow_time()
-        logger.info(f"🔄 Проверка новых записей для уведомления клиентов. Московское время: {current_time}")
-        
-        # ИСПРАВЛЕНО: Получаем записи, созданные сегодня по московскому времени
-        today_date = get_moscow_date().strftime('%Y-%m-%d')
-        
-        response = requests.get(
-            f"{API_BASE_URL}/api/appointments",
-            params={'startDate': today_date, 'endDate': today_date}
-        )
-        
-        if response.status_code != 200 or response.json().get('message') != 'success':
-            logger.error(f"Ошибка API appointments: {response.status_code} - {response.text}")
-            return
-            
-        appointments = response.json().get('data', [])
-        
-        # Фильтруем только записи, созданные сегодня (по дате создания)
-        today_appointments = []
-        for appointment in appointments:
-            created_at = appointment.get('created_at', '')
-            if created_at.startswith(today_date):
-                today_appointments.append(appointment)
-        
-        new_client_notifications_sent = 0
-        
-        for appointment in today_appointments:
-            try:
-                # Проверяем, отправлено ли уже immediate уведомление клиенту
-                check_notification_response = requests.get(
-                    f"{API_BASE_URL}/api/check-notification",
-                    params={
-                        'запись_id': appointment['id'],
-                        'тип': 'immediate'
-                    }
-                )
-                
-                # Если уведомление еще не отправлено
-                should_send = True
-                if (check_notification_response.status_code == 200 and 
-                    check_notification_response.json().get('message') == 'success' and 
-                    check_notification_response.json().get('sent', False)):
-                    should_send = False
-                    logger.info(f"Уведомление immediate для записи {appointment['id']} уже отправлено")
-                
-                if should_send and appointment.get('клиент_tg_id'):
-                    await send_immediate_client_notification(appointment)
-                    new_client_notifications_sent += 1
-                    await asyncio.sleep(0.5)
-                    
-            except Exception as e:
-                logger.error(f"Ошибка обработки новой записи для клиента {appointment.get('id')}: {e}")
-                continue
-                
-        logger.info(f"✅ Отправлено {new_client_notifications_sent} уведомлений клиентам о новых записях (сегодня)")
-        
-    except Exception as e:
-        logger.error(f"Ошибка проверки новых записей для клиентов: {e}")
-
 async def send_immediate_client_notification(appointment):
     """Немедленная отправка уведомления клиенту о successful записи"""
     try:
-        salon_phone = get_salon_phone()
+        salon_phone = await get_salon_phone()
         
         # Форматируем дату в понятный формат
         appointment_date = datetime.strptime(appointment['дата'], '%Y-%m-%d')
@@ -734,35 +586,323 @@ async def send_immediate_client_notification(appointment):
         )
             
         if success:
-            # Отмечаем уведомление как отправленное
-            mark_response = requests.post(f"{API_BASE_URL}/api/notification-sent", json={
-                'запись_id': appointment['id'],
-                'тип': 'immediate'
-            })
-            
-            if mark_response.status_code == 200 and mark_response.json().get('message') == 'success':
-                logger.info(f"✅ Отправлено немедленное уведомление клиенту {appointment['клиент_tg_id']} с кнопкой личного кабинета")
-            else:
-                logger.error(f"❌ Ошибка отметки immediate уведомления: {mark_response.text}")
+            logger.info(f"✅ Отправлено немедленное уведомление клиенту {appointment['клиент_tg_id']} с кнопкой личного кабинета")
+        return success
         
     except Exception as e:
         logger.error(f"Ошибка отправки немедленного уведомления клиенту: {e}")
+        return False
+
+def _is_created_today(appointment, now):
+    return appointment.get('created_at', '').startswith(now.strftime('%Y-%m-%d'))
+
+
+def _is_new_for_client(appointment, now):
+    """Запись создана сегодня - клиенту отправляется подтверждение"""
+    return bool(appointment.get('клиент_tg_id')) and _is_created_today(appointment, now)
+
+
+def _is_new_for_master(appointment, now):
+    """Запись создана сегодня - мастеру отправляется уведомление о новой записи"""
+    return bool(appointment.get('мастер_tg_id')) and _is_created_today(appointment, now)
+
+
+# Имя курсора запасного обхода в локальной очереди
+SWEEP_CURSOR = 'notification_sweep'
+
+# Типы уведомлений общего обхода: тип -> (условие отправки, функция отправки)
+SWEEP_NOTIFICATIONS = {
+    'immediate': (_is_new_for_client, send_immediate_client_notification),
+    'masternew': (_is_new_for_master, send_master_new_appointment_notification),
+}
+
+
+def _appointment_timestamp(appointment):
+    appointment_time = TIMEZONE.localize(
+        datetime.strptime(f"{appointment['дата']} {appointment['время'][:5]}", '%Y-%m-%d %H:%M')
+    )
+    return appointment_time.timestamp()
+
+
+def schedule_hourly_reminder(appointment):
+    """Поставить (или перенести) напоминание за час для записи; прошедшие записи снимаются"""
+    if hourly_reminders is None:
+        return
+    appointment_at = _appointment_timestamp(appointment)
+    now = time.time()
+    if not appointment.get('клиент_tg_id') or appointment_at <= now:
+        hourly_reminders.cancel(appointment['id'])
+        return
+    # Запись создана меньше чем за час - напоминание уходит сразу
+    fire_at = max(now, appointment_at - HOURLY_REMINDER_LEAD.total_seconds())
+    hourly_reminders.schedule(appointment['id'], fire_at, appointment)
+
+
+async def _fire_hourly_reminders(appointments):
+    """Наступило время напоминаний - ставим их в очередь отправки (после начала записи они уже не нужны)"""
+    for appointment in appointments:
+        enqueue_notification(appointment, 'hourly', expires_at=_appointment_timestamp(appointment))
+
+
+async def sync_hourly_reminders():
+    """Сверить расписание напоминаний с сервером: записи на сегодня и завтра без отправленного hourly"""
+    try:
+        if hourly_reminders is None:
+            return
+        await flush_notification_acks()
+        today = get_moscow_date()
+        known_before = hourly_reminders.scheduled_ids()
+
+        response = await api_get(
+            "/api/appointments-without-notification",
+            params={
+                'тип': 'hourly',
+                'startDate': today.strftime('%Y-%m-%d'),
+                'endDate': (today + timedelta(days=1)).strftime('%Y-%m-%d')
+            }
+        )
+        if response.get('message') != 'success':
+            logger.error(f"Ошибка API appointments-without-notification: {response}")
+            return
+
+        pending = response.get('data', [])
+        for appointment in pending:
+            schedule_hourly_reminder(appointment)
+
+        # Записи, пропавшие из выборки (удалены или уже напомнены), снимаем.
+        # Поставленные по событиям во время запроса не трогаем
+        pending_ids = {appointment['id'] for appointment in pending}
+        for appointment_id in known_before - pending_ids:
+            hourly_reminders.cancel(appointment_id)
+
+        logger.info(f"⏰ Запланировано напоминаний за час: {len(hourly_reminders)}")
+
+    except Exception as e:
+        logger.error(f"Ошибка сверки напоминаний за час: {e}")
+
+
+# Функции отправки уведомлений из очереди по типам
+NOTIFICATION_SENDERS = {
+    'immediate': send_immediate_client_notification,
+    'masternew': send_master_new_appointment_notification,
+    'hourly': send_user_hourly_notification,
+    'daily': send_user_daily_notification,
+}
+
+
+def enqueue_notification(appointment, notification_type, expires_at=None):
+    """Поставить уведомление в локальную очередь. Возвращает False, если оно уже было поставлено"""
+    if outbox.enqueue(appointment, notification_type, expires_at):
+        if outbox_wakeup is not None:
+            outbox_wakeup.set()
+        return True
+    return False
+
+
+def _notification_chat(item):
+    """Чат получателя уведомления: мастеру - о новой записи, остальные - клиенту"""
+    field = 'мастер_tg_id' if item['тип'] == 'masternew' else 'клиент_tg_id'
+    return item['appointment'].get(field)
+
+
+async def _deliver_outbox_item(item):
+    """Отправить одно уведомление из очереди; при неудаче - повтор с экспоненциальной паузой"""
+    chat_id = _notification_chat(item)
+    if chat_id and dead_chats.is_dead(chat_id):
+        # В недоступный чат не отправляем и не повторяем
+        dead_chats.dead_chat_stats['skipped'] += 1
+        outbox.cancel(item['запись_id'], item['тип'])
+        return False
+
+    try:
+        success = await NOTIFICATION_SENDERS[item['тип']](item['appointment'])
+        error = None
+    except Exception as e:
+        success = False
+        error = str(e)
+
+    if success:
+        outbox.mark_sent(item['запись_id'], item['тип'])
+        return True
+
+    if chat_id and dead_chats.is_dead(chat_id):
+        outbox.cancel(item['запись_id'], item['тип'])
+        return False
+
+    status = outbox.mark_failed(item['запись_id'], item['тип'], item['attempts'], error)
+    if status == 'failed':
+        logger.error(f"❌ Уведомление {item['тип']} для записи {item['запись_id']} не отправлено после {outbox.MAX_ATTEMPTS} попыток")
+    return False
+
+
+async def run_outbox_dispatcher():
+    """Отправлять уведомления из локальной очереди, как только подходит их время"""
+    while True:
+        try:
+            outbox_wakeup.clear()
+            items = outbox.due(OUTBOX_BATCH_SIZE)
+            if items:
+                await deliver("очередь уведомлений", items, _deliver_outbox_item)
+                await flush_notification_acks()
+                continue
+
+            # Ждем новое уведомление или время ближайшего повтора
+            next_at = outbox.next_attempt_at()
+            timeout = None if next_at is None else max(0, next_at - time.time())
+            try:
+                await asyncio.wait_for(outbox_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка очереди уведомлений: {e}")
+            await asyncio.sleep(5)
+
+
+async def prune_outbox():
+    """Удалить из локальной очереди старые завершенные уведомления"""
+    try:
+        removed = outbox.prune()
+        logger.info(f"Очередь уведомлений: удалено {removed} старых записей, сейчас {outbox.get_outbox_stats()}")
+    except Exception as e:
+        logger.error(f"Ошибка очистки очереди уведомлений: {e}")
+
+
+async def run_notification_sweep():
+    """Запасной обход: запрос только записей, созданных после сохраненного курсора, подходящие ставятся в очередь"""
+    try:
+        now = get_moscow_time()
+        today_date = now.strftime('%Y-%m-%d')
+        logger.info(f"🔄 Обход уведомлений. Московское время: {now}")
+
+        # Сначала отправляем накопленные отметки, чтобы выборка сервера была актуальной
+        await flush_notification_acks()
+
+        # Сервер сам отбрасывает уже отправленные уведомления (NOT EXISTS по таблице уведомлений)
+        # и возвращает только записи с id больше курсора
+        cursor = outbox.get_cursor(SWEEP_CURSOR)
+        params = {'тип': ','.join(SWEEP_NOTIFICATIONS), 'startDate': today_date, 'afterId': cursor or 0}
+        if cursor is None:
+            # Первый запуск: начинаем с записей, созданных сегодня
+            params['createdSince'] = today_date
+        response = await api_get("/api/appointments-without-notification", params=params)
+        if response.get('message') != 'success':
+            logger.error(f"Ошибка API appointments-without-notification: {response}")
+            return
+
+        pending = response.get('data', [])
+        queued_counts = {notification_type: 0 for notification_type in SWEEP_NOTIFICATIONS}
+
+        for appointment in pending:
+            notification_type = appointment['тип_уведомления']
+            should_send = SWEEP_NOTIFICATIONS[notification_type][0]
+            if should_send(appointment, now) and enqueue_notification(appointment, notification_type):
+                queued_counts[notification_type] += 1
+
+        # Курсор сдвигаем после постановки в очередь: упавший обход повторит ту же выборку
+        outbox.set_cursor(SWEEP_CURSOR, response['cursor'])
+
+        if any(queued_counts.values()):
+            logger.info(f"✅ Обход уведомлений: поставлено в очередь {queued_counts}")
+
+    except Exception as e:
+        logger.error(f"Ошибка обхода уведомлений: {e}")
 
-def shutdown_notifications():
-    """Остановка системы уведомлений"""
-    global scheduler, notification_loop
+async def _handle_appointment_event(event):
+    """Обработать событие по записи из outbox сервера"""
+    if event['событие_тип'] == 'deleted' or event.get('id') is None:
+        # Запись удалена - напоминание больше не нужно
+        if hourly_reminders is not None:
+            hourly_reminders.cancel(event['запись_id'])
+        outbox.cancel(event['запись_id'], 'hourly')
+        return
+
+    if event['событие_тип'] == 'updated':
+        # Сервер удалил уведомления измененной записи - забываем их и в локальной очереди
+        outbox.forget(event['id'])
+
+    # Новая или перенесенная запись - ставим напоминание на новое время
+    schedule_hourly_reminder(event)
+
+    if event['событие_тип'] == 'updated':
+        return
+
+    now = get_moscow_time()
+    for notification_type, (should_send, _) in SWEEP_NOTIFICATIONS.items():
+        if should_send(event, now):
+            enqueue_notification(event, notification_type)
+
+
+async def consume_appointment_events():
+    """Читать события по записям с сервера (long-poll) и сразу отправлять уведомления о новых записях"""
+    cursor = None
+    while True:
+        try:
+            if cursor is None:
+                # Начинаем с текущего курсора: пропущенное за время простоя отправит обход
+                response = await api_get("/api/appointment-events")
+            else:
+                response = await api_get(
+                    "/api/appointment-events",
+                    params={'after': cursor, 'timeout': APPOINTMENT_EVENTS_WAIT},
+                    timeout=APPOINTMENT_EVENTS_WAIT + 10
+                )
+
+            if response.get('message') != 'success':
+                logger.error(f"Ошибка API appointment-events: {response}")
+                await asyncio.sleep(5)
+                continue
+
+            for event in response.get('data', []):
+                try:
+                    await _handle_appointment_event(event)
+                except Exception as e:
+                    logger.error(f"Ошибка обработки события {event.get('событие_id')}: {e}")
+            if response.get('data'):
+                await flush_notification_acks()
+            cursor = response['cursor']
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка чтения событий по записям: {e}")
+            await asyncio.sleep(5)
+
+
+async def shutdown_notifications(application):
+    """Остановка системы уведомлений (вызывается из post_stop, пока бот еще работает)"""
+    global scheduler, events_task, hourly_reminders, outbox_task
+    
+    if hourly_reminders:
+        await hourly_reminders.stop()
+        hourly_reminders = None
+    
+    if events_task:
+        events_task.cancel()
+        try:
+            await events_task
+        except asyncio.CancelledError:
+            pass
+        events_task = None
+    
+    if outbox_task:
+        outbox_task.cancel()
+        try:
+            await outbox_task
+        except asyncio.CancelledError:
+            pass
+        outbox_task = None
     
     if scheduler:
         try:
-            scheduler.shutdown()
+            scheduler.shutdown(wait=False)
+            scheduler = None
             logger.info("✅ Система уведомлений остановлена")
         except Exception as e:
             logger.error(f"❌ Ошибка остановки планировщика: {e}")
     
-    if notification_loop:
-        try:
-            notification_loop.stop()
-            notification_loop.close()
-            logger.info("✅ Event loop уведомлений остановлен")
-        except Exception as e:
-            logger.error(f"❌ Ошибка остановки event loop: {e}")
\ No newline at end of file
+    # Отметки, накопленные с последнего сброса, отправляем сразу (неотправленные останутся в очереди)
+    await flush_notification_acks()
+    outbox.close()
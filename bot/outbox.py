@@ -0,0 +1,216 @@
+# outbox.py - локальная очередь уведомлений бота (SQLite): переживает перезапуск, не дает отправить дважды
+import os
+import json
+import time
+import sqlite3
+import logging
+from dotenv import load_dotenv
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Файл очереди
+OUTBOX_FILE = os.getenv('NOTIFICATION_OUTBOX_FILE', 'notification_outbox.db')
+# Повторы: 30 с, 1 мин, 2 мин ... но не реже раза в час; после MAX_ATTEMPTS попыток уведомление снимается
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '6'))
+# Сколько дней хранить подтвержденные сервером уведомления
+KEEP_DAYS = 3
+
+# Статусы: pending - ждет отправки, sent - отправлено, failed - попытки исчерпаны, expired - уже не актуально
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        запись_id INTEGER NOT NULL,
+        тип TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        expires_at REAL,
+        created_at REAL NOT NULL,
+        sent_at REAL,
+        acked INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        PRIMARY KEY (запись_id, тип)
+    );
+    CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+    CREATE INDEX IF NOT EXISTS idx_outbox_unacked ON outbox (status, acked);
+    CREATE TABLE IF NOT EXISTS cursors (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    );
+"""
+
+_db = None
+
+
+def _get_db():
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(OUTBOX_FILE, isolation_level=None)
+        _db.row_factory = sqlite3.Row
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.executescript(_SCHEMA)
+    return _db
+
+
+def enqueue(appointment, notification_type, expires_at=None):
+    """Поставить уведомление в очередь. Возвращает False, если оно уже было поставлено раньше
+    (у еще не отправленного уведомления при этом обновляются данные записи)."""
+    db = _get_db()
+    now = time.time()
+    payload = json.dumps(appointment, ensure_ascii=False)
+    cursor = db.execute(
+        """
+        INSERT OR IGNORE INTO outbox (запись_id, тип, payload, next_attempt_at, expires_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (appointment['id'], notification_type, payload, now, expires_at, now)
+    )
+    if cursor.rowcount:
+        return True
+    db.execute(
+        "UPDATE outbox SET payload = ?, expires_at = ? WHERE запись_id = ? AND тип = ? AND status = 'pending'",
+        (payload, expires_at, appointment['id'], notification_type)
+    )
+    return False
+
+
+def due(limit):
+    """Уведомления, которые пора отправить (просроченные сразу помечаются expired)"""
+    db = _get_db()
+    now = time.time()
+    db.execute(
+        "UPDATE outbox SET status = 'expired' WHERE status = 'pending' AND expires_at IS NOT NULL AND expires_at <= ?",
+        (now,)
+    )
+    rows = db.execute(
+        """
+        SELECT запись_id, тип, payload, attempts FROM outbox
+        WHERE status = 'pending' AND next_attempt_at <= ?
+        ORDER BY next_attempt_at
+        LIMIT ?
+        """,
+        (now, limit)
+    ).fetchall()
+    return [
+        {'запись_id': row['запись_id'], 'тип': row['тип'], 'attempts': row['attempts'],
+         'appointment': json.loads(row['payload'])}
+        for row in rows
+    ]
+
+
+def next_attempt_at():
+    """Время ближайшей запланированной попытки (None, если очередь пуста)"""
+    row = _get_db().execute(
+        "SELECT MIN(next_attempt_at) AS next_at FROM outbox WHERE status = 'pending'"
+    ).fetchone()
+    return row['next_at']
+
+
+def mark_sent(appointment_id, notification_type):
+    _get_db().execute(
+        "UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE запись_id = ? AND тип = ?",
+        (time.time(), appointment_id, notification_type)
+    )
+
+
+def mark_failed(appointment_id, notification_type, attempts, error=None):
+    """Неудачная попытка: следующая через экспоненциально растущую паузу"""
+    attempts += 1
+    status = 'failed' if attempts >= MAX_ATTEMPTS else 'pending'
+    delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    _get_db().execute(
+        """
+        UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+        WHERE запись_id = ? AND тип = ?
+        """,
+        (status, attempts, time.time() + delay, error, appointment_id, notification_type)
+    )
+    return status
+
+
+def unacked(limit):
+    """Отправленные уведомления, о которых еще не знает сервер"""
+    rows = _get_db().execute(
+        "SELECT запись_id, тип FROM outbox WHERE status = 'sent' AND acked = 0 ORDER BY sent_at LIMIT ?",
+        (limit,)
+    ).fetchall()
+    return [(row['запись_id'], row['тип']) for row in rows]
+
+
+def mark_acked(keys):
+    db = _get_db()
+    db.execute("BEGIN")
+    try:
+        db.executemany("UPDATE outbox SET acked = 1 WHERE запись_id = ? AND тип = ?", keys)
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+
+
+def forget(appointment_id):
+    """Запись изменилась и сервер удалил ее уведомления - отправленные можно отправить заново"""
+    _get_db().execute(
+        "DELETE FROM outbox WHERE запись_id = ? AND status != 'pending' AND (status != 'sent' OR acked = 1)",
+        (appointment_id,)
+    )
+
+
+def cancel(appointment_id, notification_type):
+    """Снять неотправленное уведомление (например, запись удалена)"""
+    _get_db().execute(
+        "UPDATE outbox SET status = 'expired' WHERE запись_id = ? AND тип = ? AND status = 'pending'",
+        (appointment_id, notification_type)
+    )
+
+
+def prune():
+    """Удалить старые завершенные уведомления"""
+    cursor = _get_db().execute(
+        """
+        DELETE FROM outbox
+        WHERE created_at < ?
+        AND (status IN ('failed', 'expired') OR (status = 'sent' AND acked = 1))
+        """,
+        (time.time() - KEEP_DAYS * 86400,)
+    )
+    return cursor.rowcount
+
+
+def get_cursor(name):
+    """Сохраненный курсор опроса (None, если опроса еще не было)"""
+    row = _get_db().execute("SELECT value FROM cursors WHERE name = ?", (name,)).fetchone()
+    return row['value'] if row else None
+
+
+def set_cursor(name, value):
+    _get_db().execute(
+        "INSERT INTO cursors (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+        (name, value)
+    )
+
+
+def get_outbox_stats():
+    """Количество уведомлений в очереди по статусам"""
+    rows = _get_db().execute(
+        "SELECT status, acked, COUNT(*) AS count FROM outbox GROUP BY status, acked"
+    ).fetchall()
+    stats = {'pending': 0, 'sent': 0, 'unacked': 0, 'failed': 0, 'expired': 0}
+    for row in rows:
+        stats[row['status']] += row['count']
+        if row['status'] == 'sent' and not row['acked']:
+            stats['unacked'] += row['count']
+    return stats
+
+
+def close():
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
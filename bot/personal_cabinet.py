@@ -1,7 +1,9 @@
 # personal_cabinet.py
 import os
 import logging
-import requests
+from api_client import api_get, api_post, api_patch
+from media import get_photo, remember_photo
+from state_store import StateStore
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import ContextTypes
 from datetime import datetime
@@ -19,7 +21,7 @@ API_BASE_URL = os.getenv('API_BASE_URL')
 if not API_BASE_URL:
     logger.error("❌ API_BASE_URL не установлен в .env файле")
 # Состояния пользователей для личного кабинета
-personal_states = {}
+personal_states = StateStore('personal_states')
 
 async def show_personal_cabinet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать личный кабинет или начать регистрацию"""
@@ -28,8 +30,7 @@ async def show_personal_cabinet(update: Update, context: ContextTypes.DEFAULT_TY
 
     try:
         # Проверяем, зарегистрирован ли пользователь по tg_id
-        response = requests.get(f"{API_BASE_URL}/api/client/by-tg/{user_id}")
-        data = response.json()
+        data = await api_get(f"/api/client/by-tg/{user_id}")
 
         if data['message'] == 'success' and data['data']:
             # Пользователь зарегистрирован, показываем меню личного кабинета
@@ -71,12 +72,11 @@ async def show_personal_cabinet(update: Update, context: ContextTypes.DEFAULT_TY
 async def show_cabinet_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     """Показать меню личного кабинета"""
     query = update.callback_query if update.callback_query else None
-    photo_url = f"{API_BASE_URL}/photo/images/lk.jpg"
+    photo_url = "/photo/images/lk.jpg"
 
     try:
         # Получаем данные клиента
-        response = requests.get(f"{API_BASE_URL}/api/client/by-tg/{user_id}")
-        data = response.json()
+        data = await api_get(f"/api/client/by-tg/{user_id}")
 
         if data['message'] == 'success' and data['data']:
             client_data = data['data']
@@ -105,14 +105,15 @@ async def show_cabinet_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     try:
-        photo_response = requests.get(photo_url)
-        if photo_response.status_code == 200:
-            photo_data = photo_response.content
+        photo_data = await get_photo(photo_url)
+        if photo_data:
             media = InputMediaPhoto(media=photo_data, caption=message_text)
             if query:
-                await query.edit_message_media(media=media, reply_markup=reply_markup)
+                sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                remember_photo(photo_url, sent_message)
             else:
-                await update.message.reply_photo(photo=photo_data, caption=message_text, reply_markup=reply_markup)
+                sent_message = await update.message.reply_photo(photo=photo_data, caption=message_text, reply_markup=reply_markup)
+                remember_photo(photo_url, sent_message)
         else:
             if query:
                 await query.edit_message_caption(caption=message_text, reply_markup=reply_markup)
@@ -172,53 +173,42 @@ async def logout_from_cabinet(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     try:
         # Получаем данные клиента для поиска ID
-        response = requests.get(f"{API_BASE_URL}/api/client/by-tg/{user_id}")
-        logger.info(f"DEBUG: Client by tg response status: {response.status_code}")
-        logger.info(f"DEBUG: Client by tg response text: {response.text}")
+        data = await api_get(f"/api/client/by-tg/{user_id}")
+        logger.info(f"DEBUG: Client by tg response: {data}")
         
-        if response.status_code == 200:
-            data = response.json()
+        if data.get('message') == 'success' and data.get('data'):
+            client_data = data['data']
+            client_id = client_data['id']
+            
+            # Создаем уникальное значение для tg_id, которое не будет конфликтовать
+            # Используем отрицательное значение с префиксом "deleted_"
+            unique_tg_id = f"deleted_{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
             
-            if data.get('message') == 'success' and data.get('data'):
-                client_data = data['data']
-                client_id = client_data['id']
+            update_data = await api_patch(
+                f"/api/client/{client_id}",
+                json={'tg_id': unique_tg_id}
+            )
+            logger.info(f"DEBUG: Update client response: {update_data}")
+            
+            if update_data.get('message') == 'success':
+                # Удаляем состояние пользователя если есть
+                if user_id in personal_states:
+                    del personal_states[user_id]
                 
-                # Создаем уникальное значение для tg_id, которое не будет конфликтовать
-                # Используем отрицательное значение с префиксом "deleted_"
-                unique_tg_id = f"deleted_{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+                message_text = "✅ Вы вышли из личного кабинета. Для доступа потребуется повторная регистрация."
                 
-                update_response = requests.patch(
-                    f"{API_BASE_URL}/api/client/{client_id}", 
-                    json={'tg_id': unique_tg_id}
-                )
-                logger.info(f"DEBUG: Update client response status: {update_response.status_code}")
-                logger.info(f"DEBUG: Update client response text: {update_response.text}")
+                # Сначала показываем сообщение о выходе
+                await query.edit_message_caption(caption=message_text)
                 
-                if update_response.status_code == 200:
-                    update_data = update_response.json()
-                    if update_data.get('message') == 'success':
-                        # Удаляем состояние пользователя если есть
-                        if user_id in personal_states:
-                            del personal_states[user_id]
-                        
-                        message_text = "✅ Вы вышли из личного кабинета. Для доступа потребуется повторная регистрация."
-                        
-                        # Сначала показываем сообщение о выходе
-                        await query.edit_message_caption(caption=message_text)
-                        
-                        # Затем отправляем новое сообщение с главным меню
-                        from menu_handlers import show_main_menu
-                        await show_main_menu(update, context)
-                        
-                        return
-                    else:
-                        message_text = "❌ Ошибка при обновлении данных"
-                else:
-                    message_text = "❌ Ошибка сервера при обновлении"
+                # Затем отправляем новое сообщение с главным меню
+                from menu_handlers import show_main_menu
+                await show_main_menu(update, context)
+                
+                return
             else:
-                message_text = "❌ Клиент не найден"
+                message_text = "❌ Ошибка при обновлении данных"
         else:
-            message_text = "❌ Ошибка подключения к серверу"
+            message_text = "❌ Клиент не найден"
             
         # Если дошли сюда, значит произошла ошибка
         await query.edit_message_caption(caption=message_text)
@@ -253,14 +243,13 @@ async def handle_personal_message(update: Update, context: ContextTypes.DEFAULT_
             state['phone'] = text
             # Проверяем, существует ли клиент с таким телефоном
             try:
-                response = requests.get(f"{API_BASE_URL}/api/client/by-phone/{text}")
-                data = response.json()
+                data = await api_get(f"/api/client/by-phone/{text}")
 
                 if data['message'] == 'success' and data['data']:
                     # Клиент существует, обновляем tg_id
                     client_id = data['data']['id']
-                    update_response = requests.patch(f"{API_BASE_URL}/api/client/{client_id}", json={'tg_id': str(user_id)})
-                    if update_response.json()['message'] == 'success':
+                    update_response = await api_patch(f"/api/client/{client_id}", json={'tg_id': str(user_id)})
+                    if update_response['message'] == 'success':
                         await update.message.reply_text("✅ Регистрация успешна! Теперь вы можете использовать личный кабинет.")
                         del personal_states[user_id]
                         await show_cabinet_menu(update, context, user_id)
@@ -282,12 +271,12 @@ async def handle_personal_message(update: Update, context: ContextTypes.DEFAULT_
 
             try:
                 # Добавляем нового клиента
-                response = requests.post(f"{API_BASE_URL}/api/client", json={
+                response = await api_post("/api/client", json={
                     'имя': text.strip(),
                     'телефон': state['phone'],
                     'tg_id': str(user_id)
                 })
-                if response.json()['message'] == 'success':
+                if response['message'] == 'success':
                     await update.message.reply_text("✓ Регистрация успешна! Теперь вы можете использовать личный кабинет.")
                     del personal_states[user_id]
                     await show_cabinet_menu(update, context, user_id)
@@ -317,14 +306,13 @@ async def show_current_appointments(update: Update, context: ContextTypes.DEFAUL
 async def show_appointments(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, is_history: bool, page: int = 0):
     """Общий метод для показа записей с пагинацией - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
     query = update.callback_query
-    photo_url = f"{API_BASE_URL}/photo/images/lk.jpg"
+    photo_url = "/photo/images/lk.jpg"
 
     print(f"DEBUG: show_appointments called - is_history: {is_history}, page: {page}, user_id: {user_id}")
 
     try:
         # Сначала находим client_id по tg_id
-        client_response = requests.get(f"{API_BASE_URL}/api/client/by-tg/{user_id}")
-        client_data = client_response.json()
+        client_data = await api_get(f"/api/client/by-tg/{user_id}")
         if client_data['message'] != 'success' or not client_data['data']:
             raise Exception("Client not found")
 
@@ -332,8 +320,7 @@ async def show_appointments(update: Update, context: ContextTypes.DEFAULT_TYPE,
         print(f"DEBUG: Found client_id: {client_id}")
 
         # Получаем все записи клиента
-        response = requests.get(f"{API_BASE_URL}/api/client/{client_id}/appointments")
-        data = response.json()
+        data = await api_get(f"/api/client/{client_id}/appointments")
 
         if data['message'] == 'success':
             appointments = data['data']['appointments']
@@ -454,14 +441,15 @@ async def show_appointments(update: Update, context: ContextTypes.DEFAULT_TYPE,
             print(f"DEBUG: Final keyboard: {keyboard}")
 
             try:
-                photo_response = requests.get(photo_url)
-                if photo_response.status_code == 200:
-                    photo_data = photo_response.content
+                photo_data = await get_photo(photo_url)
+                if photo_data:
                     if query.message.photo:
                         media = InputMediaPhoto(media=photo_data, caption=message_text)
-                        await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        sent_message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                        remember_photo(photo_url, sent_message)
                     else:
-                        await query.message.reply_photo(photo=photo_data, caption=message_text, reply_markup=reply_markup)
+                        sent_message = await query.message.reply_photo(photo=photo_data, caption=message_text, reply_markup=reply_markup)
+                        remember_photo(photo_url, sent_message)
                         await query.delete_message()
                 else:
                     if query.message.photo:
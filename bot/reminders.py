@@ -0,0 +1,101 @@
+# reminders.py - напоминания о записях в точное время (куча по времени срабатывания)
+import time
+import heapq
+import asyncio
+import logging
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+
+class ReminderScheduler:
+    """Напоминания в точное время: куча (время срабатывания, запись_id) и одна задача,
+    которая спит до ближайшего напоминания. Перенос и отмена - O(log n), без опроса сервера."""
+
+    def __init__(self, fire):
+        # fire(appointments) - корутина, получает список записей, у которых наступило время напоминания
+        self._fire = fire
+        self._heap = []
+        # запись_id -> (время срабатывания, запись)
+        self._entries = {}
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def scheduled_ids(self):
+        return set(self._entries)
+
+    def schedule(self, appointment_id, fire_at, appointment):
+        """Поставить или перенести напоминание (fire_at - unix timestamp)"""
+        current = self._entries.get(appointment_id)
+        self._entries[appointment_id] = (fire_at, appointment)
+        if current is not None and current[0] == fire_at:
+            # Время не изменилось - обновляем только данные записи
+            return
+        heapq.heappush(self._heap, (fire_at, appointment_id))
+        self._compact()
+        self._changed.set()
+
+    def _compact(self):
+        """Пересобрать кучу, если устаревших элементов в ней больше, чем актуальных"""
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._heap = [(fire_at, appointment_id) for appointment_id, (fire_at, _) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, appointment_id):
+        """Отменить напоминание. Элемент в куче остается и пропускается при извлечении"""
+        if self._entries.pop(appointment_id, None) is not None:
+            self._compact()
+            self._changed.set()
+
+    def _is_current(self, fire_at, appointment_id):
+        entry = self._entries.get(appointment_id)
+        return entry is not None and entry[0] == fire_at
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, appointment_id = heapq.heappop(self._heap)
+            if self._is_current(fire_at, appointment_id):
+                due.append(self._entries.pop(appointment_id)[1])
+        return due
+
+    def _next_fire_at(self):
+        # Убираем с вершины кучи отмененные и перенесенные напоминания
+        while self._heap and not self._is_current(*self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def _run(self):
+        while True:
+            self._changed.clear()
+            next_fire_at = self._next_fire_at()
+            timeout = None if next_fire_at is None else max(0, next_fire_at - time.time())
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+                # Расписание изменилось - пересчитываем ближайшее время
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            due = self._pop_due(time.time())
+            if due:
+                try:
+                    await self._fire(due)
+                except Exception as e:
+                    logger.error(f"Ошибка отправки напоминаний: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
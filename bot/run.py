@@ -5,16 +5,6 @@ from main import main
 from admin import handle_admin_message
 from menu_handlers import *
 from personal_cabinet import *
-from notification import initialize_notifications, shutdown_notifications
-import asyncio
-import signal
-import sys
-
-def signal_handler(sig, frame):
-    """Обработчик сигналов для graceful shutdown"""
-    print("\n🛑 Получен сигнал остановки...")
-    shutdown_notifications()
-    sys.exit(0)
 
 if __name__ == '__main__':
     # Загружаем переменные окружения из текущей директории
@@ -24,10 +14,6 @@ if __name__ == '__main__':
     print("BOT_TOKEN:", os.getenv('BOT_TOKEN'))
     print("API_BASE_URL:", os.getenv('API_BASE_URL'))
     
-    # Регистрируем обработчики сигналов
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-    
     # Проверяем наличие токена
     if not os.getenv('BOT_TOKEN'):
         print("❌ Ошибка: BOT_TOKEN не установлен")
@@ -39,17 +25,12 @@ if __name__ == '__main__':
         print("Добавьте API_BASE_URL=your_api_url в файл .env")
         exit(1)
     
-    # Инициализируем систему уведомлений
-    initialize_notifications()
-    
     try:
-        # Запускаем бота
+        # Запускаем бота. Уведомления запускаются и останавливаются вместе с приложением
+        # (post_init / post_stop), SIGINT и SIGTERM обрабатывает run_polling
         print("🤖 Запуск бота...")
         main()
     except KeyboardInterrupt:
         print("\n🛑 Остановка бота...")
     except Exception as e:
-        print(f"❌ Критическая ошибка: {e}")
-    finally:
-        # Останавливаем систему уведомлений
-        shutdown_notifications()
\ No newline at end of file
+        print(f"❌ Критическая ошибка: {e}")
\ No newline at end of file
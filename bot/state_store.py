@@ -0,0 +1,340 @@
+# state_store.py - хранилище состояний диалогов с временем жизни записи и ограничением размера
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dotenv import load_dotenv
+# Загружаем переменные окружения
+load_dotenv('.env')
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Брошенный диалог забывается через STATE_TTL_SECONDS без действий пользователя
+STATE_TTL_SECONDS = int(os.getenv('STATE_TTL_SECONDS', str(6 * 3600)))
+# Больше STATE_MAX_SIZE диалогов в одном хранилище не держим - вытесняются самые давние
+STATE_MAX_SIZE = int(os.getenv('STATE_MAX_SIZE', '10000'))
+
+# Где хранятся состояния между перезапусками: memory, sqlite или redis
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_DB_FILE = os.getenv('STATE_DB_FILE', 'conversation_state.db')
+# Как часто (в секундах) SQLite получает накопленные изменения
+STATE_FLUSH_SECONDS = float(os.getenv('STATE_FLUSH_SECONDS', '2'))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# Все созданные хранилища (для статистики и сохранения)
+_stores = []
+
+
+class StateStore(MutableMapping):
+    """Словарь состояний user_id -> состояние. Каждое обращение продлевает жизнь записи,
+    записи хранятся в порядке последнего обращения, поэтому просроченные и лишние удаляются с начала."""
+
+    def __init__(self, name, ttl=STATE_TTL_SECONDS, max_size=STATE_MAX_SIZE):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (состояние, время жизни записи)
+        self._entries = OrderedDict()
+        # key -> время истечения
+        self._expires = {}
+        # key -> состояние в JSON, как оно лежит в хранилище (чтобы сохранять только изменения)
+        self._saved = {}
+        self.metrics = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+        _stores.append(self)
+
+    def _is_expired(self, key, now):
+        return self._expires[key] <= now
+
+    def _drop(self, key):
+        del self._entries[key]
+        del self._expires[key]
+        self._saved.pop(key, None)
+
+    def _touch(self, key, now):
+        self._entries.move_to_end(key)
+        self._expires[key] = now + self._entries[key][1]
+
+    def purge_expired(self):
+        """Удалить просроченные записи с начала очереди (до первой живой)"""
+        now = time.time()
+        removed = 0
+        while self._entries:
+            key = next(iter(self._entries))
+            if not self._is_expired(key, now):
+                break
+            self._drop(key)
+            removed += 1
+        self.metrics['expired'] += removed
+        return removed
+
+    def __getitem__(self, key):
+        now = time.time()
+        if key not in self._entries:
+            self.metrics['misses'] += 1
+            raise KeyError(key)
+        if self._is_expired(key, now):
+            self._drop(key)
+            self.metrics['expired'] += 1
+            self.metrics['misses'] += 1
+            raise KeyError(key)
+        self.metrics['hits'] += 1
+        self._touch(key, now)
+        return self._entries[key][0]
+
+    def set(self, key, value, ttl=None):
+        """Сохранить состояние; ttl - свое время жизни для этой записи"""
+        now = time.time()
+        self._entries[key] = (value, ttl or self.ttl)
+        self._touch(key, now)
+        self.purge_expired()
+        while len(self._entries) > self.max_size:
+            evicted_key = next(iter(self._entries))
+            self._drop(evicted_key)
+            self.metrics['evicted'] += 1
+            logger.debug(f"Состояние {self.name} пользователя {evicted_key} вытеснено (лимит {self.max_size})")
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        # Снимок сохраненного состояния остается до save(), чтобы удаление дошло до хранилища
+        del self._entries[key]
+        del self._expires[key]
+
+    def __contains__(self, key):
+        # Проверка без продления жизни записи
+        return key in self._entries and not self._is_expired(key, time.time())
+
+    def __iter__(self):
+        now = time.time()
+        return iter([key for key in self._entries if not self._is_expired(key, now)])
+
+    def __len__(self):
+        self.purge_expired()
+        return len(self._entries)
+
+    def get_stats(self):
+        return {'active': len(self), **self.metrics}
+
+    async def load(self, key):
+        """Взять состояние пользователя из хранилища. Общее хранилище (несколько процессов) читается
+        при каждом обновлении, локальное - только если состояния нет в памяти (например, после перезапуска)"""
+        if not _backend.shared and key in self:
+            return
+        value = await _backend.load(self.name, key)
+        if value is None:
+            if key in self._entries:
+                self._drop(key)
+            return
+        self._entries[key] = (json.loads(value), self.ttl)
+        self._touch(key, time.time())
+        self._saved[key] = value
+
+    async def save(self, key):
+        """Записать в хранилище состояние пользователя, если оно изменилось за время обработки обновления"""
+        if key in self:
+            value = json.dumps(self._entries[key][0], ensure_ascii=False, default=str)
+            if self._saved.get(key) != value:
+                await _backend.save(self.name, key, value, self._entries[key][1])
+                self._saved[key] = value
+        elif self._saved.pop(key, None) is not None:
+            await _backend.delete(self.name, key)
+
+
+def get_state_stats():
+    """Статистика всех хранилищ состояний: активные диалоги, истекшие и вытесненные"""
+    return {store.name: store.get_stats() for store in _stores}
+
+
+class MemoryStateBackend:
+    """Состояния только в памяти процесса (теряются при перезапуске)"""
+    shared = False
+
+    async def start(self):
+        pass
+
+    async def load(self, store, key):
+        return None
+
+    async def save(self, store, key, value, ttl):
+        pass
+
+    async def delete(self, store, key):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SQLiteStateBackend:
+    """Состояния в SQLite с отложенной записью: изменения копятся и пишутся одной транзакцией
+    раз в STATE_FLUSH_SECONDS, так что обработчики не ждут диск"""
+    shared = False
+
+    def __init__(self, path=STATE_DB_FILE, flush_seconds=STATE_FLUSH_SECONDS):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self._db = None
+        # (хранилище, key) -> (JSON или None для удаления, время истечения)
+        self._pending = {}
+        self._task = None
+
+    async def start(self):
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS states (
+                store TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (store, key)
+            )
+        """)
+        self._db.execute("DELETE FROM states WHERE expires_at <= ?", (time.time(),))
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            self.flush()
+
+    def flush(self):
+        """Записать накопленные изменения одной транзакцией"""
+        if not self._pending or self._db is None:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            self._db.execute("BEGIN")
+            for (store, key), (value, expires_at) in pending.items():
+                if value is None:
+                    self._db.execute("DELETE FROM states WHERE store = ? AND key = ?", (store, key))
+                else:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO states (store, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                        (store, key, value, expires_at)
+                    )
+            self._db.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояний диалогов: {e}")
+            self._db.execute("ROLLBACK")
+            # Более новые изменения из очереди не перезаписываем
+            self._pending = {**pending, **self._pending}
+
+    async def load(self, store, key):
+        pending = self._pending.get((store, str(key)))
+        if pending is not None:
+            return pending[0]
+        row = self._db.execute(
+            "SELECT value FROM states WHERE store = ? AND key = ? AND expires_at > ?",
+            (store, str(key), time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    async def save(self, store, key, value, ttl):
+        self._pending[(store, str(key))] = (value, time.time() + ttl)
+
+    async def delete(self, store, key):
+        self._pending[(store, str(key))] = (None, 0)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class RedisStateBackend:
+    """Состояния в Redis (или совместимом сервере): общие для нескольких процессов бота.
+    client - асинхронный клиент с методами get/set(ex=)/delete, например redis.asyncio.Redis"""
+    shared = True
+
+    def __init__(self, client, prefix='salon:state'):
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, store, key):
+        return f"{self.prefix}:{store}:{key}"
+
+    async def start(self):
+        pass
+
+    async def load(self, store, key):
+        value = await self.client.get(self._key(store, key))
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    async def save(self, store, key, value, ttl):
+        await self.client.set(self._key(store, key), value, ex=int(ttl))
+
+    async def delete(self, store, key):
+        await self.client.delete(self._key(store, key))
+
+    async def close(self):
+        close = getattr(self.client, 'aclose', None) or getattr(self.client, 'close', None)
+        if close:
+            await close()
+
+
+_backend = MemoryStateBackend()
+
+
+def _backend_from_env():
+    if STATE_BACKEND == 'sqlite':
+        return SQLiteStateBackend()
+    if STATE_BACKEND == 'redis':
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            # Без Redis состояния молча терялись бы при перезапуске - лучше не запускаться
+            raise RuntimeError("STATE_BACKEND=redis, но пакет redis не установлен (pip install -r requirements.txt)") from e
+        return RedisStateBackend(redis.from_url(REDIS_URL))
+    return MemoryStateBackend()
+
+
+async def init_state_backend(backend=None):
+    """Подключить хранилище состояний (по умолчанию - из STATE_BACKEND)"""
+    global _backend
+    _backend = backend or _backend_from_env()
+    await _backend.start()
+    logger.info(f"Хранилище состояний диалогов: {type(_backend).__name__}")
+
+
+async def close_state_backend():
+    """Записать отложенные изменения и закрыть хранилище"""
+    global _backend
+    await _backend.close()
+    _backend = MemoryStateBackend()
+
+
+async def load_user_states(user_id):
+    """Подготовить состояния пользователя перед обработкой его обновления"""
+    if isinstance(_backend, MemoryStateBackend):
+        return
+    for store in _stores:
+        try:
+            await store.load(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка чтения состояния {store.name} пользователя {user_id}: {e}")
+
+
+async def save_user_states(user_id):
+    """Сохранить изменения состояний пользователя после обработки его обновления"""
+    if isinstance(_backend, MemoryStateBackend):
+        return
+    for store in _stores:
+        try:
+            await store.save(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния {store.name} пользователя {user_id}: {e}")
@@ -0,0 +1,63 @@
+# test_dead_chats.py - чат из реестра недоступных снова получает сообщения, когда пользователь пишет боту
+import asyncio
+from datetime import datetime
+import pytest
+from telegram import Update, Message, Chat, User
+from telegram.ext import Application
+import dead_chats
+import delivery
+from main import SalonApplication
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """Запросы к реестру на сервере записываются вместо отправки"""
+    calls = []
+
+    async def api_post(path, json=None, timeout=None):
+        calls.append(('POST', path))
+        return {'message': 'success'}
+
+    async def api_delete(path, timeout=None):
+        calls.append(('DELETE', path))
+        return {'message': 'success'}
+
+    monkeypatch.setattr(dead_chats, 'api_post', api_post)
+    monkeypatch.setattr(dead_chats, 'api_delete', api_delete)
+    monkeypatch.setattr(dead_chats, '_registry', {})
+    return calls
+
+
+def _private_message(chat_id):
+    user = User(chat_id, 'Анна', False)
+    message = Message(1, datetime.now(), Chat(chat_id, Chat.PRIVATE), from_user=user, text='/start')
+    return Update(1, message=message)
+
+
+def test_inbound_update_revives_dead_chat(server):
+    application = Application.builder().token('123:TEST').application_class(SalonApplication).build()
+    # initialize() обращается к Telegram (get_me); обработчиков нет, поэтому бот не нужен
+    application._initialized = True
+    sent = []
+
+    async def send():
+        sent.append(1)
+        return 'ok'
+
+    async def scenario():
+        await dead_chats.mark_dead(42, 'Forbidden: bot was blocked by the user')
+        with pytest.raises(dead_chats.ChatUnavailable):
+            await delivery.send_limited(42, send)
+
+        # Обновление от другого пользователя не трогает реестр и сервер
+        await application.process_update(_private_message(7))
+        assert server == [('POST', '/api/dead-chats')]
+
+        await application.process_update(_private_message(42))
+        assert not dead_chats.is_marked(42)
+        assert server[-1] == ('DELETE', '/api/dead-chats/42')
+
+        assert await delivery.send_limited(42, send) == 'ok'
+        assert sent == [1]
+
+    asyncio.run(scenario())
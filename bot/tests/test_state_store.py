@@ -0,0 +1,215 @@
+# test_state_store.py - сохранение состояний диалогов через SQLite (отложенная запись) и Redis (локальный fake)
+import sys
+import time
+import asyncio
+import pytest
+import state_store
+
+
+class FakeRedis:
+    """Redis в памяти процесса: только команды, которые нужны хранилищу состояний"""
+
+    def __init__(self):
+        # key -> (значение, время истечения или None)
+        self.data = {}
+        self.commands = []
+
+    def _alive(self, key):
+        item = self.data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self.data[key]
+            return None
+        return item
+
+    async def get(self, key):
+        self.commands.append('get')
+        item = self._alive(key)
+        return item[0].encode('utf-8') if item else None
+
+    async def set(self, key, value, ex=None):
+        self.commands.append('set')
+        self.data[key] = (value, time.time() + ex if ex else None)
+        return True
+
+    async def delete(self, key):
+        self.commands.append('delete')
+        return 1 if self.data.pop(key, None) is not None else 0
+
+    async def aclose(self):
+        pass
+
+
+@pytest.fixture
+def stores():
+    """Отдельные хранилища на тест: глобальный список возвращается после теста"""
+    saved = list(state_store._stores)
+    state_store._stores.clear()
+    user_states = state_store.StateStore('user_states', ttl=60)
+    admin_states = state_store.StateStore('admin_states', ttl=60)
+    yield user_states, admin_states
+    state_store._stores[:] = saved
+
+
+class FakeClock:
+    """Часы хранилища состояний, которые двигает тест"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(state_store, 'time', fake)
+    return fake
+
+
+def test_state_expires_after_ttl(stores, clock):
+    user_states, _ = stores
+    user_states[1] = {'step': 'name'}
+    user_states.set(2, {'step': 'phone'}, ttl=600)
+
+    clock.now += 59
+    # Чтение продлевает жизнь записи
+    assert user_states[1] == {'step': 'name'}
+    clock.now += 59
+    assert 1 in user_states
+
+    clock.now += 61
+    assert 1 not in user_states
+    with pytest.raises(KeyError):
+        user_states[1]
+    assert user_states.get(1) is None
+    assert user_states.metrics['expired'] == 1
+    # Запись со своим ttl живет дольше
+    assert user_states[2] == {'step': 'phone'}
+
+
+def test_least_recently_used_state_is_evicted(stores, clock):
+    user_states = state_store.StateStore('small_states', ttl=60, max_size=3)
+    for user_id in (1, 2, 3):
+        user_states[user_id] = {'step': user_id}
+        clock.now += 1
+
+    # Пользователь 1 недавно читал свое состояние - вытесняется давно не обращавшийся 2
+    assert user_states[1] == {'step': 1}
+    user_states[4] = {'step': 4}
+
+    assert 2 not in user_states
+    assert sorted(user_states) == [1, 3, 4]
+    assert user_states.metrics['evicted'] == 1
+
+
+def _forget_local(*stores):
+    """Как после перезапуска процесса: в памяти ничего нет"""
+    for store in stores:
+        store._entries.clear()
+        store._expires.clear()
+        store._saved.clear()
+
+
+def test_redis_round_trip(stores):
+    user_states, admin_states = stores
+    client = FakeRedis()
+
+    async def scenario():
+        await state_store.init_state_backend(state_store.RedisStateBackend(client))
+
+        await state_store.load_user_states(7)
+        user_states[7] = {'step': 'name'}
+        # Изменение вложенного состояния тоже должно сохраниться
+        user_states[7]['date'] = '2026-10-20'
+        admin_states[7] = {'step': 'enter_time'}
+        await state_store.save_user_states(7)
+
+        # Другой процесс бота видит те же состояния
+        _forget_local(user_states, admin_states)
+        await state_store.load_user_states(7)
+        assert user_states[7] == {'step': 'name', 'date': '2026-10-20'}
+        assert admin_states[7] == {'step': 'enter_time'}
+
+        # Неизменное состояние повторно не записывается
+        client.commands.clear()
+        await state_store.save_user_states(7)
+        assert 'set' not in client.commands
+
+        del admin_states[7]
+        await state_store.save_user_states(7)
+        assert 'salon:state:admin_states:7' not in client.data
+
+        _forget_local(user_states, admin_states)
+        await state_store.load_user_states(7)
+        assert 7 in user_states
+        assert 7 not in admin_states
+
+        # Состояние живет в Redis столько же, сколько в памяти
+        assert client.data['salon:state:user_states:7'][1] == pytest.approx(time.time() + 60, abs=5)
+
+        await state_store.close_state_backend()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_write_behind_round_trip(stores, tmp_path):
+    user_states, admin_states = stores
+    path = str(tmp_path / 'state.db')
+
+    async def scenario():
+        backend = state_store.SQLiteStateBackend(path, flush_seconds=3600)
+        await state_store.init_state_backend(backend)
+
+        await state_store.load_user_states(5)
+        user_states[5] = {'step': 'phone', 'service_id': 3}
+        admin_states[5] = {'step': 'select_service'}
+        await state_store.save_user_states(5)
+
+        # До сброса изменения только в очереди, но уже читаются
+        assert backend._db.execute("SELECT COUNT(*) FROM states").fetchone()[0] == 0
+        assert await backend.load('user_states', 5) is not None
+
+        backend.flush()
+        assert backend._db.execute("SELECT COUNT(*) FROM states").fetchone()[0] == 2
+
+        del admin_states[5]
+        user_states[5]['step'] = 'confirm'
+        await state_store.save_user_states(5)
+        # Закрытие записывает то, что еще не сброшено
+        await state_store.close_state_backend()
+
+        _forget_local(user_states, admin_states)
+        await state_store.init_state_backend(state_store.SQLiteStateBackend(path, flush_seconds=3600))
+        await state_store.load_user_states(5)
+        assert user_states[5] == {'step': 'confirm', 'service_id': 3}
+        assert 5 not in admin_states
+        await state_store.close_state_backend()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_flush_runs_in_background(stores, tmp_path):
+    user_states, _ = stores
+    path = str(tmp_path / 'state.db')
+
+    async def scenario():
+        backend = state_store.SQLiteStateBackend(path, flush_seconds=0.05)
+        await state_store.init_state_backend(backend)
+        await state_store.load_user_states(9)
+        user_states[9] = {'step': 'name'}
+        await state_store.save_user_states(9)
+        await asyncio.sleep(0.2)
+        assert backend._db.execute("SELECT value FROM states WHERE key = '9'").fetchone()[0] == '{"step": "name"}'
+        await state_store.close_state_backend()
+
+    asyncio.run(scenario())
+
+
+def test_redis_backend_requires_package(monkeypatch):
+    # Запрошенный Redis без пакета - ошибка запуска, а не тихий переход на память
+    monkeypatch.setattr(state_store, 'STATE_BACKEND', 'redis')
+    monkeypatch.setitem(sys.modules, 'redis', None)
+    monkeypatch.setitem(sys.modules, 'redis.asyncio', None)
+    with pytest.raises(RuntimeError):
+        state_store._backend_from_env()
@@ -4,6 +4,7 @@ const path = require('path');
 const cors = require('cors');
 const multer = require('multer');
 const fs = require('fs');
+const zlib = require('zlib');
 const sharp = require('sharp');
 const heicConvert = require('heic-convert');
 
@@ -16,12 +17,45 @@ const PORT = process.env.PORT;
 
 process.env.TZ = "Europe/Moscow";
 
+// Дата YYYY-MM-DD в часовом поясе салона (toISOString дает дату по UTC - до 03:00 это еще вчера)
+function localDateString(date = new Date()) {
+    const month = String(date.getMonth() + 1).padStart(2, '0');
+    const day = String(date.getDate()).padStart(2, '0');
+    return `${date.getFullYear()}-${month}-${day}`;
+}
+
 // Middleware
 app.use(cors());
 app.use(express.json());
 app.use(express.static('sh'));
 app.use(express.static('back')); // Serve static files from 'back'
 app.use('/photo', express.static('photo'));
+
+// Сжатие JSON ответов API (gzip), если клиент его поддерживает. Мелкие ответы не сжимаем
+const GZIP_MIN_BYTES = 1024;
+app.use('/api', (req, res, next) => {
+    if (!req.get('Accept-Encoding') || !req.acceptsEncodings('gzip')) {
+        return next();
+    }
+    const originalJson = res.json.bind(res);
+    res.json = (body) => {
+        const payload = Buffer.from(JSON.stringify(body));
+        if (payload.length < GZIP_MIN_BYTES) {
+            return originalJson(body);
+        }
+        zlib.gzip(payload, (err, compressed) => {
+            if (err) {
+                return originalJson(body);
+            }
+            res.vary('Accept-Encoding');
+            res.set('Content-Encoding', 'gzip');
+            res.type('application/json');
+            res.send(compressed);
+        });
+        return res;
+    };
+    next();
+});
 // Добавьте в начало server.js для отладки
 console.log('Текущая директория:', __dirname);
 console.log('Путь к папке фото:', path.join(__dirname, 'photo/работники/'));
@@ -36,6 +70,125 @@ const db = new sqlite3.Database('./database.db', (err) => {
     }
 });
 
+// Версии таблиц для ETag: увеличиваются после каждого изменения данных в таблице
+const serverStartedAt = Date.now().toString(36);
+const tableVersions = {};
+
+function bumpTableVersion(sql) {
+    const match = /^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM)\s+([^\s(]+)/i.exec(sql);
+    if (match) {
+        tableVersions[match[1]] = (tableVersions[match[1]] || 0) + 1;
+    }
+}
+
+// Оборачиваем db.run, чтобы каждое успешное изменение увеличивало версию таблицы
+const originalDbRun = db.run.bind(db);
+db.run = function (sql, ...args) {
+    const callbackIndex = args.findIndex(arg => typeof arg === 'function');
+    const callback = callbackIndex >= 0 ? args[callbackIndex] : null;
+    const wrapped = function (err) {
+        if (!err) {
+            bumpTableVersion(sql);
+        }
+        if (callback) {
+            return callback.apply(this, arguments);
+        }
+    };
+    if (callbackIndex >= 0) {
+        args[callbackIndex] = wrapped;
+    } else {
+        args.push(wrapped);
+    }
+    return originalDbRun(sql, ...args);
+};
+
+// Middleware: ETag из версий таблиц. Если клиент прислал тот же ETag - 304 без запроса к БД
+function tableEtag(...tables) {
+    return (req, res, next) => {
+        const versions = tables.map(table => tableVersions[table] || 0).join('.');
+        res.set('ETag', `W/"${serverStartedAt}-${versions}"`);
+        if (req.fresh) {
+            return res.status(304).end();
+        }
+        next();
+    };
+}
+
+// Колоночный формат ответа (?format=compact): вместо массива объектов - массив значений на каждую колонку.
+// Для колонок из dictionaryColumns в columns хранятся индексы, а сами значения - один раз в dictionaries
+function toCompact(rows, columnNames, dictionaryColumns = []) {
+    const columns = {};
+    const dictionaries = {};
+    const positions = {};
+    columnNames.forEach(name => { columns[name] = []; });
+    dictionaryColumns.forEach(name => {
+        dictionaries[name] = [];
+        positions[name] = new Map();
+    });
+
+    rows.forEach(row => {
+        columnNames.forEach(name => {
+            const value = row[name];
+            if (!positions[name]) {
+                columns[name].push(value);
+                return;
+            }
+            let position = positions[name].get(value);
+            if (position === undefined) {
+                position = dictionaries[name].length;
+                dictionaries[name].push(value);
+                positions[name].set(value, position);
+            }
+            columns[name].push(position);
+        });
+    });
+
+    return { message: "success", format: "compact", count: rows.length, columns, dictionaries };
+}
+
+// Ожидающие long-poll запросы /api/appointment-events
+const appointmentEventWaiters = new Set();
+
+function notifyAppointmentEventWaiters() {
+    const waiters = [...appointmentEventWaiters];
+    appointmentEventWaiters.clear();
+    waiters.forEach(waiter => waiter());
+}
+
+// Записать событие по записи в outbox внутри текущей транзакции и выполнить COMMIT
+function commitWithAppointmentEvent(appointmentId, eventType, callback) {
+    const sql = "INSERT INTO события_записей (запись_id, тип) VALUES (?, ?)";
+    db.run(sql, [appointmentId, eventType], function(err) {
+        if (err) {
+            return callback(err);
+        }
+        db.run("COMMIT", function(err) {
+            if (!err) {
+                notifyAppointmentEventWaiters();
+            }
+            callback(err);
+        });
+    });
+}
+
+// Сколько дней хранить события по записям: бот читает outbox с курсора, полученного при запуске,
+// поэтому старые события ему не нужны
+const APPOINTMENT_EVENTS_KEEP_DAYS = 7;
+
+// Удалить события старше APPOINTMENT_EVENTS_KEEP_DAYS (при запуске и раз в сутки)
+function pruneAppointmentEvents() {
+    const sql = "DELETE FROM события_записей WHERE создано < datetime('now', '+3 hours', ?)";
+    db.run(sql, [`-${APPOINTMENT_EVENTS_KEEP_DAYS} days`], function(err) {
+        if (err) {
+            console.error('Error pruning appointment events:', err.message);
+            return;
+        }
+        if (this.changes > 0) {
+            console.log(`Удалено старых событий по записям: ${this.changes}`);
+        }
+    });
+}
+
 const adminPhotoStorage = multer.diskStorage({
     destination: function (req, file, cb) {
         const dir = path.join(__dirname, 'photo/администратор/');
@@ -523,7 +676,7 @@ app.post('/api/upload-service-photo', uploadService.single('photo'), async (req,
 
 
 // Добавить endpoint для получения всех услуг
-app.get('/api/services-all', (req, res) => {
+app.get('/api/services-all', tableEtag('услуги'), (req, res) => {
     const sql = "SELECT * FROM услуги WHERE доступен != 0 ORDER BY доступен DESC, категория, название";
     db.all(sql, [], (err, rows) => {
         if (err) {
@@ -571,6 +724,9 @@ app.get('/api/clients-with-tg', (req, res) => {
             res.status(500).json({ error: err.message });
             return;
         }
+        if (req.query.format === 'compact') {
+            return res.json(toCompact(rows, ['id', 'имя', 'телефон', 'tg_id'], ['имя']));
+        }
         res.json({
             message: "success",
             data: rows
@@ -578,20 +734,113 @@ app.get('/api/clients-with-tg', (req, res) => {
     });
 });
 
+// API endpoint для получателей рассылки постранично (keyset по id): по умолчанию только id и tg_id,
+// details=1 добавляет имя и телефон. next_after - afterId следующей страницы (null на последней)
+app.get('/api/broadcast-recipients', (req, res) => {
+    const afterId = parseInt(req.query.afterId) || 0;
+    const limit = Math.min(Math.max(parseInt(req.query.limit) || 100, 1), 1000);
+    const columns = req.query.details ? 'id, tg_id, имя, телефон' : 'id, tg_id';
+    const sql = `
+        SELECT ${columns}
+        FROM клиенты 
+        WHERE tg_id IS NOT NULL AND tg_id != '' AND id > ?
+        ORDER BY id
+        LIMIT ?
+    `;
+    
+    db.all(sql, [afterId, limit], (err, rows) => {
+        if (err) {
+            res.status(500).json({ error: err.message });
+            return;
+        }
+        res.json({
+            message: "success",
+            data: rows,
+            next_after: rows.length === limit ? rows[rows.length - 1].id : null
+        });
+    });
+});
+
 // API endpoint для массовой рассылки (для статистики)
 app.get('/api/broadcast-stats', (req, res) => {
-    const sql = "SELECT COUNT(*) as total FROM клиенты WHERE tg_id IS NOT NULL AND tg_id != ''";
+    const sql = `
+        SELECT 
+            COUNT(*) as total,
+            COUNT(н.tg_id) as dead
+        FROM клиенты к
+        LEFT JOIN недоступные_чаты н ON н.tg_id = к.tg_id
+        WHERE к.tg_id IS NOT NULL AND к.tg_id != ''
+    `;
     
     db.get(sql, [], (err, row) => {
+        if (err) {
+            res.status(500).json({ error: err.message });
+            return;
+        }
+        db.get('SELECT COUNT(*) as count FROM недоступные_чаты', [], (err, registry) => {
+            if (err) {
+                res.status(500).json({ error: err.message });
+                return;
+            }
+            res.json({
+                message: "success",
+                data: {
+                    total_clients: row.total,
+                    dead_clients: row.dead,
+                    reachable_clients: row.total - row.dead,
+                    dead_chats: registry.count
+                }
+            });
+        });
+    });
+});
+
+// API endpoint для реестра недоступных чатов (бот пропускает их при рассылках и уведомлениях)
+app.get('/api/dead-chats', (req, res) => {
+    db.all('SELECT tg_id, причина, отмечено FROM недоступные_чаты ORDER BY отмечено', [], (err, rows) => {
         if (err) {
             res.status(500).json({ error: err.message });
             return;
         }
         res.json({
             message: "success",
-            data: {
-                total_clients: row.total
-            }
+            data: rows
+        });
+    });
+});
+
+// API endpoint для отметки чата недоступным (повторная отметка обновляет время)
+app.post('/api/dead-chats', (req, res) => {
+    const { tg_id, причина } = req.body;
+
+    if (!tg_id) {
+        return res.status(400).json({ error: 'Не указан tg_id' });
+    }
+
+    const sql = `
+        INSERT INTO недоступные_чаты (tg_id, причина, отмечено)
+        VALUES (?, ?, datetime('now', '+3 hours'))
+        ON CONFLICT(tg_id) DO UPDATE SET причина = excluded.причина, отмечено = excluded.отмечено
+    `;
+    db.run(sql, [String(tg_id), причина || null], function(err) {
+        if (err) {
+            res.status(500).json({ error: err.message });
+            return;
+        }
+        res.json({ message: "success" });
+    });
+});
+
+// API endpoint для снятия отметки (чат снова доступен)
+app.delete('/api/dead-chats/:tg_id', (req, res) => {
+    db.run('DELETE FROM недоступные_чаты WHERE tg_id = ?', [req.params.tg_id], function(err) {
+        if (err) {
+            res.status(500).json({ error: err.message });
+            return;
+        }
+        res.json({
+            message: "success",
+            changes: this.changes
         });
     });
 });
@@ -704,6 +953,39 @@ db.run(`
             )
         `);
 
+        // Индекс для выборок свободного времени по дате
+        db.run(`
+            CREATE INDEX IF NOT EXISTS idx_расписание_доступно_дата
+            ON расписание (доступно, дата)
+        `);
+
+        // Индекс для выборок записей по дате (уведомления, отчеты)
+        db.run(`
+            CREATE INDEX IF NOT EXISTS idx_записи_дата
+            ON записи (дата, время)
+        `);
+
+        // Outbox событий по записям: бот читает их через long-poll /api/appointment-events
+        db.run(`
+            CREATE TABLE IF NOT EXISTS события_записей (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                запись_id INTEGER NOT NULL,
+                тип TEXT NOT NULL CHECK(тип IN ('created', 'updated', 'deleted')),
+                создано DATETIME DEFAULT (datetime('now', '+3 hours')),
+                FOREIGN KEY (запись_id) REFERENCES записи(id)
+            )
+        `);
+        pruneAppointmentEvents();
+
+        // Чаты, в которые бот не может писать (бот заблокирован или чат удален)
+        db.run(`
+            CREATE TABLE IF NOT EXISTS недоступные_чаты (
+                tg_id TEXT PRIMARY KEY,
+                причина TEXT,
+                отмечено DATETIME DEFAULT (datetime('now', '+3 hours'))
+            )
+        `);
+
         // Insert sample data if tables are empty
         db.get("SELECT COUNT(*) as count FROM мастера", [], (err, row) => {
             if (err) {
@@ -718,7 +1000,7 @@ db.run(`
 // server.js - добавить API endpoints для страниц
 
 // Получить контент страницы
-app.get('/api/pages/:pageName', (req, res) => {
+app.get('/api/pages/:pageName', tableEtag('страницы'), (req, res) => {
     const pageName = req.params.pageName;
     
     const sql = "SELECT элемент, текст FROM страницы WHERE страница = ? ORDER BY порядок";
@@ -886,7 +1168,7 @@ app.patch('/api/contact-visibility/:type', (req, res) => {
 });
 
 // Обновить endpoint для получения ссылок, чтобы учитывать доступность
-app.get('/api/links', (req, res) => {
+app.get('/api/links', tableEtag('ссылки'), (req, res) => {
     const sql = "SELECT тип, url, описание, COALESCE(доступен, 1) as доступен FROM ссылки WHERE COALESCE(доступен, 1) = 1";
     db.all(sql, [], (err, rows) => {
         if (err) {
@@ -1109,7 +1391,7 @@ app.get('/admin', (req, res) => {
 });
 
 // API endpoint to get all services
-app.get('/api/services', (req, res) => {
+app.get('/api/services', tableEtag('услуги'), (req, res) => {
     const sql = "SELECT * FROM услуги WHERE доступен = 1 ORDER BY категория, название";
     db.all(sql, [], (err, rows) => {
         if (err) {
@@ -1311,7 +1593,7 @@ app.delete('/api/service/:id', (req, res) => {
 });
 
 // API endpoint to get all specialists
-app.get('/api/specialists', (req, res) => {
+app.get('/api/specialists', tableEtag('мастера'), (req, res) => {
     const sql = "SELECT id, имя, описание, фото FROM мастера WHERE доступен = 1 ORDER BY имя";
     db.all(sql, [], (err, rows) => {
         if (err) {
@@ -1437,6 +1719,95 @@ app.get('/api/specialist/:specialistId/service/:serviceId/available-dates', (req
     });
 });
 
+// API endpoint to get first week (Mon-Sun) with free time for specialist and service
+// Возвращает первую свободную дату >= start (не позже until) и все свободные даты ее недели
+app.get('/api/specialist/:specialistId/service/:serviceId/available-week', (req, res) => {
+    const specialistId = req.params.specialistId;
+    const serviceId = req.params.serviceId;
+    const startDate = req.query.start;
+    const untilDate = req.query.until || '2099-12-31';
+
+    if (!startDate) {
+        return res.status(400).json({ error: 'Start date is required' });
+    }
+
+    const sql = `
+        WITH первая AS (
+            SELECT MIN(дата) as дата
+            FROM расписание
+            WHERE мастер_id = ?
+            AND услуга_id = ?
+            AND доступно = 1
+            AND дата BETWEEN ? AND ?
+        )
+        SELECT DISTINCT
+            р.дата,
+            п.дата as первая_дата,
+            date(п.дата, 'weekday 0', '-6 days') as начало_недели,
+            date(п.дата, 'weekday 0') as конец_недели
+        FROM первая п
+        JOIN расписание р ON р.дата BETWEEN date(п.дата, 'weekday 0', '-6 days') AND date(п.дата, 'weekday 0')
+        WHERE р.мастер_id = ?
+        AND р.услуга_id = ?
+        AND р.доступно = 1
+        ORDER BY р.дата
+    `;
+
+    db.all(sql, [specialistId, serviceId, startDate, untilDate, specialistId, serviceId], (err, rows) => {
+        if (err) {
+            res.status(500).json({ error: err.message });
+            return;
+        }
+
+        const first = rows[0];
+
+        res.json({
+            message: "success",
+            firstAvailableDate: first ? first.первая_дата : null,
+            weekStart: first ? first.начало_недели : null,
+            weekEnd: first ? first.конец_недели : null,
+            availableDates: rows.map(row => row.дата)
+        });
+    });
+});
+
+// API endpoint to get all (specialist, service) pairs with free time from start date
+// Один сгруппированный запрос вместо перебора услуг × мастеров × available-dates
+app.get('/api/available-pairs', (req, res) => {
+    const startDate = req.query.start || localDateString();
+
+    const sql = `
+        SELECT
+            р.мастер_id,
+            м.имя as мастер_имя,
+            р.услуга_id,
+            у.название as услуга_название,
+            у.цена,
+            у.категория,
+            MIN(р.дата) as ближайшая_дата
+        FROM расписание р
+        JOIN мастера м ON р.мастер_id = м.id
+        JOIN услуги у ON р.услуга_id = у.id
+        WHERE р.доступно = 1
+        AND р.дата >= ?
+        AND м.доступен = 1
+        AND у.доступен = 1
+        GROUP BY р.мастер_id, р.услуга_id
+        ORDER BY у.категория, у.название, м.имя
+    `;
+
+    db.all(sql, [startDate], (err, rows) => {
+        if (err) {
+            res.status(500).json({ error: err.message });
+            return;
+        }
+        res.json({
+            message: "success",
+            data: rows
+        });
+    });
+});
+
 
 // API endpoint to get specialist by ID
 app.get('/api/specialist/:id', (req, res) => {
@@ -1736,7 +2107,7 @@ app.put('/api/appointment/:id', (req, res) => {
                                 return;
                             }
                             
-                            db.run("COMMIT", function(err) {
+                            commitWithAppointmentEvent(appointmentId, 'updated', function(err) {
                                 if (err) {
                                     db.run("ROLLBACK");
                                     res.status(500).json({ error: err.message });
@@ -1842,7 +2213,7 @@ app.patch('/api/appointment/:id/change-master', (req, res) => {
                         }
 
                         // Коммитим транзакцию
-                        db.run("COMMIT", function(err) {
+                        commitWithAppointmentEvent(appointmentId, 'updated', function(err) {
                             if (err) {
                                 db.run("ROLLBACK");
                                 res.status(500).json({ error: err.message });
@@ -2086,8 +2457,10 @@ app.post('/api/admin/appointment', (req, res) => {
                             return;
                         }
                         
+                        const appointmentId = this.lastID;
+                        
                         // Commit transaction
-                        db.run("COMMIT", function(err) {
+                        commitWithAppointmentEvent(appointmentId, 'created', function(err) {
                             if (err) {
                                 db.run("ROLLBACK");
                                 res.status(500).json({ error: err.message });
@@ -2097,7 +2470,7 @@ app.post('/api/admin/appointment', (req, res) => {
                             res.json({
                                 message: "success",
                                 appointment: {
-                                    id: this.lastID,
+                                    id: appointmentId,
                                     clientId: clientId,
                                     specialistId: specialistId,
                                     serviceId: serviceId,
@@ -2117,7 +2490,7 @@ app.post('/api/admin/appointment', (req, res) => {
 });
 
 // В API endpoint для получения всех мастеров изменим запрос
-app.get('/api/specialists-all', (req, res) => {
+app.get('/api/specialists-all', tableEtag('мастера'), (req, res) => {
     const sql = "SELECT id, имя, описание, фото, доступен, tg_id FROM мастера WHERE доступен != 0 ORDER BY доступен DESC, имя";    db.all(sql, [], (err, rows) => {
         if (err) {
             res.status(500).json({ error: err.message });
@@ -2593,7 +2966,7 @@ app.get('/api/schedule-available', (req, res) => {
 });
 
 // API endpoint для управления свободным временем (только от текущей даты)
-app.get('/api/freetime-available', (req, res) => {
+app.get('/api/freetime-available', tableEtag('расписание', 'мастера', 'услуги'), (req, res) => {
     const masterId = req.query.masterId;
     const fromDate = req.query.fromDate;
     const toDate = req.query.toDate;
@@ -2634,6 +3007,13 @@ app.get('/api/freetime-available', (req, res) => {
             res.status(500).json({ error: err.message });
             return;
         }
+        if (req.query.format === 'compact') {
+            return res.json(toCompact(
+                rows,
+                ['id', 'дата', 'время', 'мастер_id', 'услуга_id', 'доступно', 'мастер_имя', 'услуга_название', 'услуга_цена'],
+                ['дата', 'мастер_имя', 'услуга_название', 'услуга_цена']
+            ));
+        }
         res.json({
             message: "success",
             data: rows
@@ -3229,6 +3609,57 @@ app.post('/api/notification-sent', (req, res) => {
 
 
 
+// API endpoint для пакетной отметки уведомлений как отправленных (одна транзакция на пакет)
+app.post('/api/notifications-sent', (req, res) => {
+    const items = Array.isArray(req.body.items) ? req.body.items : [];
+    
+    if (items.length === 0 || items.some(item => !item || !item.запись_id || !item.тип)) {
+        return res.status(400).json({ error: 'Нужен непустой список items с полями запись_id и тип' });
+    }
+    
+    const sql = `
+        INSERT INTO уведомления (запись_id, тип, отправлено) 
+        VALUES (?, ?, 1)
+        ON CONFLICT(запись_id, тип) 
+        DO UPDATE SET отправлено = 1, время_отправки = datetime('now', 'localtime')
+    `;
+    
+    db.serialize(() => {
+        db.run("BEGIN TRANSACTION");
+        
+        let failed = null;
+        const stmt = db.prepare(sql);
+        items.forEach(item => {
+            stmt.run([item.запись_id, item.тип], (err) => {
+                if (err && !failed) {
+                    failed = err;
+                }
+            });
+        });
+        
+        stmt.finalize(() => {
+            if (failed) {
+                db.run("ROLLBACK");
+                res.status(500).json({ error: failed.message });
+                return;
+            }
+            
+            db.run("COMMIT", function(err) {
+                if (err) {
+                    db.run("ROLLBACK");
+                    res.status(500).json({ error: err.message });
+                    return;
+                }
+                
+                res.json({
+                    message: "success",
+                    count: items.length
+                });
+            });
+        });
+    });
+});
+
 app.get('/api/check-notification', (req, res) => {
     const запись_id = req.query.запись_id;
     const тип = req.query.тип;
@@ -3297,8 +3728,10 @@ app.get('/api/appointments-for-hourly', (req, res) => {
 app.delete('/api/appointment/:id', (req, res) => {
     const appointmentId = req.params.id;
 
-    // Start a transaction to ensure atomicity
+    // Удаление, освобождение слота и событие для бота - в одной транзакции
     db.serialize(() => {
+        db.run("BEGIN TRANSACTION");
+
         // Get appointment details
         const getAppointmentSql = `
             SELECT мастер_id, услуга_id, дата, время 
@@ -3308,11 +3741,13 @@ app.delete('/api/appointment/:id', (req, res) => {
         
         db.get(getAppointmentSql, [appointmentId], (err, appointment) => {
             if (err) {
+                db.run("ROLLBACK");
                 console.error('Error getting appointment:', err);
                 return res.status(500).json({ error: 'Ошибка получения данных записи' });
             }
             
             if (!appointment) {
+                db.run("ROLLBACK");
                 return res.status(404).json({ error: 'Запись не найдена' });
             }
             
@@ -3320,11 +3755,13 @@ app.delete('/api/appointment/:id', (req, res) => {
             const deleteSql = `DELETE FROM записи WHERE id = ?`;
             db.run(deleteSql, [appointmentId], function(err) {
                 if (err) {
+                    db.run("ROLLBACK");
                     console.error('Error deleting appointment:', err);
                     return res.status(500).json({ error: 'Ошибка удаления записи' });
                 }
                 
                 if (this.changes === 0) {
+                    db.run("ROLLBACK");
                     return res.status(404).json({ error: 'Запись не найдена' });
                 }
                 
@@ -3342,28 +3779,38 @@ app.delete('/api/appointment/:id', (req, res) => {
                     [appointment.мастер_id, appointment.услуга_id, appointment.дата, appointment.время], 
                     function(err) {
                         if (err) {
+                            db.run("ROLLBACK");
                             console.error('Error updating schedule:', err);
                             return res.status(500).json({ error: 'Ошибка обновления расписания' });
                         }
                         
+                        const scheduleUpdated = this.changes > 0;
+                        
                         // Log the update for debugging
                         console.log(`Updated schedule slot: master=${appointment.мастер_id}, service=${appointment.услуга_id}, date=${appointment.дата}, time=${appointment.время}, rows affected=${this.changes}`);
                         
-                        res.json({
-                            message: "success",
-                            data: { 
-                                id: appointmentId,
-                                scheduleUpdated: this.changes > 0
+                        // Событие для бота: напоминания по удаленной записи больше не нужны
+                        commitWithAppointmentEvent(appointmentId, 'deleted', function(err) {
+                            if (err) {
+                                db.run("ROLLBACK");
+                                console.error('Error adding appointment event:', err);
+                                return res.status(500).json({ error: 'Ошибка удаления записи' });
                             }
+                            
+                            res.json({
+                                message: "success",
+                                data: { 
+                                    id: appointmentId,
+                                    scheduleUpdated: scheduleUpdated
+                                }
+                            });
                         });
                     }
                 );
             });
         });
     });
-
-
-});   
+});
 
 
 
@@ -3531,7 +3978,7 @@ app.post('/api/appointment', (req, res) => {
                                 const appointmentId = this.lastID;
                                 
                                 // Commit transaction
-                                db.run("COMMIT", function(err) {
+                                commitWithAppointmentEvent(appointmentId, 'created', function(err) {
                                     if (err) {
                                         db.run("ROLLBACK");
                                         res.status(500).json({ error: err.message });
@@ -3563,6 +4010,90 @@ app.post('/api/appointment', (req, res) => {
 });
 
 
+// API endpoint для чтения событий по записям (long-poll).
+// Без after возвращает только текущий курсор; с after ждет новых событий до timeout секунд
+const APPOINTMENT_EVENTS_MAX_WAIT = 30;
+app.get('/api/appointment-events', (req, res) => {
+    if (req.query.after === undefined) {
+        db.get("SELECT COALESCE(MAX(id), 0) as cursor FROM события_записей", [], (err, row) => {
+            if (err) {
+                res.status(500).json({ error: err.message });
+                return;
+            }
+            res.json({ message: "success", data: [], cursor: row.cursor });
+        });
+        return;
+    }
+
+    const after = parseInt(req.query.after) || 0;
+    const limit = Math.min(parseInt(req.query.limit) || 100, 500);
+    const waitMs = Math.min(parseInt(req.query.timeout) || 0, APPOINTMENT_EVENTS_MAX_WAIT) * 1000;
+
+    const sql = `
+        SELECT 
+            с.id as событие_id,
+            с.тип as событие_тип,
+            с.запись_id,
+            з.id,
+            з.дата,
+            з.время,
+            з.цена,
+            з.created_at,
+            з.мастер_id,
+            з.услуга_id,
+            к.имя as клиент_имя,
+            к.телефон as клиент_телефон,
+            к.tg_id as клиент_tg_id,
+            у.название as услуга_название,
+            м.имя as мастер_имя,
+            м.tg_id as мастер_tg_id
+        FROM события_записей с
+        LEFT JOIN записи з ON с.запись_id = з.id
+        LEFT JOIN клиенты к ON з.клиент_id = к.id
+        LEFT JOIN услуги у ON з.услуга_id = у.id
+        LEFT JOIN мастера м ON з.мастер_id = м.id
+        WHERE с.id > ?
+        ORDER BY с.id
+        LIMIT ?
+    `;
+
+    let timer = null;
+    const waiter = () => {
+        clearTimeout(timer);
+        readEvents(false);
+    };
+
+    function readEvents(canWait) {
+        db.all(sql, [after, limit], (err, rows) => {
+            if (err) {
+                res.status(500).json({ error: err.message });
+                return;
+            }
+            if (rows.length === 0 && canWait && waitMs > 0) {
+                appointmentEventWaiters.add(waiter);
+                timer = setTimeout(() => {
+                    appointmentEventWaiters.delete(waiter);
+                    readEvents(false);
+                }, waitMs);
+                return;
+            }
+            res.json({
+                message: "success",
+                data: rows,
+                cursor: rows.length ? rows[rows.length - 1].событие_id : after
+            });
+        });
+    }
+
+    // Клиент отключился - перестаем ждать
+    res.on('close', () => {
+        clearTimeout(timer);
+        appointmentEventWaiters.delete(waiter);
+    });
+
+    readEvents(true);
+});
+
 // Добавить после существующих endpoints для страниц
 
 // API endpoint для получения всех элементов страницы с порядком
@@ -3703,6 +4234,107 @@ app.get('/api/appointments-for-daily-simple', (req, res) => {
     }
 });
 
+// API endpoint для записей, по которым еще не отправлено уведомление указанного типа.
+// тип можно передать списком через запятую - строка возвращается для каждой пары (запись, недостающий тип).
+// afterId - курсор: только записи с id больше указанного; в ответе cursor - id, с которого продолжать
+const NOTIFICATION_TYPES = ['daily', 'hourly', 'new', 'masternew', 'immediate'];
+app.get('/api/appointments-without-notification', (req, res) => {
+    const types = String(req.query.тип || '').split(',').map(type => type.trim()).filter(Boolean);
+    const startDate = req.query.startDate;
+    const endDate = req.query.endDate;
+    const createdSince = req.query.createdSince;
+    const afterId = req.query.afterId === undefined ? null : parseInt(req.query.afterId);
+
+    if (types.length === 0 || types.some(type => !NOTIFICATION_TYPES.includes(type))) {
+        return res.status(400).json({ error: `Укажите тип уведомления: ${NOTIFICATION_TYPES.join(', ')}` });
+    }
+
+    if (Number.isNaN(afterId) || afterId < 0) {
+        return res.status(400).json({ error: 'afterId должен быть неотрицательным числом' });
+    }
+
+    let sql = `
+        WITH типы(тип) AS (VALUES ${types.map(() => '(?)').join(', ')})
+        SELECT 
+            т.тип as тип_уведомления,
+            з.id,
+            з.дата,
+            з.время,
+            з.цена,
+            з.created_at,
+            з.мастер_id,
+            з.услуга_id,
+            к.имя as клиент_имя,
+            к.телефон as клиент_телефон,
+            к.tg_id as клиент_tg_id,
+            у.название as услуга_название,
+            м.имя as мастер_имя,
+            м.tg_id as мастер_tg_id
+        FROM записи з
+        CROSS JOIN типы т
+        LEFT JOIN клиенты к ON з.клиент_id = к.id
+        LEFT JOIN услуги у ON з.услуга_id = у.id
+        LEFT JOIN мастера м ON з.мастер_id = м.id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM уведомления 
+            WHERE запись_id = з.id AND тип = т.тип AND отправлено = 1
+        )
+    `;
+    const params = [...types];
+
+    if (startDate) {
+        sql += ' AND з.дата >= ?';
+        params.push(startDate);
+    }
+
+    if (endDate) {
+        sql += ' AND з.дата <= ?';
+        params.push(endDate);
+    }
+
+    if (createdSince) {
+        sql += ' AND з.created_at >= ?';
+        params.push(createdSince);
+    }
+
+    if (afterId === null) {
+        sql += ' ORDER BY з.дата ASC, з.время ASC, з.id ASC';
+
+        db.all(sql, params, (err, rows) => {
+            if (err) {
+                res.status(500).json({ error: err.message });
+                return;
+            }
+            res.json({
+                message: "success",
+                data: rows
+            });
+        });
+        return;
+    }
+
+    // Верхнюю границу фиксируем заранее: записи, созданные во время запроса, попадут в следующий опрос
+    db.get('SELECT MAX(id) as max_id FROM записи', [], (err, row) => {
+        if (err) {
+            res.status(500).json({ error: err.message });
+            return;
+        }
+        const cursor = Math.max(afterId, row.max_id || 0);
+
+        db.all(sql + ' AND з.id > ? AND з.id <= ? ORDER BY з.id ASC', [...params, afterId, cursor], (err, rows) => {
+            if (err) {
+                res.status(500).json({ error: err.message });
+                return;
+            }
+            res.json({
+                message: "success",
+                data: rows,
+                cursor: cursor
+            });
+        });
+    });
+});
+
 // server.js - endpoint для суточных уведомлений мастерам
 app.get('/api/appointments-for-master-daily', (req, res) => {
     try {
@@ -3749,6 +4381,75 @@ app.get('/api/appointments-for-master-daily', (req, res) => {
     }
 });
 
+// API endpoint для ежедневной рассылки мастерам: записи на дату одним запросом, сгруппированные по мастерам
+// (только мастера с tg_id)
+app.get('/api/appointments-by-master', (req, res) => {
+    const date = req.query.date;
+    
+    if (!date) {
+        return res.status(400).json({ error: 'date обязателен' });
+    }
+    
+    const sql = `
+        SELECT 
+            з.id,
+            з.дата,
+            з.время,
+            з.цена,
+            з.мастер_id,
+            м.имя as мастер_имя,
+            м.tg_id as мастер_tg_id,
+            к.имя as клиент_имя,
+            к.телефон as клиент_телефон,
+            у.название as услуга_название
+        FROM записи з
+        JOIN мастера м ON з.мастер_id = м.id
+        LEFT JOIN клиенты к ON з.клиент_id = к.id
+        LEFT JOIN услуги у ON з.услуга_id = у.id
+        WHERE з.дата = ?
+        AND м.tg_id IS NOT NULL 
+        AND м.tg_id != ''
+        AND м.доступен != 0
+        ORDER BY з.мастер_id, з.время
+    `;
+    
+    db.all(sql, [date], (err, rows) => {
+        if (err) {
+            res.status(500).json({ error: err.message });
+            return;
+        }
+        
+        // Строки уже отсортированы по мастеру - группируем за один проход
+        const masters = [];
+        rows.forEach(row => {
+            let master = masters[masters.length - 1];
+            if (!master || master.мастер_id !== row.мастер_id) {
+                master = {
+                    мастер_id: row.мастер_id,
+                    мастер_имя: row.мастер_имя,
+                    мастер_tg_id: row.мастер_tg_id,
+                    записи: []
+                };
+                masters.push(master);
+            }
+            master.записи.push({
+                id: row.id,
+                дата: row.дата,
+                время: row.время,
+                цена: row.цена,
+                клиент_имя: row.клиент_имя,
+                клиент_телефон: row.клиент_телефон,
+                услуга_название: row.услуга_название
+            });
+        });
+        
+        res.json({
+            message: "success",
+            data: masters
+        });
+    });
+});
+
 // API endpoint для обновления порядка элементов
 app.put('/api/page-content-order/:pageName', (req, res) => {
     const pageName = req.params.pageName;
@@ -3865,6 +4566,9 @@ app.listen(PORT, () => {
     console.log(`Server is running on http://localhost:${PORT}`);
 });
 
+// Ежедневная очистка outbox событий по записям
+setInterval(pruneAppointmentEvents, 24 * 60 * 60 * 1000);
+
 // Graceful shutdown
 process.on('SIGTERM', shutDown);
 process.on('SIGINT', shutDown);